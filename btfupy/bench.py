@@ -0,0 +1,596 @@
+import binascii
+import contextlib
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from . import checkout
+from . import commit
+from .blobstore import asyncserver
+from .blobstore import cache
+from .blobstore import client
+from .blobstore import local
+from .blobstore import server
+from .blobstore import treestore
+
+FORMAT = 1 # version of the JSON results
+SEED = 1
+REPEAT = 3
+LOOPBACK = '127.0.0.1'
+BLOCK_SIZE = 1024 * 1024 # generated file content is written in these
+FUSE_IO_SIZE = 128 * 1024 # what the kernel asks BTFS to read or write
+BATCH_SIZE = 100 # blobs per call in batched client benchmarks
+TEXT_RATIO = 0.5 # fraction of generated files that are compressible text
+VOCABULARY_SIZE = 1024
+
+# Synthetic trees: ``depth`` levels of ``width`` subdirectories each, with
+# ``files`` files of ``sizes`` bytes in every directory. ``files`` is
+# multiplied by the scale of the run.
+PROFILES = {
+    'small': dict(depth=2, width=6, files=50, sizes=(64, 8 * 1024)),
+    'huge': dict(depth=0, width=0, files=2, sizes=(4 << 20, 12 << 20)),
+    'deep': dict(depth=32, width=1, files=4, sizes=(64, 4 * 1024)),
+    'wide': dict(depth=0, width=0, files=4000, sizes=(16, 1024)),
+}
+PROFILE_ORDER = ['small', 'huge', 'deep', 'wide']
+
+# Results are only comparable between runs with the same settings.
+SETTINGS = ['seed', 'scale', 'repeat', 'engine', 'compress']
+# The metrics ``compare`` shows, and whether bigger is better.
+COMPARED = [
+    ('ops_per_sec', True),
+    ('p50_ms', False),
+    ('p99_ms', False),
+    ('requests', False),
+    ('peak_rss_kb', False),
+]
+
+
+def iter_random(rng, size, vocabulary):
+    while size > 0:
+        n = min(size, BLOCK_SIZE)
+        yield binascii.unhexlify('%0*x' % (2 * n, rng.getrandbits(8 * n)))
+        size -= n
+
+
+def iter_text(rng, size, vocabulary):
+    while size > 0:
+        n = min(size, BLOCK_SIZE)
+        words = []
+        length = 0
+        while length <= n: # the joined words are one separator shorter
+            word = rng.choice(vocabulary)
+            words.append(word)
+            length += len(word) + 1
+        yield ' '.join(words)[:n]
+        size -= n
+
+
+def generate(path, profile, seed=SEED, scale=1.0):
+    """Write the synthetic tree ``profile`` into the new directory ``path``
+    and return the relative path and size of each of its files. The same
+    seed and scale always give the same tree.
+    """
+    spec = PROFILES[profile]
+    rng = random.Random(int(hashlib.sha1('%s-%s' % (seed, profile))
+                            .hexdigest(), 16))
+    vocabulary = [''.join(rng.choice(string.ascii_lowercase)
+                          for _ in xrange(rng.randint(2, 10)))
+                  for _ in xrange(VOCABULARY_SIZE)]
+    count = max(int(round(spec['files'] * scale)), 1)
+    files = []
+    level = ['']
+    for depth in xrange(spec['depth'] + 1):
+        next_level = []
+        for dirpath in level:
+            os.mkdir(os.path.join(path, dirpath))
+            for i in xrange(count):
+                size = rng.randint(*spec['sizes'])
+                if rng.random() < TEXT_RATIO:
+                    name, blocks = 'f%d.txt' % i, iter_text
+                else:
+                    name, blocks = 'f%d.bin' % i, iter_random
+                name = os.path.join(dirpath, name)
+                with open(os.path.join(path, name), 'wb') as fp:
+                    for block in blocks(rng, size, vocabulary):
+                        fp.write(block)
+                files.append((name, size))
+            if depth < spec['depth']:
+                next_level.extend(os.path.join(dirpath, 'd%d' % i)
+                                  for i in xrange(spec['width']))
+        level = next_level
+    return files
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of the sorted ``values``."""
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in KiB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024 # bytes there, KiB everywhere else
+    return rss
+
+
+def get_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self):
+        with self.lock:
+            self.count += 1
+
+
+class CountingRequestHandler(server.BlobRequestHandler):
+
+    def log_request(self, code='-', size='-'):
+        self.server.requests.add()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CountingBlobServer(server.BlobServer):
+
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        server.BlobServer.__init__(self, *args, **kwargs)
+        self.RequestHandlerClass = CountingRequestHandler
+        self.requests = Counter()
+
+
+class CountingAsyncBlobServer(asyncserver.AsyncBlobServer):
+
+    def __init__(self, *args, **kwargs):
+        asyncserver.AsyncBlobServer.__init__(self, *args, **kwargs)
+        self.requests = Counter()
+
+    def log_request(self, addr, request, response):
+        self.requests.add()
+
+
+class Loopback(object):
+    """Serves a new store under ``path`` on an ephemeral port of the
+    loopback interface, from a background thread, and counts the requests
+    it serves.
+    """
+
+    def __init__(self, path, engine='threaded', compress=False):
+        self.path = path
+        self.compress = compress
+        store_path = os.path.join(path, 'store')
+        store = local.LocalBlobStore(store_path, compress=compress)
+        if engine == 'async':
+            self.server = CountingAsyncBlobServer(store_path, LOOPBACK, 0,
+                                                  store=store)
+            port = self.server.socket.getsockname()[1]
+        else:
+            self.server = CountingBlobServer(store_path, LOOPBACK, 0,
+                                             store=store)
+            port = self.server.server_address[1]
+        self.url = 'http://%s:%d' % (LOOPBACK, port)
+        self.requests = self.server.requests
+        self.clients = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def client(self, root_path):
+        """Return a store that talks to the server through a new, cold
+        cache. ``root_path`` holds the ``.btfuignore`` file.
+        """
+        self.clients += 1
+        cache_path = os.path.join(self.path, 'cache%d' % self.clients)
+        return treestore.RootStore(self.url, None, root_name=root_path,
+                                   cache_path=cache_path,
+                                   compress=self.compress)
+
+    def close(self):
+        self.server.shutdown()
+        if hasattr(self.server, 'server_close'):
+            self.server.server_close()
+
+
+class Measurement(object):
+    """Collects the latency of every operation of one benchmark, and the
+    number of items and bytes they processed and requests they made.
+    """
+
+    def __init__(self, name, requests=None):
+        self.name = name
+        self.requests = requests
+        self.latencies = []
+        self.items = 0
+        self.bytes = 0
+        self.request_count = 0
+
+    @contextlib.contextmanager
+    def op(self, size=0, items=1):
+        """Time the body of the ``with`` statement as one operation."""
+        requests = self.requests.count if self.requests else 0
+        start = time.time()
+        yield
+        self.latencies.append(time.time() - start)
+        self.items += items
+        self.bytes += size
+        if self.requests is not None:
+            self.request_count += self.requests.count - requests
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        seconds = sum(latencies)
+        result = {
+            'name': self.name,
+            'ops': len(latencies),
+            'items': self.items,
+            'bytes': self.bytes,
+            'seconds': round(seconds, 6),
+            'ops_per_sec': None,
+            'bytes_per_sec': None,
+            'requests': None,
+        }
+        if seconds:
+            result['ops_per_sec'] = round(self.items / seconds, 3)
+            result['bytes_per_sec'] = round(self.bytes / seconds, 3)
+        for key, fraction in [('p50_ms', 0.5), ('p90_ms', 0.9),
+                              ('p99_ms', 0.99), ('max_ms', 1.0)]:
+            value = percentile(latencies, fraction)
+            result[key] = None if value is None else round(value * 1000, 3)
+        if self.requests is not None:
+            result['requests'] = self.request_count
+        return result
+
+
+class Benchmark(object):
+    """Runs the benchmark groups on synthetic trees under the scratch
+    directory ``path``. Every group runs in a forked process so that its
+    peak RSS is its own, and each result reports the items processed per
+    second (blobs or files), latency percentiles over its operations, the
+    requests the loopback server saw and the peak RSS of its group.
+    """
+
+    def __init__(self, path, seed=SEED, scale=1.0, repeat=REPEAT,
+                 engine='threaded', compress=False, log=sys.stderr):
+        self.path = path
+        self.seed = seed
+        self.scale = scale
+        self.repeat = max(repeat, 1)
+        self.engine = engine
+        self.compress = compress
+        self.log = log
+        self.trees = {}
+        self.groups = [('local', self.bench_local),
+                       ('cache', self.bench_cache),
+                       ('client', self.bench_client)]
+        self.groups.extend(('tree.%s' % profile,
+                            lambda profile=profile: self.bench_tree(profile))
+                           for profile in PROFILE_ORDER)
+        self.groups.append(('fs', self.bench_fs))
+        with open(os.path.join(path, '.btfuignore'), 'w'):
+            pass
+
+    def __report(self, message):
+        if self.log is not None:
+            print >>self.log, 'bench: %s' % message
+
+    def __mkdtemp(self, prefix):
+        return tempfile.mkdtemp(prefix=prefix, dir=self.path)
+
+    def __loopback(self):
+        return Loopback(self.__mkdtemp('server'), engine=self.engine,
+                        compress=self.compress)
+
+    def __client(self, loopback):
+        return loopback.client(self.path)
+
+    def tree(self, profile):
+        """Return the path and files of the synthetic tree ``profile``,
+        generating it the first time.
+        """
+        if profile not in self.trees:
+            path = os.path.join(self.path, 'tree-%s' % profile)
+            start = time.time()
+            files = generate(path, profile, seed=self.seed, scale=self.scale)
+            self.__report('generated %s: %d files, %d bytes in %.1fs' %
+                          (profile, len(files), sum(s for _, s in files),
+                           time.time() - start))
+            self.trees[profile] = path, files
+        return self.trees[profile]
+
+    def read_blobs(self, profile):
+        path, files = self.tree(profile)
+        blobs = []
+        for name, _ in files:
+            with open(os.path.join(path, name), 'rb') as fp:
+                blobs.append(fp.read())
+        return blobs
+
+    def bench_local(self):
+        blobs = self.read_blobs('small')
+        store = local.LocalBlobStore(self.__mkdtemp('local'),
+                                     compress=self.compress)
+        put = Measurement('local.put_blob')
+        get = Measurement('local.get_blob')
+        refs = []
+        for blob in blobs:
+            with put.op(len(blob)):
+                refs.append(store.put_blob(blob))
+        for _ in xrange(self.repeat):
+            for ref, blob in zip(refs, blobs):
+                with get.op(len(blob)):
+                    store.get_blob(ref)
+        return [put, get]
+
+    def bench_cache(self):
+        blobs = self.read_blobs('small')
+        path = self.__mkdtemp('cache')
+        store = cache.BlobCache(path, compress=self.compress)
+        put = Measurement('cache.put_blob')
+        hot = Measurement('cache.get_blob.memory')
+        disk = Measurement('cache.get_blob.disk')
+        refs = []
+        for blob in blobs:
+            with put.op(len(blob)):
+                refs.append(store.put_blob(blob))
+        for _ in xrange(self.repeat):
+            for ref, blob in zip(refs, blobs):
+                with hot.op(len(blob)):
+                    store.get_blob(ref)
+        for _ in xrange(self.repeat):
+            # a new cache on the same path starts with an empty memory tier
+            store = cache.BlobCache(path, compress=self.compress)
+            for ref, blob in zip(refs, blobs):
+                with disk.op(len(blob)):
+                    store.get_blob(ref)
+        return [put, hot, disk]
+
+    def bench_client(self):
+        blobs = self.read_blobs('small')
+        results = []
+        for batched in [False, True]:
+            suffix = 's' if batched else ''
+            loopback = self.__loopback()
+            put = Measurement('client.put_blob' + suffix, loopback.requests)
+            store = self.__client(loopback)
+            refs = []
+            if batched:
+                for i in xrange(0, len(blobs), BATCH_SIZE):
+                    batch = blobs[i:i + BATCH_SIZE]
+                    with put.op(sum(map(len, batch)), len(batch)):
+                        refs.extend(store.put_blobs(batch))
+            else:
+                for blob in blobs:
+                    with put.op(len(blob)):
+                        refs.append(store.put_blob(blob))
+            get = Measurement('client.get_blob' + suffix, loopback.requests)
+            for _ in xrange(self.repeat):
+                store = self.__client(loopback)
+                if batched:
+                    for i in xrange(0, len(refs), BATCH_SIZE):
+                        batch = refs[i:i + BATCH_SIZE]
+                        size = sum(map(len, blobs[i:i + BATCH_SIZE]))
+                        with get.op(size, len(batch)):
+                            store.get_blobs(batch)
+                else:
+                    for ref, blob in zip(refs, blobs):
+                        with get.op(len(blob)):
+                            store.get_blob(ref)
+            results.extend([put, get])
+            loopback.close()
+        return results
+
+    def bench_tree(self, profile):
+        path, files = self.tree(profile)
+        size = sum(s for _, s in files)
+        put = Measurement('put_tree.%s' % profile)
+        again = Measurement('put_tree.%s.unchanged' % profile)
+        pipeline = Measurement('commit.%s' % profile)
+        fetch = Measurement('checkout.%s' % profile)
+        for _ in xrange(self.repeat):
+            loopback = self.__loopback()
+            put.requests = again.requests = loopback.requests
+            store = self.__client(loopback)
+            with put.op(size, len(files)):
+                treeref = store.put_file(path)
+            with again.op(size, len(files)):
+                store.put_file(path)
+            loopback.close()
+        for _ in xrange(self.repeat):
+            loopback = self.__loopback()
+            pipeline.requests = loopback.requests
+            with pipeline.op(size, len(files)):
+                commit.Commit(self.__client(loopback)).run(path)
+            loopback.close()
+        loopback = self.__loopback()
+        treeref = self.__client(loopback).put_file(path)
+        fetch.requests = loopback.requests
+        for _ in xrange(self.repeat):
+            dest = self.__mkdtemp('checkout')
+            with fetch.op(size, len(files)):
+                errors = checkout.Checkout(self.__client(loopback),
+                                           progress=None).run(treeref, dest)
+            if errors:
+                raise IOError('checkout failed: %s' % errors[0])
+            shutil.rmtree(dest)
+        loopback.close()
+        return [put, again, pipeline, fetch]
+
+    def bench_fs(self):
+        try:
+            from . import fs
+        except (ImportError, EnvironmentError), e:
+            return [{'name': 'fs', 'skipped': 'fuse is unavailable: %s' % e}]
+        path, files = self.tree('small')
+        loopback = self.__loopback()
+        treeref = self.__client(loopback).put_file(path)
+        btfs = fs.BTFS(self.__client(loopback), treeref)
+        paths = [('/' + name, size) for name, size in files]
+        cold = Measurement('fs.getattr.cold', loopback.requests)
+        for name, _ in paths:
+            with cold.op():
+                btfs.getattr(name)
+        warm = Measurement('fs.getattr', loopback.requests)
+        for _ in xrange(self.repeat):
+            for name, _ in paths:
+                with warm.op():
+                    btfs.getattr(name)
+        read = Measurement('fs.read', loopback.requests)
+        for name, size in paths:
+            with read.op(size):
+                fh = btfs.open(name, os.O_RDONLY)
+                offset = 0
+                while True:
+                    data = btfs.read(name, FUSE_IO_SIZE, offset, fh)
+                    offset += len(data)
+                    if len(data) < FUSE_IO_SIZE:
+                        break
+                btfs.release(name, fh)
+            if offset != size:
+                raise IOError('read %d bytes of %s instead of %d' %
+                              (offset, name, size))
+        write = Measurement('fs.write', loopback.requests)
+        blobs = self.read_blobs('small')
+        for i, blob in enumerate(blobs):
+            name = '/new%d' % i
+            with write.op(len(blob)):
+                fh = btfs.create(name, 0100644)
+                for offset in xrange(0, len(blob), FUSE_IO_SIZE):
+                    btfs.write(name, blob[offset:offset + FUSE_IO_SIZE],
+                               offset, fh)
+                btfs.release(name, fh)
+        done = Measurement('fs.commit', loopback.requests)
+        with done.op(sum(map(len, blobs)), len(blobs)):
+            btfs.commit()
+        loopback.close()
+        return [cold, warm, read, write, done]
+
+    def run_group(self, name, func):
+        """Run ``func`` in a child process and return its results."""
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = 0
+            try:
+                results = []
+                for measurement in func():
+                    if isinstance(measurement, Measurement):
+                        measurement = measurement.result()
+                        measurement['peak_rss_kb'] = peak_rss()
+                    results.append(measurement)
+            except Exception, e:
+                traceback.print_exc()
+                results = [{'name': name, 'error': str(e)}]
+                status = 1
+            with os.fdopen(write_fd, 'w') as fp:
+                json.dump(results, fp)
+            os._exit(status)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as fp:
+            data = fp.read()
+        os.waitpid(pid, 0)
+        try:
+            return json.loads(data)
+        except ValueError:
+            return [{'name': name, 'error': 'the benchmark process died'}]
+
+    def run(self, only=None):
+        """Run the groups whose names start with one of the prefixes
+        ``only``, or all of them, and return the results as a dict.
+        """
+        results = []
+        for name, func in self.groups:
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            if name.startswith('tree.'):
+                self.tree(name[len('tree.'):])
+            elif name in ['local', 'cache', 'client', 'fs']:
+                self.tree('small')
+            self.__report('running %s' % name)
+            start = time.time()
+            results.extend(self.run_group(name, func))
+            self.__report('%s took %.1fs' % (name, time.time() - start))
+        return {
+            'format': FORMAT,
+            'revision': get_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'seed': self.seed,
+            'scale': self.scale,
+            'repeat': self.repeat,
+            'engine': self.engine,
+            'compress': bool(self.compress),
+            'pool_size': client.POOL_SIZE,
+            'results': results,
+        }
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.3f' % value
+    return str(value)
+
+
+def compare(old, new, fp=sys.stdout):
+    """Print the change in each compared metric of the results ``new``
+    from the results ``old``, marking changes of more than 10% for the
+    worse with ``!``.
+    """
+    for key in SETTINGS:
+        if old.get(key) != new.get(key):
+            print >>fp, 'warning: the runs differ in %s: %s and %s' % (
+                key, old.get(key), new.get(key))
+    old_results = dict((result['name'], result) for result in old['results'])
+    print >>fp, '%-32s %-12s %14s %14s %9s' % ('benchmark', 'metric', 'old',
+                                               'new', 'change')
+    for result in new['results']:
+        base = old_results.get(result['name'])
+        if base is None:
+            continue
+        for key, bigger_is_better in COMPARED:
+            old_value, new_value = base.get(key), result.get(key)
+            if old_value is None or new_value is None:
+                continue
+            change = '-'
+            if old_value:
+                ratio = float(new_value - old_value) / old_value
+                change = '%+.1f%%' % (100 * ratio)
+                if (ratio < -0.1 if bigger_is_better else ratio > 0.1):
+                    change += '!'
+            print >>fp, '%-32s %-12s %14s %14s %9s' % (
+                result['name'], key, format_value(old_value),
+                format_value(new_value), change)
@@ -11,6 +11,13 @@ class BlobStore(object):
         otherwise ``None``.
         """
 
+    def get_encoded_blob(self, blobref):
+        """May return the encoding and content of the blob at the given
+        ``blobref`` if it's stored compressed, so that it can be sent without
+        being decompressed. Returns ``None`` otherwise.
+        """
+        return None
+
     @abc.abstractmethod
     def get_link(self, link):
         """Should return the blobref at the given ``link`` if it exists,
@@ -25,13 +32,59 @@ class BlobStore(object):
     def has_blob(self, blobref):
         """Should return ``True`` if the blob exists, otherwise ``False``."""
 
+    def iter_links(self, prefix=''):
+        """Generate the links that start with ``prefix``, in order, a page
+        at a time.
+        """
+        after = ''
+        while True:
+            page = self.list_links(prefix, after)
+            if page is None:
+                raise IOError('could not list links')
+            for link in page:
+                yield link
+            if not page:
+                return
+            after = page[-1]
+
+    def list_links(self, prefix='', after='', limit=None):
+        """May return up to ``limit`` of the links that start with
+        ``prefix`` and sort after ``after``, in order. By default they're
+        filtered from the list of every link.
+        """
+        links = [link for link in (self.get_link('') or '').split('\n')
+                 if link.startswith(prefix) and link > after]
+        return links[:limit] if limit else links
+
+    def open_blob(self, blobref):
+        """May return the blob at the given ``blobref`` as a
+        ``local.BlobFile``, so that it can be sent without being read into
+        memory. Returns ``None`` if it doesn't exist or can't be opened.
+        """
+        return None
+
     @abc.abstractmethod
     def put_blob(self, blob):
         """Should store the given ``blob`` and return its blobref."""
 
+    def put_blob_stream(self, fp):
+        """Should store the content of the file object ``fp`` and return its
+        blobref. By default the content is read into memory and passed to
+        ``put_blob``.
+        """
+        return self.put_blob(fp.read())
+
+    def touch_blob(self, blobref):
+        """May mark the blob at the given ``blobref`` as recently used, so
+        that it isn't garbage collected. Returns ``True`` if it exists.
+        """
+        return self.has_blob(blobref)
+
     @abc.abstractmethod
-    def set_link(self, link, blobref):
+    def set_link(self, link, blobref, expected=None):
         """Should set the value ``link`` to ``blobref``. If ``link`` is empty,
         generate one. If ``blobref`` is empty, delete ``link``. If both are
-        empty, return ``None``. Otherwise, return either ``link`` or the link
-        that was generated."""
+        empty, return ``None``. If ``expected`` isn't ``None`` and ``link``
+        doesn't currently point to it (or exist, if it's empty), leave it
+        alone and return ``None``. Otherwise, return either ``link`` or the
+        link that was generated."""
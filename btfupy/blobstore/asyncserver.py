@@ -0,0 +1,553 @@
+import asyncore
+import collections
+import cStringIO
+import errno
+import email.utils
+import httplib
+import Queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from . import compression
+from . import local
+from . import server
+from . import zerocopy
+from .. import metrics
+
+MAX_CONNECTIONS = 1024
+MAX_INFLIGHT = 16 # requests handled by the store at the same time
+IDLE_TIMEOUT = 60 # close keep-alive connections idle for this many seconds
+MAX_HEADER_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024 # request bodies bigger than this go to disk
+READ_SIZE = 64 * 1024
+
+
+class Request(object):
+
+    def __init__(self, command, path, version, headers):
+        self.command = command
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        self.encoding = headers.get('Content-Encoding')
+        encoding = headers.get('Transfer-Encoding') or ''
+        self.chunked = encoding.lower() == 'chunked'
+        self.remaining = 0 if self.chunked else int(
+            headers.get('Content-Length') or 0)
+        # 'size' while a chunk size line is expected, 'data' within a
+        # chunk, 'end' for the line break after it and 'trailer' after the
+        # last chunk.
+        self.chunk_state = 'size'
+
+    def keep_alive(self):
+        connection = (self.headers.get('Connection') or '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def read(self):
+        self.body.seek(0)
+        content = self.body.read()
+        self.body.close()
+        return compression.decompress(content, self.encoding,
+                                      compression.MAX_DECODED_SIZE)
+
+    def stream(self):
+        """Return a file object that reads the decoded body."""
+        self.body.seek(0)
+        return compression.decoding_reader(self.body, self.encoding)
+
+    @classmethod
+    def parse(cls, header):
+        """Parse a request line and headers, or return ``None`` if they're
+        malformed.
+        """
+        lines = header.split('\r\n')
+        words = lines[0].split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            return None
+        headers = httplib.HTTPMessage(cStringIO.StringIO(
+            '\r\n'.join(lines[1:]) + '\r\n\r\n'))
+        try:
+            request = cls(words[0], words[1], words[2], headers)
+        except ValueError:
+            return None
+        if request.remaining < 0:
+            return None
+        return request
+
+
+class Response(object):
+    """A response whose body is a string or a file of ``length`` bytes
+    that's streamed to the client as the socket becomes writable.
+    """
+
+    def __init__(self, code, body='', headers=None, length=None,
+                 close=False):
+        self.code = code
+        self.body = body
+        self.headers = headers or {}
+        self.length = len(body) if length is None else length
+        self.close = close
+
+    def header(self):
+        lines = ['HTTP/1.1 %d %s' % (self.code, httplib.responses[self.code]),
+                 'Date: %s' % email.utils.formatdate(usegmt=True),
+                 'Content-Length: %d' % self.length,
+                 'Content-Type: text/plain',
+                 'Accept-Encoding: %s' % ', '.join(compression.ENCODINGS)]
+        for key, value in self.headers.iteritems():
+            lines.append('%s: %s' % (key, value))
+        if self.close:
+            lines.append('Connection: close')
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+class BlobConnection(asyncore.dispatcher):
+    """An HTTP/1.1 connection. Requests are read one at a time; while one is
+    being handled, or its response hasn't been sent yet, nothing more is
+    read from the socket, so a slow client holds back only itself.
+    """
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.inbuf = ''
+        self.outbuf = collections.deque()
+        self.request = None
+        self.busy = False
+        self.closing = False
+        self.last_active = time.time()
+        self.sendfile = zerocopy.can_sendfile(sock)
+
+    def readable(self):
+        return not (self.busy or self.closing or self.outbuf)
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_read(self):
+        data = self.recv(READ_SIZE)
+        if not data:
+            self.close()
+            return
+        self.last_active = time.time()
+        self.inbuf += data
+        self.process()
+
+    def process(self):
+        while not (self.busy or self.closing):
+            if self.request is None:
+                i = self.inbuf.find('\r\n\r\n')
+                if i < 0:
+                    if len(self.inbuf) > MAX_HEADER_SIZE:
+                        self.respond(Response(
+                            httplib.REQUEST_ENTITY_TOO_LARGE, close=True))
+                    return
+                header = self.inbuf[:i]
+                self.inbuf = self.inbuf[i + 4:]
+                if not header.strip():
+                    continue
+                self.request = Request.parse(header)
+                if self.request is None:
+                    self.respond(Response(httplib.BAD_REQUEST, close=True))
+                    return
+            request = self.request
+            if request.chunked:
+                try:
+                    if not self.read_chunks(request):
+                        return
+                except ValueError:
+                    self.respond(Response(httplib.BAD_REQUEST, close=True))
+                    return
+            elif request.remaining:
+                self.read_data(request)
+                if request.remaining:
+                    return
+            self.request = None
+            self.busy = True
+            self.server.submit(self, request)
+
+    def read_data(self, request):
+        data = self.inbuf[:request.remaining]
+        self.inbuf = self.inbuf[len(data):]
+        request.body.write(data)
+        request.remaining -= len(data)
+
+    def read_line(self):
+        i = self.inbuf.find('\r\n')
+        if i < 0:
+            if len(self.inbuf) > MAX_HEADER_SIZE:
+                raise ValueError('line too long')
+            return None
+        line = self.inbuf[:i]
+        self.inbuf = self.inbuf[i + 2:]
+        return line
+
+    def read_chunks(self, request):
+        """Decode as much of a chunked body as has arrived and return
+        ``True`` once all of it has.
+        """
+        while True:
+            if request.chunk_state == 'data':
+                self.read_data(request)
+                if request.remaining:
+                    return False
+                request.chunk_state = 'end'
+                continue
+            line = self.read_line()
+            if line is None:
+                return False
+            if request.chunk_state == 'end':
+                request.chunk_state = 'size'
+            elif request.chunk_state == 'trailer':
+                if not line:
+                    return True
+            else:
+                request.remaining = int(line.split(';', 1)[0], 16)
+                if request.remaining < 0:
+                    raise ValueError('negative chunk size')
+                if request.remaining:
+                    request.chunk_state = 'data'
+                else:
+                    request.chunk_state = 'trailer'
+
+    def respond(self, response, request=None):
+        """Queue ``response`` to be sent. Called on the event loop thread."""
+        self.busy = False
+        if request is None or not request.keep_alive():
+            response.close = True
+        header = response.header()
+        if not response.length or (request and request.command == 'HEAD'):
+            if hasattr(response.body, 'close'):
+                response.body.close()
+            self.outbuf.append(header)
+        elif isinstance(response.body, str):
+            self.outbuf.append(header + response.body)
+        else:
+            self.outbuf.extend([header, response.body])
+        if request is not None:
+            self.server.log_request(self.addr, request, response)
+        self.closing = response.close
+        self.last_active = time.time()
+        self.process()
+
+    def handle_write(self):
+        while self.outbuf:
+            data = self.outbuf[0]
+            if not isinstance(data, str) and self.sendfile:
+                if not self.send_blob_file(data):
+                    return
+                data.close()
+                self.outbuf.popleft()
+                continue
+            elif not isinstance(data, str):
+                chunk = data.read(READ_SIZE)
+                if not chunk:
+                    data.close()
+                    self.outbuf.popleft()
+                    continue
+                self.outbuf.appendleft(chunk)
+                data = chunk
+            sent = self.send(data)
+            self.last_active = time.time()
+            if sent < len(data):
+                self.outbuf[0] = data[sent:]
+                return
+            self.outbuf.popleft()
+        if self.closing:
+            self.close()
+
+    def send_blob_file(self, blob_file):
+        """Have the kernel send the next chunk of ``blob_file`` and return
+        ``True`` once all of it has been sent.
+        """
+        if blob_file.pos < blob_file.size:
+            try:
+                sent = zerocopy.sendfile(
+                    self.socket.fileno(), blob_file.fileno(),
+                    blob_file.offset + blob_file.pos,
+                    min(blob_file.size - blob_file.pos, zerocopy.CHUNK_SIZE))
+            except OSError, e:
+                if e.errno in [errno.EPIPE, errno.ECONNRESET]:
+                    self.close()
+                elif e.errno not in [errno.EAGAIN, errno.EINTR]:
+                    raise
+                return False
+            if not sent:
+                raise IOError('blob file ended early')
+            blob_file.seek(blob_file.pos + sent)
+            self.last_active = time.time()
+        return blob_file.pos >= blob_file.size
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.close()
+
+    def close(self):
+        for data in self.outbuf:
+            if not isinstance(data, str):
+                data.close()
+        self.outbuf.clear()
+        self.server.connections.discard(self)
+        asyncore.dispatcher.close(self)
+
+
+class Waker(asyncore.dispatcher):
+    """Wakes the event loop up from another thread."""
+
+    def __init__(self, map, callback):
+        self.writer, reader = socket.socketpair()
+        self.writer.setblocking(0)
+        asyncore.dispatcher.__init__(self, reader, map=map)
+        self.callback = callback
+        self.lock = threading.Lock()
+
+    def wake(self):
+        with self.lock:
+            try:
+                self.writer.send('x')
+            except socket.error:
+                pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(READ_SIZE)
+        self.callback()
+
+    def close(self):
+        self.writer.close()
+        asyncore.dispatcher.close(self)
+
+
+class AsyncBlobServer(asyncore.dispatcher, server.StoreServer):
+    """Serves the same protocol as ``BlobServer`` from a single event loop.
+    At most ``max_connections`` connections are accepted; further clients
+    wait in the listen backlog. Store calls are made by ``max_inflight``
+    worker threads, and requests beyond that queue up without being read
+    any further.
+    """
+
+    def __init__(self, path, host, port, auth_token=None, store=None,
+                 max_connections=MAX_CONNECTIONS, max_inflight=MAX_INFLIGHT):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.store = store if store is not None else local.LocalBlobStore(path)
+        self.existence = self.open_existence()
+        self.history = self.open_history()
+        self.path = path
+        self.auth_token = auth_token
+        self.max_connections = max_connections
+        self.connections = set()
+        self.pending = collections.deque()
+        self.work = Queue.Queue()
+        self.done = collections.deque()
+        self.waker = Waker(self.map, self.finish)
+        self.running = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.workers = [threading.Thread(target=self.__work)
+                        for _ in xrange(max(max_inflight, 1))]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def readable(self):
+        return len(self.connections) < self.max_connections
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            pair[0].setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections.add(BlobConnection(pair[0], self))
+
+    def log_request(self, addr, request, response):
+        sys.stderr.write('%s - - [%s] "%s %s %s" %d -\n' % (
+            addr[0], time.strftime('%d/%b/%Y %H:%M:%S'), request.command,
+            request.path, request.version, response.code))
+
+    def submit(self, connection, request):
+        self.work.put((connection, request))
+
+    def finish(self):
+        while self.done:
+            connection, request, response = self.done.popleft()
+            if connection in self.connections:
+                connection.respond(response, request)
+
+    def __work(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            connection, request = item
+            start = time.time()
+            try:
+                response = self.handle_request(request)
+            except compression.CorruptContent:
+                response = Response(httplib.BAD_REQUEST, close=True)
+            except:
+                metrics.incr('server.errors')
+                traceback.print_exc()
+                response = Response(httplib.INTERNAL_SERVER_ERROR)
+            metrics.observe(
+                'server.' + server.route_name(request.command, request.path),
+                time.time() - start)
+            self.done.append((connection, request, response))
+            self.waker.wake()
+
+    def handle_request(self, request):
+        if not server.authenticate(self.auth_token, request.command,
+                                   request.path, request.headers):
+            request.body.close()
+            return Response(httplib.FORBIDDEN, close=True)
+        if not compression.supported(request.encoding):
+            request.body.close()
+            return Response(httplib.UNSUPPORTED_MEDIA_TYPE, close=True)
+        path = request.path
+        if request.command in ['GET', 'HEAD']:
+            request.body.close()
+            if path.startswith(server.BLOBS_PATH):
+                return self.get_blob_response(path[len(server.BLOBS_PATH):],
+                                              request)
+            elif path.startswith(server.LINKS_PATH + '?'):
+                try:
+                    content = self.get_links_content(
+                        path[len(server.LINKS_PATH) + 1:])
+                except ValueError:
+                    return Response(httplib.BAD_REQUEST)
+                return self.encoded_response(content, request)
+            elif path.startswith(server.LINKS_PATH):
+                blobref = self.get_link(path[len(server.LINKS_PATH):])
+                if blobref is None:
+                    return Response(httplib.NOT_FOUND)
+                return self.encoded_response(blobref, request)
+            elif path.startswith(server.HISTORY_PATH):
+                try:
+                    content = self.get_history_content(
+                        path[len(server.HISTORY_PATH):])
+                except ValueError:
+                    return Response(httplib.BAD_REQUEST)
+                if content is None:
+                    return Response(httplib.NOT_FOUND)
+                return self.encoded_response(content, request)
+            elif path == server.STATS_PATH:
+                return self.encoded_response(self.get_stats_content(),
+                                             request)
+        elif request.command == 'POST':
+            if path == server.BLOBS_PATH:
+                try:
+                    return Response(httplib.OK,
+                                    self.put_blob_stream(request.stream()))
+                finally:
+                    request.body.close()
+            content = request.read()
+            if path == server.LINKS_PATH:
+                return self.set_link_response(None, content, request)
+            elif path == server.BATCH_HAS_PATH:
+                return Response(httplib.OK, '\n'.join(
+                    ref for ref in content.split() if not self.has_blob(ref)))
+            elif path == server.BATCH_GET_PATH:
+                return self.encoded_response(server.pack_blobs(
+                    (ref, self.get_blob(ref)) for ref in content.split()),
+                    request)
+            elif path == server.BATCH_PUT_PATH:
+                try:
+                    return Response(httplib.OK,
+                                    self.put_blobs_content(content))
+                except ValueError:
+                    return Response(httplib.BAD_REQUEST)
+        elif request.command in ['PUT', 'DELETE']:
+            content = request.read()
+            if path.startswith(server.LINKS_PATH):
+                link = path[len(server.LINKS_PATH):]
+                if request.command == 'DELETE':
+                    content = None
+                return self.set_link_response(link, content, request)
+        else:
+            request.body.close()
+            return Response(httplib.NOT_IMPLEMENTED, close=True)
+        return Response(httplib.METHOD_NOT_ALLOWED)
+
+    def encoded_response(self, content, request):
+        headers = {}
+        if request.command != 'HEAD':
+            content = server.encode_content(
+                content, request.headers.get('Accept-Encoding'), headers)
+        return Response(httplib.OK, content, headers)
+
+    def set_link_response(self, link, ref, request):
+        expected = server.parse_precondition(request.headers)
+        link = self.set_link(link, ref, expected)
+        if link is not None:
+            return Response(httplib.OK, link)
+        elif expected is not None:
+            return Response(httplib.PRECONDITION_FAILED)
+        return Response(httplib.NOT_FOUND)
+
+    def get_blob_response(self, ref, request):
+        if request.command == 'HEAD' and not self.has_blob(ref):
+            return Response(httplib.NOT_FOUND)
+        size = self.get_size(ref)
+        if size is None:
+            return Response(httplib.NOT_FOUND)
+        headers = {'Accept-Ranges': 'bytes'}
+        try:
+            byte_range = server.parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return Response(httplib.REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers=headers)
+        if byte_range is None:
+            start, end = 0, size - 1
+            code = httplib.OK
+        else:
+            start, end = byte_range
+            code = httplib.PARTIAL_CONTENT
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        if byte_range is None and request.command == 'GET':
+            content = self.get_encoded_content(
+                ref, size, request.headers.get('Accept-Encoding'), headers)
+            if content is not None:
+                return Response(code, content, headers)
+        blob_file = self.open_blob(ref)
+        if blob_file is None:
+            blob = self.get_blob(ref, end - start + 1, start)
+            if blob is None:
+                return Response(httplib.NOT_FOUND)
+            return Response(code, blob, headers)
+        blob_file = blob_file.range(start, end - start + 1)
+        return Response(code, blob_file, headers, length=blob_file.size)
+
+    def close_idle(self):
+        deadline = time.time() - IDLE_TIMEOUT
+        for connection in list(self.connections):
+            if connection.last_active < deadline and not connection.busy:
+                connection.close()
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            asyncore.loop(timeout=1.0, map=self.map, count=1)
+            self.close_idle()
+
+    def shutdown(self):
+        self.running = False
+        for worker in self.workers:
+            self.work.put(None)
+        asyncore.close_all(self.map)
@@ -1,17 +1,261 @@
+import atexit
+import hashlib
 import os
+import sys
+import tempfile
+import threading
+import time
 
-import memcache
+try:
+    import memcache
+except ImportError:
+    memcache = None
 
 from . import local
+from .. import lru
+from .. import metrics
+
+# Partially fetched blobs are tracked in blocks of this many bytes. They count
+# towards the disk limit under their ref with PARTIAL_PREFIX in front.
+PARTIAL_BLOCK_SIZE = 64 * 1024
+PARTIAL_PREFIX = 'partial/'
+
+# Budgets of the in-process tiers. Tree blobs (and chunk indexes) get their
+# own budget so that reading big files doesn't evict the directory
+# structure.
+TREE_BLOB_BYTES = 32 * 1024 * 1024
+FILE_BLOB_BYTES = 64 * 1024 * 1024
+SIZE_ENTRIES = 64 * 1024
+# Blobs bigger than this are never held in memory; ranges of them are read
+# from disk directly.
+MEMORY_BLOB_MAX = 4 * 1024 * 1024
+# memcached silently rejects values bigger than its item size, 1 MiB by
+# default, so larger blobs aren't sent to it.
+MEMCACHE_VALUE_MAX = 1024 * 1024 - 1024
+
+# Tree blobs and chunk indexes are told apart from file data by how they
+# start: with an entry, or with the format line of treestore.format_tree.
+TREE_PREFIXES = ('tree sha1-', 'blob sha1-', 'chunks sha1-', 'chunk sha1-',
+                 'format ')
+
+# Limit on the blobs kept on disk. Once it's exceeded, least recently used
+# blobs are removed in the background until the cache is down to
+# EVICT_TARGET of it. Tree blobs are ranked as if they had been used
+# TREE_GRACE seconds later than they were, so directory structure outlives
+# file contents of the same age.
+DISK_BYTES = 4 * 1024 * 1024 * 1024
+EVICT_TARGET = 0.9
+TREE_GRACE = 24 * 60 * 60
+# Accesses are appended to the index this many at a time, and the index is
+# rewritten once it has more than COMPACT_RATIO lines per cached blob.
+INDEX_FLUSH_LINES = 256
+COMPACT_RATIO = 4
+COMPACT_MIN_LINES = 4096
+
+
+class DiskIndex(object):
+    """Tracks the size, last access time and kind of every blob in the disk
+    tier of ``cache`` and evicts the least recently used ones from a
+    background thread once they add up to more than ``max_bytes``. The
+    index is kept in a log of ``ref size atime kind`` lines, of which the
+    last one for a ref wins, so processes sharing the cache see each other's
+    accesses the next time they start. Partially fetched blobs are tracked
+    and evicted too, by the bytes fetched so far.
+    """
+
+    def __init__(self, cache, max_bytes):
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.path = os.path.join(cache.store_path, 'index')
+        self.entries = {}
+        self.bytes = 0
+        self.lines = 0
+        self.pending = []
+        self.lock = threading.Lock()
+        self.log_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        if os.path.exists(self.path):
+            self.__load()
+        else:
+            self.__scan()
+        self.__scan_partial()
+        atexit.register(self.flush)
+        thread = threading.Thread(target=self.__evict_loop)
+        thread.daemon = True
+        thread.start()
+        if self.bytes > self.max_bytes:
+            self.wakeup.set()
+
+    def __load(self):
+        with open(self.path, 'rb') as fp:
+            for line in fp:
+                self.lines += 1
+                try:
+                    ref, size, atime, kind = line.split()
+                    size = int(size)
+                    atime = int(atime)
+                except ValueError:
+                    continue # torn by a crash mid-write
+                self.__set(ref, size, atime, kind == 't')
+
+    def __scan(self):
+        # The cache predates the index, so every blob starts out as a file
+        # blob last used when it was written.
+        for ref, path in self.cache.iter_blobs():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            self.__set(ref, st.st_size, int(st.st_mtime), False)
+        self.__compact()
+
+    def __scan_partial(self):
+        # Partial blobs left by versions that didn't track them.
+        for ref, size, mtime in self.cache.iter_partial_blobs():
+            if PARTIAL_PREFIX + ref not in self.entries:
+                self.__set(PARTIAL_PREFIX + ref, size, int(mtime), False)
+
+    def __set(self, ref, size, atime, tree):
+        old = self.entries.pop(ref, None)
+        if old is not None:
+            self.bytes -= old[0]
+        if size >= 0:
+            self.entries[ref] = (size, atime, tree)
+            self.bytes += size
+
+    def __compact(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache.store_path,
+                                        prefix='.tmp-index-')
+        with os.fdopen(fd, 'wb') as fp:
+            for ref, (size, atime, tree) in self.entries.iteritems():
+                fp.write('%s %d %d %s\n' % (ref, size, atime,
+                                            't' if tree else 'f'))
+        os.rename(tmp_path, self.path)
+        self.lines = len(self.entries)
+
+    def touch(self, ref, size, tree):
+        """Record that the blob at ``ref`` was used or written."""
+        now = int(time.time())
+        with self.lock:
+            old = self.entries.get(ref)
+            if (old is not None and old[0] == size and old[1] == now and
+                    old[2] >= tree):
+                return
+            tree = tree or (old is not None and old[2])
+            self.__set(ref, size, now, tree)
+            self.pending.append('%s %d %d %s\n' % (ref, size, now,
+                                                   't' if tree else 'f'))
+            flush = len(self.pending) >= INDEX_FLUSH_LINES
+            if self.bytes > self.max_bytes:
+                self.wakeup.set()
+        if flush:
+            self.flush()
+
+    def forget(self, ref):
+        """Record that the blob at ``ref`` was removed."""
+        with self.lock:
+            if ref not in self.entries:
+                return
+            self.__set(ref, -1, 0, False)
+            self.pending.append('%s -1 0 f\n' % ref)
+
+    def flush(self):
+        """Append the accesses recorded so far to the index, and rewrite it
+        if it has grown too long.
+        """
+        with self.log_lock:
+            with self.lock:
+                lines, self.pending = self.pending, []
+                self.lines += len(lines)
+                compact = self.lines > max(COMPACT_RATIO * len(self.entries),
+                                           COMPACT_MIN_LINES)
+            try:
+                if compact:
+                    with self.lock:
+                        self.__compact()
+                elif lines:
+                    with open(self.path, 'ab') as fp:
+                        fp.write(''.join(lines))
+            except (IOError, OSError), e:
+                print >>sys.stderr, 'WARNING: %s: %s' % (self.path, e)
+
+    @staticmethod
+    def __rank(entry):
+        size, atime, tree = entry
+        return atime + TREE_GRACE if tree else atime
+
+    def evict(self):
+        """Remove least recently used blobs until the cache is down to
+        ``EVICT_TARGET`` of its limit, and return how many bytes were freed.
+        """
+        with self.lock:
+            excess = self.bytes - int(self.max_bytes * EVICT_TARGET)
+            if self.bytes <= self.max_bytes or excess <= 0:
+                return 0
+            ranked = sorted(self.entries.iteritems(),
+                            key=lambda (ref, entry): self.__rank(entry))
+        victims = []
+        for ref, (size, _, _) in ranked:
+            if excess <= 0:
+                break
+            victims.append(ref)
+            excess -= size
+        freed = 0
+        for ref in victims:
+            if ref.startswith(PARTIAL_PREFIX):
+                self.cache.delete_partial_blob(ref[len(PARTIAL_PREFIX):])
+            else:
+                self.cache.delete_blob(ref)
+            with self.lock:
+                old = self.entries.get(ref)
+                if old is None:
+                    continue
+                freed += old[0]
+                self.__set(ref, -1, 0, False)
+                self.pending.append('%s -1 0 f\n' % ref)
+        self.flush()
+        return freed
+
+    def __evict_loop(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                self.evict()
+            except Exception, e:
+                print >>sys.stderr, 'WARNING: cache eviction failed: %s' % e
 
 
 class BlobCache(local.LocalBlobStore):
+    """A local blob store used as a cache. Blobs are looked up in memory
+    first, then in memcached if ``memcache_url`` is given, and then on disk,
+    where at most ``disk_bytes`` of them are kept, or any amount if it's 0,
+    compressed if ``compress`` is true.
+    """
 
-    def __init__(self, path=None, memcache_url=None):
+    def __init__(self, path=None, memcache_url=None,
+                 tree_blob_bytes=TREE_BLOB_BYTES,
+                 file_blob_bytes=FILE_BLOB_BYTES, disk_bytes=DISK_BYTES,
+                 compress=False):
         if path is None:
             path = os.path.join(os.environ['HOME'], '.cache', 'btfu')
-        super(BlobCache, self).__init__(path)
-        self.memcache_client = memcache.Client([memcache_url or '127.0.0.1'])
+        super(BlobCache, self).__init__(path, compress=compress)
+        self.tree_blobs = lru.LRUCache(tree_blob_bytes)
+        self.file_blobs = lru.LRUCache(file_blob_bytes)
+        self.sizes = lru.LRUCache(SIZE_ENTRIES)
+        self.memcache_client = None
+        if memcache_url and memcache is None:
+            print >>sys.stderr, ('WARNING: python-memcached is not installed; '
+                                 'not using memcached')
+        elif memcache_url:
+            self.memcache_client = memcache.Client([memcache_url])
+        self.partial_path = os.path.join(self.store_path, 'partial')
+        if not os.path.exists(self.partial_path):
+            os.mkdir(self.partial_path)
+        self.partial_lock = threading.Lock()
+        self.disk_index = None
+        if disk_bytes > 0:
+            self.disk_index = DiskIndex(self, disk_bytes)
 
     @classmethod
     def __get_memcache_key(cls, prefix, postfix):
@@ -25,7 +269,11 @@ class BlobCache(local.LocalBlobStore):
         key = self.__get_memcache_key(prefix, postfix)
         if key is None:
             return None
-        return self.memcache_client.get(key)
+        with metrics.timer('cache.memcache.get'):
+            value = self.memcache_client.get(key)
+        metrics.incr('cache.memcache.%s.%s' %
+                     (prefix, 'miss' if value is None else 'hit'))
+        return value
 
     def __memcache_set(self, prefix, postfix, value):
         if not self.memcache_client:
@@ -37,34 +285,225 @@ class BlobCache(local.LocalBlobStore):
             return
         self.memcache_client.add(key, value)
 
+    def __get_partial_paths(self, ref):
+        path = os.path.join(self.partial_path, os.path.basename(ref))
+        return path, path + '.map'
+
+    def __load_partial_map(self, ref):
+        try:
+            with open(self.__get_partial_paths(ref)[1], 'rb') as fp:
+                total = int(fp.readline())
+                return total, bytearray(fp.read())
+        except (IOError, ValueError):
+            return None, None
+
+    def __touch_partial(self, ref, blocks):
+        if self.disk_index is not None:
+            self.disk_index.touch(PARTIAL_PREFIX + ref,
+                                  sum(blocks) * PARTIAL_BLOCK_SIZE, False)
+
+    def __forget_partial(self, ref):
+        if self.disk_index is not None:
+            self.disk_index.forget(PARTIAL_PREFIX + ref)
+
+    def iter_partial_blobs(self):
+        """Generate the ref, the number of bytes fetched and the time of the
+        last fetch of every partially fetched blob.
+        """
+        for name in os.listdir(self.partial_path):
+            if not name.endswith('.map'):
+                continue
+            ref = name[:-len('.map')]
+            with self.partial_lock:
+                total, blocks = self.__load_partial_map(ref)
+                try:
+                    mtime = os.stat(self.__get_partial_paths(ref)[1]).st_mtime
+                except OSError:
+                    continue
+            if total is not None:
+                yield ref, sum(blocks) * PARTIAL_BLOCK_SIZE, mtime
+
+    def delete_partial_blob(self, ref):
+        """Remove what has been fetched of the blob at ``ref``."""
+        with self.partial_lock:
+            for path in self.__get_partial_paths(ref):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def get_partial_blob(self, ref, size=-1, offset=0):
+        """Return ``size`` bytes at ``offset`` from the partially fetched blob
+        at ``ref`` if every block in that range has been fetched, otherwise
+        ``None``.
+        """
+        with self.partial_lock:
+            total, blocks = self.__load_partial_map(ref)
+            if total is None:
+                return None
+            end = total if size < 0 else min(offset + size, total)
+            if offset >= end:
+                return ''
+            first = offset // PARTIAL_BLOCK_SIZE
+            last = (end - 1) // PARTIAL_BLOCK_SIZE
+            if not all(blocks[first:last + 1]):
+                return None
+            self.__touch_partial(ref, blocks)
+            with open(self.__get_partial_paths(ref)[0], 'rb') as fp:
+                fp.seek(offset)
+                return fp.read(end - offset)
+
+    def put_partial_blob(self, ref, offset, data, total):
+        """Store ``data`` fetched from ``offset`` in the blob at ``ref``, which
+        is ``total`` bytes long. ``offset`` must be a multiple of
+        ``PARTIAL_BLOCK_SIZE``. Once every block has been fetched the blob is
+        verified and moved into the cache proper, a buffer at a time, so
+        that it's never held in memory as a whole.
+        """
+        data_path, map_path = self.__get_partial_paths(ref)
+        if offset == 0 and len(data) == total:
+            self.delete_partial_blob(ref)
+            self.__forget_partial(ref)
+            if self.blobref(data) == ref:
+                BlobCache.put_blob(self, data)
+            return
+        with self.partial_lock:
+            known_total, blocks = self.__load_partial_map(ref)
+            if known_total != total:
+                blocks = bytearray(-(-total // PARTIAL_BLOCK_SIZE))
+            fd = os.open(data_path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            end = offset + len(data)
+            for i in xrange(offset // PARTIAL_BLOCK_SIZE, len(blocks)):
+                if min((i + 1) * PARTIAL_BLOCK_SIZE, total) > end:
+                    break
+                blocks[i] = 1
+            if all(blocks):
+                if os.path.exists(map_path):
+                    os.remove(map_path)
+                try:
+                    self.__put_partial_file(ref, data_path)
+                finally:
+                    os.remove(data_path)
+                    self.__forget_partial(ref)
+                return
+            with open(map_path, 'wb') as fp:
+                fp.write('%d\n' % total)
+                fp.write(blocks)
+            self.__touch_partial(ref, blocks)
+
+    def __put_partial_file(self, ref, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fp:
+            for data in iter(lambda: fp.read(local.BUFFER_SIZE), ''):
+                digest.update(data)
+        if 'sha1-%s' % digest.hexdigest() != ref:
+            return
+        with open(path, 'rb') as fp:
+            BlobCache.put_blob_stream(self, fp)
+
+    def __touch(self, ref, blob=None, size=None):
+        if self.disk_index is None:
+            return
+        if blob is not None:
+            tree = blob.startswith(TREE_PREFIXES)
+            size = len(blob)
+        else:
+            tree = False
+        self.disk_index.touch(ref, size, tree)
+
+    def __memory_tier(self, blob):
+        if blob.startswith(TREE_PREFIXES):
+            return self.tree_blobs
+        return self.file_blobs
+
+    def __memory_get(self, ref):
+        for tier in [self.tree_blobs, self.file_blobs]:
+            if ref in tier:
+                blob = tier.get(ref)
+                if blob is not None:
+                    return blob
+        return None
+
+    def __memory_set(self, ref, blob, miss=False):
+        if len(blob) > MEMORY_BLOB_MAX:
+            return
+        tier = self.__memory_tier(blob)
+        if miss:
+            tier.misses += 1
+        tier.set(ref, blob, len(blob))
+
+    def cache_stats(self):
+        """Return the hits, misses, size in bytes and number of blobs of
+        each in-process tier.
+        """
+        return dict((name, dict(hits=tier.hits, misses=tier.misses,
+                                bytes=tier.size, blobs=len(tier)))
+                    for name, tier in [('tree', self.tree_blobs),
+                                       ('file', self.file_blobs)])
+
     def get_blob(self, ref, size=-1, offset=0):
-        blob = self.memcache_get_blob(ref)
+        blob = self.__memory_get(ref)
         if blob is None:
-            # Don't pass size or offset to superclass. We want the whole blob
-            # so we can store it in memory.
-            blob = super(BlobCache, self).get_blob(ref)
-        if blob is not None:
-            self.memcache_set_blob(ref, blob)
-            if offset > 0:
-                blob = blob[offset:]
-            if size > -1:
-                blob = blob[:size]
+            metrics.incr('cache.memory.miss')
+            blob = self.memcache_get_blob(ref)
+            if blob is None:
+                disk_size = super(BlobCache, self).get_size(ref)
+                if disk_size is None:
+                    metrics.incr('cache.disk.miss')
+                    return None
+                metrics.incr('cache.disk.hit')
+                if disk_size > MEMORY_BLOB_MAX:
+                    self.__touch(ref, size=disk_size)
+                    with metrics.timer('cache.disk.get'):
+                        return super(BlobCache, self).get_blob(
+                            ref, size=size, offset=offset)
+                with metrics.timer('cache.disk.get'):
+                    blob = super(BlobCache, self).get_blob(ref)
+                if blob is None:
+                    return None
+                self.memcache_set_blob(ref, blob)
+            self.__memory_set(ref, blob, miss=True)
+        else:
+            metrics.incr('cache.memory.hit')
+        self.__touch(ref, blob)
+        if offset > 0:
+            blob = blob[offset:]
+        if size > -1:
+            blob = blob[:size]
         return blob
 
     def get_size(self, ref):
+        blob = self.__memory_get(ref)
+        if blob is not None:
+            return len(blob)
+        size = self.sizes.get(ref)
+        if size is not None:
+            return size
         size = self.memcache_get_size(ref)
         if size is not None:
             return size
         size = super(BlobCache, self).get_size(ref)
-        self.memcache_set_size(ref, size)
+        self.set_size(ref, size)
         return size
 
     def put_blob(self, blob):
         ref = super(BlobCache, self).put_blob(blob)
+        self.__touch(ref, blob)
+        self.__memory_set(ref, blob)
         self.memcache_set_blob(ref, blob)
         return ref
 
+    def put_blob_stream(self, fp):
+        ref = super(BlobCache, self).put_blob_stream(fp)
+        self.__touch(ref, size=super(BlobCache, self).get_size(ref))
+        return ref
+
     def set_size(self, ref, size):
+        if size is not None:
+            self.sizes.set(ref, size, 1)
         self.memcache_set_size(ref, size)
 
     def memcache_get_blob(self, ref):
@@ -74,7 +513,8 @@ class BlobCache(local.LocalBlobStore):
         return self.__memcache_get('size', ref)
 
     def memcache_set_blob(self, ref, blob):
-        self.__memcache_set('blob', ref, blob)
+        if len(blob) <= MEMCACHE_VALUE_MAX:
+            self.__memcache_set('blob', ref, blob)
         self.__memcache_set('size', ref, len(blob))
 
     def memcache_set_size(self, ref, size):
@@ -1,90 +1,343 @@
+import Queue
+import atexit
 import hashlib
 import hmac
 import httplib
+import json
+import os
 import socket
 import ssl
 import sys
+import tempfile
+import threading
 import time
+import urllib
 import urlparse
 import wsgiref.handlers
 
 from . import cache
+from . import compression
+from . import history
+from . import links
+from . import local
 from . import server
+from .. import lru
+from .. import metrics
+
+# Limits on the number of refs and the number of blob bytes sent in a single
+# batch request.
+BATCH_SIZE = 64
+BATCH_BYTES = 8 * 1024 * 1024
+
+POOL_SIZE = 4
+RETRIES = 3
+RETRY_DELAY = 0.1 # seconds; doubled after every failed attempt
+
+# Refs the server was seen to have aren't checked for again for KNOWN_TTL
+# seconds. Checking a blob touches it, which protects it from both btfu gc
+# and btfu repack --gc for the server's grace period (gc-grace), so this must
+# be shorter than that.
+KNOWN_TTL = 60 * 60
+KNOWN_ENTRIES = 64 * 1024
+
+
+def batches(items, size=BATCH_SIZE):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+class HTTPConnection(httplib.HTTPConnection):
+    """Sends every write at once. A request body is written after its
+    headers, and Nagle's algorithm would hold it back until the server
+    acknowledged them, which it may delay by up to 40ms.
+    """
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class HTTPSConnection(httplib.HTTPSConnection):
+
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class ConnectionPool(object):
+    """A bounded pool of persistent HTTP connections to a single server that
+    can be shared between threads.
+    """
+
+    def __init__(self, url, size=POOL_SIZE):
+        self.url = urlparse.urlparse(url)
+        if self.url.scheme not in ['http', 'https']:
+            raise ValueError('invalid URL scheme: %r' % self.url.scheme)
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def new_connection(self):
+        if self.url.scheme == 'http':
+            return HTTPConnection(self.url.hostname, self.url.port)
+        try:
+            return HTTPSConnection(
+                self.url.hostname, self.url.port,
+                context=ssl.SSLContext(ssl.PROTOCOL_TLSv1_2))
+        except AttributeError:
+            return HTTPSConnection(self.url.hostname, self.url.port)
+
+    def acquire(self):
+        """Block until a connection is available and return it."""
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            return self.new_connection()
+
+    def release(self, connection, reuse=True):
+        """Return ``connection`` to the pool, or close it if it can't be
+        reused.
+        """
+        if reuse:
+            self.idle.put(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+
+class KnownRefs(object):
+    """Remembers the ``max_entries`` refs most recently seen on a server,
+    and when, so that they aren't checked for while they're younger than
+    ``ttl`` seconds. They're kept in a log of ``ref time`` lines at
+    ``path``, so the next process to talk to the server starts with them.
+    """
+
+    def __init__(self, path, ttl=KNOWN_TTL, max_entries=KNOWN_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.refs = lru.LRUCache(max_entries)
+        self.lines = 0
+        self.pending = []
+        self.lock = threading.Lock()
+        if ttl > 0 and os.path.exists(path):
+            self.__load()
+        atexit.register(self.flush)
+
+    def __load(self):
+        deadline = time.time() - self.ttl
+        with open(self.path, 'rb') as fp:
+            for line in fp:
+                self.lines += 1
+                try:
+                    ref, seen = line.split()
+                    seen = int(seen)
+                except ValueError:
+                    continue # torn by a crash mid-write
+                if seen > deadline:
+                    self.refs.set(ref, seen, 1)
+
+    def __contains__(self, ref):
+        seen = self.refs.get(ref)
+        return seen is not None and seen > time.time() - self.ttl
+
+    def add(self, refs):
+        """Record that the server has each of ``refs`` now."""
+        if self.ttl <= 0:
+            return
+        now = int(time.time())
+        with self.lock:
+            for ref in refs:
+                self.refs.set(ref, now, 1)
+                self.pending.append('%s %d\n' % (ref, now))
+            flush = len(self.pending) >= cache.INDEX_FLUSH_LINES
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Append the refs recorded so far to the log, or rewrite it without
+        the stale ones if it has grown too long.
+        """
+        with self.lock:
+            lines, self.pending = self.pending, []
+            self.lines += len(lines)
+            compact = self.lines > max(cache.COMPACT_RATIO * len(self.refs),
+                                       cache.COMPACT_MIN_LINES)
+            if compact:
+                deadline = time.time() - self.ttl
+                lines = ['%s %d\n' % (ref, seen)
+                         for ref, seen in self.refs.snapshot()
+                         if seen > deadline]
+                self.lines = len(lines)
+            try:
+                if compact:
+                    fd, tmp_path = tempfile.mkstemp(
+                        dir=os.path.dirname(self.path), prefix='.tmp-known-')
+                    with os.fdopen(fd, 'wb') as fp:
+                        fp.write(''.join(lines))
+                    os.rename(tmp_path, self.path)
+                elif lines:
+                    with open(self.path, 'ab') as fp:
+                        fp.write(''.join(lines))
+            except (IOError, OSError), e:
+                print >>sys.stderr, 'WARNING: %s: %s' % (self.path, e)
 
 
 class BlobClient(cache.BlobCache):
 
     def __init__(self, baseurl, auth_token=None, cache_path=None,
-                 memcache_url=None):
-        super(BlobClient, self).__init__(cache_path, memcache_url=memcache_url)
+                 memcache_url=None, pool_size=POOL_SIZE,
+                 tree_blob_bytes=cache.TREE_BLOB_BYTES,
+                 file_blob_bytes=cache.FILE_BLOB_BYTES,
+                 disk_bytes=cache.DISK_BYTES, compress=False,
+                 known_ttl=KNOWN_TTL):
+        super(BlobClient, self).__init__(cache_path, memcache_url=memcache_url,
+                                         tree_blob_bytes=tree_blob_bytes,
+                                         file_blob_bytes=file_blob_bytes,
+                                         disk_bytes=disk_bytes,
+                                         compress=compress)
         self.baseurl = baseurl
         self.auth_token = auth_token
-        url = urlparse.urlparse(baseurl)
-        if url.scheme == 'http':
-            self.connection = httplib.HTTPConnection(url.hostname, url.port)
-        elif url.scheme == 'https':
-            try:
-                self.connection = httplib.HTTPSConnection(
-                    url.hostname, url.port,
-                    context=ssl.SSLContext(ssl.PROTOCOL_TLSv1_2))
-            except AttributeError:
-                self.connection = httplib.HTTPSConnection(
-                    url.hostname, url.port)
-        else:
-            raise ValueError('invalid URL scheme: %r' % url.scheme)
-
-    def __request(self, method, path, data=None):
-        self.connection.putrequest(method, path)
-        if data is not None:
-            self.connection.putheader('Content-Length', str(len(data)))
-            self.connection.putheader('Content-Type',
-                                      'application/octet-stream')
+        self.pool = ConnectionPool(baseurl, pool_size)
+        self.known = KnownRefs(os.path.join(
+            self.store_path, 'known-%s' % hashlib.sha1(baseurl).hexdigest()),
+            ttl=known_ttl)
+        # Request bodies are compressed once the server has said, in the
+        # Accept-Encoding header of a response, that it can decode them.
+        self.upload_encoding = None
+
+    def __send(self, connection, method, path, data=None, headers=None):
+        connection.putrequest(method, path)
+        for key, value in (headers or {}).iteritems():
+            connection.putheader(key, value)
+        if hasattr(data, 'read'):
+            # the caller sets Content-Length or Transfer-Encoding
+            connection.putheader('Content-Type', 'application/octet-stream')
+        elif data is not None:
+            connection.putheader('Content-Length', str(len(data)))
+            connection.putheader('Content-Type', 'application/octet-stream')
         else:
-            self.connection.putheader('Content-Length', '0')
+            connection.putheader('Content-Length', '0')
+        if method != 'HEAD':
+            connection.putheader('Accept-Encoding',
+                                 ', '.join(compression.ENCODINGS))
         date = wsgiref.handlers.format_date_time(time.time())
-        self.connection.putheader('Date', date)
+        connection.putheader('Date', date)
         if self.auth_token:
             signature = hmac.new(self.auth_token, digestmod=hashlib.sha1)
             signature.update(method)
             signature.update(path)
             signature.update(date)
-            self.connection.putheader('Authorization', signature.hexdigest())
-        try:
-            self.connection.endheaders()
-        except socket.error, e:
-            print >>sys.stderr, 'FATAL: %s: %s' % (self.baseurl, e)
-            exit(e[0])
-        if data is not None:
-            self.connection.send(data)
-        response = self.connection.getresponse()
+            connection.putheader('Authorization', signature.hexdigest())
+        connection.endheaders()
+        if hasattr(data, 'read'):
+            chunked = 'Transfer-Encoding' in (headers or {})
+            for chunk in iter(lambda: data.read(local.BUFFER_SIZE), ''):
+                metrics.incr('client.bytes_sent', len(chunk))
+                if chunked:
+                    chunk = '%x\r\n%s\r\n' % (len(chunk), chunk)
+                connection.send(chunk)
+            if chunked:
+                connection.send('0\r\n\r\n')
+        elif data is not None:
+            metrics.incr('client.bytes_sent', len(data))
+            connection.send(data)
+        response = connection.getresponse()
+        content = response.read()
+        metrics.incr('client.bytes_received', len(content))
+        self.upload_encoding = compression.accepted(
+            response.getheader('Accept-Encoding'))
+        return response, compression.decompress(
+            content, response.getheader('Content-Encoding'))
+
+    def __request(self, method, path, data=None, headers=None):
+        """Send a request over a pooled connection and return the response
+        and its content. Requests that are safe to repeat (everything except
+        creating a new link) are retried on a fresh connection if the
+        connection fails.
+        """
+        retries = RETRIES
+        if method == 'POST' and path == server.LINKS_PATH:
+            retries = 0
+        encoding = self.upload_encoding
+        if (isinstance(data, str) and encoding is not None and
+                'Content-Encoding' not in (headers or {})):
+            compressed = compression.compress(data, encoding)
+            if compressed is not None:
+                response, content = self.__request(
+                    method, path, compressed,
+                    dict(headers or {}, **{'Content-Encoding': encoding}))
+                if response.status != httplib.UNSUPPORTED_MEDIA_TYPE:
+                    return response, content
+                self.upload_encoding = None
+        start = data.tell() if hasattr(data, 'read') else None
+        name = 'client.' + server.route_name(method, path)
+        for attempt in xrange(retries + 1):
+            if start is not None:
+                data.seek(start)
+            connection = self.pool.acquire()
+            try:
+                with metrics.timer(name):
+                    response, content = self.__send(connection, method,
+                                                    path, data, headers)
+            except (socket.error, httplib.HTTPException), e:
+                self.pool.release(connection, reuse=False)
+                if attempt == retries:
+                    raise
+                metrics.incr('client.retries')
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+                continue
+            header = response.getheader('Connection')
+            self.pool.release(connection,
+                              reuse=not (header and header.lower() == 'close'))
+            break
         if response.status == httplib.FORBIDDEN:
             print >>sys.stderr, 'ERROR: Authorization failed.'
         elif response.status == httplib.INTERNAL_SERVER_ERROR:
             print >>sys.stderr, 'WARNING: Internal server error.'
-        connection = response.getheader('Connection')
-        if connection and connection.lower() == 'close':
-            print >>sys.stderr, 'FATAL: Server closed the connection.'
-            exit(response.status)
-        return response
+        return response, content
 
     def __get_blob_request(self, ref):
-        response = self.__request('GET', server.BLOBS_PATH + ref)
-        content = response.read()
+        response, content = self.__request('GET', server.BLOBS_PATH + ref)
         if response.status == httplib.OK:
             return content
         return None
 
+    def __get_range_request(self, ref, size=-1, offset=0):
+        # Fetch whole blocks around the requested range so that neighbouring
+        # reads can be served from the partial blob cache.
+        start = offset - offset % cache.PARTIAL_BLOCK_SIZE
+        if size < 0:
+            byte_range = 'bytes=%d-' % start
+        else:
+            end = offset + size
+            end += -end % cache.PARTIAL_BLOCK_SIZE
+            byte_range = 'bytes=%d-%d' % (start, end - 1)
+        response, content = self.__request('GET', server.BLOBS_PATH + ref,
+                                           headers={'Range': byte_range})
+        if response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+            return ''
+        elif response.status == httplib.OK:
+            start = 0
+            self.put_partial_blob(ref, start, content, len(content))
+        elif response.status == httplib.PARTIAL_CONTENT:
+            total = int(response.getheader('Content-Range').rsplit('/', 1)[1])
+            self.put_partial_blob(ref, start, content, total)
+        else:
+            return None
+        content = content[offset - start:]
+        if size > -1:
+            content = content[:size]
+        return content
+
     def __get_size_request(self, ref):
-        response = self.__request('HEAD', server.BLOBS_PATH + ref)
+        response, content = self.__request('HEAD', server.BLOBS_PATH + ref)
         size = int(response.getheader('Content-Length'))
-        content = response.read()
         if response.status == httplib.OK:
             return size
         return None
 
     def __has_blob_request(self, ref):
-        response = self.__request('HEAD', server.BLOBS_PATH + ref)
-        content = response.read()
+        response, content = self.__request('HEAD', server.BLOBS_PATH + ref)
         if response.status == httplib.OK:
             return True
         elif response.status == httplib.NOT_FOUND:
@@ -92,33 +345,134 @@ class BlobClient(cache.BlobCache):
         return None
 
     def __put_blob_request(self, blob):
-        response = self.__request('POST', server.BLOBS_PATH, blob)
-        content = response.read()
+        response, content = self.__request('POST', server.BLOBS_PATH, blob)
         if response.status == httplib.OK:
             return content
         return None
 
+    def __put_blob_stream_request(self, fp, size, chunked=False):
+        if chunked:
+            headers = {'Transfer-Encoding': 'chunked'}
+        else:
+            headers = {'Content-Length': str(size)}
+        response, content = self.__request('POST', server.BLOBS_PATH, fp,
+                                           headers)
+        if response.status == httplib.OK:
+            return content
+        return None
+
+    def __get_blobs_request(self, refs):
+        response, content = self.__request('POST', server.BATCH_GET_PATH,
+                                           '\n'.join(refs))
+        if response.status == httplib.OK:
+            return dict(server.unpack_blobs(content))
+        return None
+
+    def __missing_blobs_request(self, refs):
+        response, content = self.__request('POST', server.BATCH_HAS_PATH,
+                                           '\n'.join(refs))
+        if response.status == httplib.OK:
+            return set(content.split())
+        return None
+
+    def __put_blobs_request(self, blobs):
+        body = server.pack_blobs((self.blobref(blob), blob) for blob in blobs)
+        response, content = self.__request('POST', server.BATCH_PUT_PATH,
+                                           body)
+        if response.status == httplib.OK:
+            return content.split('\n')
+        return None
+
+    def __put_pending_blobs(self, blobs):
+        refs = self.__put_blobs_request(blobs)
+        if refs is None:
+            return map(self.blobref, blobs)
+        self.known.add(refs)
+        for blob in blobs:
+            super(BlobClient, self).put_blob(blob)
+        return []
+
+    def __has_known_blob(self, ref):
+        if ref in self.known:
+            metrics.incr('client.known.hit')
+            return True
+        if self.__has_blob_request(ref):
+            self.known.add([ref])
+            return True
+        return False
+
     def get_blob(self, ref, size=-1, offset=0):
         blob = super(BlobClient, self).get_blob(ref, size=size, offset=offset)
-        if blob is None:
-            blob = self.__get_blob_request(ref)
+        if blob is not None:
+            return blob
+        if size > -1 or offset > 0:
+            blob = self.get_partial_blob(ref, size=size, offset=offset)
+            if blob is None:
+                blob = self.__get_range_request(ref, size=size, offset=offset)
+            return blob
+        blob = self.__get_blob_request(ref)
         if blob is not None:
             super(BlobClient, self).put_blob(blob)
-            if offset > 0:
-                blob = blob[offset:]
-            if size > -1:
-                blob = blob[:size]
         return blob
 
+    def get_blobs(self, refs):
+        """Return a dict mapping each of ``refs`` to its blob, or ``None`` if
+        it doesn't exist. Blobs that aren't cached are fetched in batches.
+        """
+        blobs = {}
+        missing = []
+        for ref in refs:
+            if ref in blobs:
+                continue
+            blob = super(BlobClient, self).get_blob(ref)
+            blobs[ref] = blob
+            if blob is None:
+                missing.append(ref)
+        for batch in batches(missing):
+            fetched = self.__get_blobs_request(batch) or {}
+            for ref in batch:
+                blob = blobs[ref] = fetched.get(ref)
+                if blob is not None:
+                    super(BlobClient, self).put_blob(blob)
+        return blobs
+
+    def get_history(self, link, limit=history.PAGE_SIZE, before=None,
+                    until=None):
+        """Return up to ``limit`` refs and creation times of the roots behind
+        ``link``, newest first, as ``HistoryIndex.page`` does, or ``None`` if
+        the server can't serve its history.
+        """
+        params = [('limit', limit)]
+        if before is not None:
+            params.append(('before', before))
+        if until is not None:
+            params.append(('until', repr(float(until))))
+        query = urllib.urlencode(params)
+        response, content = self.__request(
+            'GET', '%s%s?%s' % (server.HISTORY_PATH, link, query))
+        if response.status == httplib.OK:
+            return history.parse_page(content)
+        elif response.status == httplib.NOT_FOUND:
+            return []
+        return None
+
     def get_link(self, link):
         if link is None:
             link = ''
-        response = self.__request('GET', server.LINKS_PATH + link)
-        content = response.read()
+        response, content = self.__request('GET', server.LINKS_PATH + link)
         if response.status == httplib.OK:
             return content
         return None
 
+    def list_links(self, prefix='', after='', limit=links.PAGE_SIZE):
+        query = urllib.urlencode([('prefix', prefix), ('after', after),
+                                  ('limit', limit)])
+        response, content = self.__request(
+            'GET', '%s?%s' % (server.LINKS_PATH, query))
+        if response.status == httplib.OK:
+            return content.split('\n') if content else []
+        return None
+
     def get_size(self, ref):
         size = super(BlobClient, self).get_size(ref)
         if size is not None:
@@ -128,23 +482,111 @@ class BlobClient(cache.BlobCache):
             super(BlobClient, self).set_size(ref, size)
         return size
 
+    def get_stats(self):
+        """Return the server's metrics as ``metrics.Registry.snapshot``
+        does, or ``None`` if it doesn't serve them.
+        """
+        response, content = self.__request('GET', server.STATS_PATH)
+        if response.status == httplib.OK:
+            return json.loads(content)
+        return None
+
+    def has_blobs(self, refs):
+        """Return a dict mapping each of ``refs`` to ``True`` if the server
+        has it, ``False`` if it doesn't and ``None`` if the request failed.
+        Refs the server was seen to have recently aren't asked about.
+        """
+        has = {}
+        unknown = []
+        for ref in refs:
+            if ref in self.known:
+                has[ref] = True
+            else:
+                unknown.append(ref)
+        metrics.incr('client.known.hit', len(refs) - len(unknown))
+        for batch in batches(unknown):
+            missing = self.__missing_blobs_request(batch)
+            for ref in batch:
+                has[ref] = None if missing is None else ref not in missing
+            if missing is not None:
+                self.known.add(ref for ref in batch if ref not in missing)
+        return has
+
     def put_blob(self, blob):
         ref = self.blobref(blob)
-        if self.__has_blob_request(ref):
+        if self.__has_known_blob(ref):
             return ref
         ref = self.__put_blob_request(blob)
         if ref is not None:
+            self.known.add([ref])
             super(BlobClient, self).put_blob(blob)
         return ref
 
-    def set_link(self, link, ref):
+    def put_blob_stream(self, fp, chunked=False):
+        """Store the content of the seekable file object ``fp`` without
+        reading it into memory and return its ref. It's read once to hash it,
+        so that nothing is sent if the server already has it, and once more
+        to send it, optionally with chunked transfer encoding.
+        """
+        start = fp.tell()
+        digest = hashlib.sha1()
+        for data in iter(lambda: fp.read(local.BUFFER_SIZE), ''):
+            digest.update(data)
+        ref = 'sha1-%s' % digest.hexdigest()
+        if self.__has_known_blob(ref):
+            return ref
+        size = fp.tell() - start
+        fp.seek(start)
+        ref = self.__put_blob_stream_request(fp, size, chunked)
+        if ref is not None:
+            self.known.add([ref])
+            fp.seek(start)
+            super(BlobClient, self).put_blob_stream(fp)
+        return ref
+
+    def put_blobs(self, blobs):
+        """Store each of ``blobs`` and return a list of their refs. Only the
+        blobs the server is missing are uploaded, in batches of at most
+        ``BATCH_BYTES``.
+        """
+        refs = map(self.blobref, blobs)
+        has = self.has_blobs(list(set(refs)))
+        pending = []
+        pending_size = 0
+        failed = set()
+        for ref, blob in zip(refs, blobs):
+            if has[ref]:
+                continue
+            has[ref] = True
+            pending.append(blob)
+            pending_size += len(blob)
+            if pending_size >= BATCH_BYTES:
+                failed.update(self.__put_pending_blobs(pending))
+                pending = []
+                pending_size = 0
+        if pending:
+            failed.update(self.__put_pending_blobs(pending))
+        return [None if ref in failed else ref for ref in refs]
+
+    def set_link(self, link, ref, expected=None):
         if link is None:
             link = ''
+        headers = {}
+        if expected:
+            headers['If-Match'] = '"%s"' % expected
+        elif expected is not None:
+            headers['If-None-Match'] = '*'
         if ref:
-            response = self.__request('PUT', server.LINKS_PATH + link, ref)
+            response, content = self.__request('PUT', server.LINKS_PATH + link,
+                                               ref, headers)
         else:
-            response = self.__request('DELETE', server.LINKS_PATH + link)
-        content = response.read()
+            response, content = self.__request(
+                'DELETE', server.LINKS_PATH + link, headers=headers)
         if response.status == httplib.OK:
             return content
+        elif (response.status == httplib.PRECONDITION_FAILED and link and
+              self.get_link(link) == (ref or None)):
+            # A retried request may have succeeded the first time. Refs
+            # name their content, so the link is where it was meant to be.
+            return link
         return None
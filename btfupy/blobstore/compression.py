@@ -0,0 +1,166 @@
+import cStringIO
+import zlib
+
+# Codecs are named after HTTP content codings, and the same names are used
+# on disk. HTTP's "deflate" is the zlib format.
+DEFLATE = 'deflate'
+IDENTITY = 'identity'
+LEVEL = 6
+MIN_SIZE = 256 # smaller blobs aren't worth compressing
+# Compressed blobs are only kept if they're at most this fraction of their
+# original size.
+MAX_RATIO = 0.9
+# Blobs bigger than this are never compressed on the fly by the server.
+MAX_SIZE = 4 * 1024 * 1024
+BUFFER_SIZE = 64 * 1024 # streamed content is read in these
+# Request bodies that are read into memory are decoded to at most this.
+MAX_DECODED_SIZE = 64 * 1024 * 1024
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+class CorruptContent(ValueError):
+    """Raised for content that is malformed, truncated or decodes to more
+    than it's allowed to.
+    """
+
+
+class Codec(object):
+
+    def __init__(self, name, compress, decompress, decompressor):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.decompressor = decompressor
+
+
+CODECS = {}
+ENCODINGS = [] # in order of preference
+
+
+def register(codec):
+    CODECS[codec.name] = codec
+    ENCODINGS.append(codec.name)
+
+register(Codec(DEFLATE, lambda data: zlib.compress(data, LEVEL),
+               zlib.decompress, zlib.decompressobj))
+
+
+def get_codec(encoding):
+    codec = CODECS.get(encoding)
+    if codec is None:
+        raise UnsupportedEncoding('unsupported encoding: %r' % encoding)
+    return codec
+
+
+def supported(encoding):
+    return not encoding or encoding == IDENTITY or encoding in CODECS
+
+
+def compress(data, encoding=DEFLATE):
+    """Return ``data`` compressed with ``encoding``, or ``None`` if it's too
+    small to bother with or doesn't compress well enough.
+    """
+    if len(data) < MIN_SIZE:
+        return None
+    compressed = get_codec(encoding).compress(data)
+    if len(compressed) > len(data) * MAX_RATIO:
+        return None
+    return compressed
+
+
+def decompress(data, encoding, max_size=None):
+    """Return ``data`` decoded from ``encoding``. Raise ``CorruptContent`` if
+    it's malformed or truncated, or decodes to more than ``max_size`` bytes.
+    """
+    if not encoding or encoding == IDENTITY:
+        return data
+    if max_size is not None:
+        return DecodingReader(cStringIO.StringIO(data), encoding,
+                              max_size).read()
+    try:
+        return get_codec(encoding).decompress(data)
+    except zlib.error, e:
+        raise CorruptContent(str(e))
+
+
+def accepted(header):
+    """Return the preferred encoding listed in the value of an
+    ``Accept-Encoding`` header, or ``None``.
+    """
+    listed = set()
+    for item in (header or '').split(','):
+        params = item.strip().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > 0:
+            listed.add(params[0].strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in listed:
+            return encoding
+    return None
+
+
+class DecodingReader(object):
+    """Decompresses the content of the file object ``fp`` as it's read, at
+    most ``BUFFER_SIZE`` bytes of output at a time. Raises
+    ``CorruptContent`` if the content is malformed or truncated, or decodes
+    to more than ``max_size`` bytes.
+    """
+
+    def __init__(self, fp, encoding, max_size=None):
+        self.fp = fp
+        self.decompressor = get_codec(encoding).decompressor()
+        self.max_size = max_size
+        self.decoded = 0
+        self.buffer = ''
+        self.eof = False
+
+    def __decode(self):
+        data = self.decompressor.unconsumed_tail or self.fp.read(BUFFER_SIZE)
+        if data:
+            return self.decompressor.decompress(data, BUFFER_SIZE)
+        # A stream that has ended leaves any further input unused.
+        probe = self.decompressor.copy()
+        probe.decompress('\0')
+        if not probe.unused_data:
+            raise CorruptContent('truncated content')
+        self.eof = True
+        return self.decompressor.flush()
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while not self.eof and (size < 0 or length < size):
+            try:
+                data = self.__decode()
+            except zlib.error, e:
+                raise CorruptContent(str(e))
+            self.decoded += len(data)
+            if self.max_size is not None and self.decoded > self.max_size:
+                raise CorruptContent('content decodes to more than %d bytes' %
+                                     self.max_size)
+            parts.append(data)
+            length += len(data)
+        self.buffer = ''.join(parts)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def decoding_reader(fp, encoding, max_size=None):
+    """Return a file object that reads the content of ``fp`` decoded from
+    ``encoding``, which may decode to at most ``max_size`` bytes.
+    """
+    if not encoding or encoding == IDENTITY:
+        return fp
+    return DecodingReader(fp, encoding, max_size)
@@ -0,0 +1,86 @@
+import sys
+import threading
+
+from .. import bloom
+from .. import metrics
+
+ERROR_RATE = 0.01 # fraction of missing blobs that are looked for on disk
+HEADROOM = 2 # the filter has room for this many times the stored blobs
+MIN_CAPACITY = 64 * 1024
+
+
+class ExistenceFilter(object):
+    """Tells, without touching the disk, that ``store`` doesn't have a blob.
+
+    A Bloom filter of every ref in the store is built in a background thread
+    and refs are added to it as blobs are put, so a ref that isn't in it is
+    certainly missing. Blobs put while it's being built are added once it's
+    done, and until then every ref might be present. When more refs than it
+    has room for have been added it's rebuilt twice as big. Deleted blobs
+    stay in it until then, which only costs a look on disk.
+    """
+
+    def __init__(self, store, error_rate=ERROR_RATE, log=sys.stderr):
+        self.store = store
+        self.error_rate = error_rate
+        self.log = log
+        self.lock = threading.Lock()
+        self.filter = None
+        self.capacity = 0
+        self.pending = None # refs put while building, or None if idle
+
+    def __report(self, message):
+        if self.log is not None:
+            print >>self.log, 'existence: %s' % message
+
+    def start(self):
+        """Build the filter in a background thread, unless it's already
+        being built.
+        """
+        with self.lock:
+            if self.pending is not None:
+                return None
+            self.pending = []
+        thread = threading.Thread(target=self.__build)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __build(self):
+        try:
+            capacity = max(self.store.count_blobs() * HEADROOM,
+                           self.capacity * 2, MIN_CAPACITY)
+            refs = bloom.BloomFilter(capacity, self.error_rate)
+            for ref in self.store.iter_refs():
+                refs.add(ref)
+        except Exception, e:
+            with self.lock:
+                self.pending = None
+            self.__report('failed: %s' % e)
+            return
+        with self.lock:
+            for ref in self.pending:
+                refs.add(ref)
+            self.pending = None
+            self.filter = refs
+            self.capacity = capacity
+        self.__report('indexed %d blobs' % len(refs))
+
+    def add(self, ref):
+        full = False
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(ref)
+            if self.filter is not None:
+                self.filter.add(ref)
+                full = len(self.filter) > self.capacity
+        if full:
+            self.start()
+
+    def might_have(self, ref):
+        """Return ``False`` if the store certainly doesn't have ``ref``."""
+        refs = self.filter
+        if refs is None or ref in refs:
+            return True
+        metrics.incr('server.existence.filtered')
+        return False
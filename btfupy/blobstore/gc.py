@@ -0,0 +1,148 @@
+import binascii
+import os
+import sys
+import threading
+import time
+
+from .. import bloom
+
+GRACE_PERIOD = 24 * 60 * 60 # blobs younger than this are never swept
+ERROR_RATE = 0.001 # fraction of garbage the mark set lets through
+SWEEP_BATCH = 1000 # blobs swept between pauses
+
+# The first word of every line of a root, tree or chunk index that refers to
+# another blob, as written by ``treestore``, and whether the blob it refers
+# to may refer to others in turn.
+REF_KEYS = {
+    'root': True,
+    'tree': True,
+    'chunks': True,
+    'blob': False,
+    'chunk': False,
+}
+
+
+def parse_refs(blob):
+    """Generate the refs in the root, tree or chunk index ``blob`` and
+    whether each of them refers to further blobs.
+    """
+    for line in blob.splitlines():
+        words = line.split(' ', 2)
+        if (len(words) > 1 and words[0] in REF_KEYS and
+                words[1].startswith('sha1-')):
+            yield words[1], REF_KEYS[words[0]]
+
+
+class GarbageCollector(object):
+    """Deletes the blobs of ``store`` that can't be reached from any link.
+
+    Marking walks from every link through root chains, trees and chunk
+    indexes. Reachable refs are added to a Bloom filter sized for the number
+    of blobs in the store, so memory use stays bounded. A false positive
+    only means that a piece of garbage survives until the next collection.
+    Blobs that refer to others are also remembered exactly, so they're never
+    mistaken for visited and skipped.
+
+    Sweeping walks the loose blobs in batches of ``SWEEP_BATCH``, pausing
+    ``pause`` seconds between batches, and only deletes blobs last written
+    or touched more than ``grace`` seconds ago. The store touches blobs that
+    are put again or checked for, so it's safe to collect while writers
+    upload blobs and set links to them, as long as no other process is
+    writing to ``store`` through a separate ``PackBlobStore``: a process
+    other than the server must open packs read-only. Packed blobs aren't
+    swept; they're dropped by repacking with the mark set as the blobs to
+    keep and ``deadline()`` as the deadline, which needs the server to be
+    stopped.
+    """
+
+    def __init__(self, store, grace=GRACE_PERIOD, pause=0,
+                 error_rate=ERROR_RATE, log=sys.stderr):
+        self.store = store
+        self.grace = grace
+        self.pause = pause
+        self.error_rate = error_rate
+        self.log = log
+
+    def __report(self, message):
+        if self.log is not None:
+            print >>self.log, 'gc: %s' % message
+
+    def mark(self):
+        """Return a Bloom filter of the refs of every reachable blob."""
+        marked = bloom.BloomFilter(self.store.count_blobs(), self.error_rate)
+        expanded = set()
+        links = 0
+        stack = []
+        for link in self.store.iter_links():
+            links += 1
+            ref = self.store.get_link(link)
+            if ref:
+                stack.append(ref)
+        while stack:
+            ref = stack.pop()
+            marked.add(ref)
+            try:
+                raw = binascii.unhexlify(ref[len('sha1-'):])
+            except TypeError:
+                continue
+            if raw in expanded:
+                continue
+            expanded.add(raw)
+            blob = self.store.get_blob(ref)
+            if blob is None:
+                self.__report('missing blob %s' % ref)
+                continue
+            for child, structured in parse_refs(blob):
+                if structured:
+                    stack.append(child)
+                else:
+                    marked.add(child)
+        self.__report('marked %d blobs from %d links' % (len(marked), links))
+        return marked
+
+    def deadline(self):
+        """Return the time before which unmarked blobs may be deleted."""
+        return time.time() - self.grace
+
+    def sweep(self, marked, dry_run=False):
+        """Delete the loose blobs that aren't in ``marked`` and are older
+        than the grace period, and return how many blobs and bytes were
+        deleted.
+        """
+        deadline = self.deadline()
+        deleted = freed = 0
+        for i, (ref, path) in enumerate(self.store.iter_blobs()):
+            if i and not i % SWEEP_BATCH and self.pause:
+                time.sleep(self.pause)
+            if ref in marked:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_mtime > deadline:
+                continue
+            if dry_run or self.store.delete_blob(ref):
+                deleted += 1
+                freed += st.st_size
+        self.__report('%s %d blobs, %d bytes' %
+                      ('would delete' if dry_run else 'deleted', deleted,
+                       freed))
+        return deleted, freed
+
+    def run(self, dry_run=False):
+        return self.sweep(self.mark(), dry_run=dry_run)
+
+    def start(self, interval):
+        """Collect every ``interval`` seconds in a background thread."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.run()
+                except Exception, e:
+                    self.__report('failed: %s' % e)
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+        return thread
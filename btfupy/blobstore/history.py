@@ -0,0 +1,154 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# The keys of the parent and creation time lines of a root blob, as written
+# by ``treestore.RootAttr``.
+PARENT_KEY = 'root'
+CTIME_KEY = 'ctime'
+
+
+def parse_root(blob):
+    """Return the parent ref and creation time of the root blob ``blob``, or
+    ``None`` if it isn't one.
+    """
+    if blob is None:
+        return None
+    parent = ctime = None
+    for line in blob.splitlines():
+        key, _, value = line.partition(' ')
+        if key == PARENT_KEY:
+            parent = value
+        elif key == CTIME_KEY:
+            try:
+                ctime = float(value)
+            except ValueError:
+                return None
+    if ctime is None:
+        return None
+    return parent, ctime
+
+
+def format_page(entries):
+    return '\n'.join('%s %r' % (ref, ctime) for ref, ctime in entries)
+
+
+def parse_page(content):
+    entries = []
+    for line in content.splitlines():
+        ref, ctime = line.split()
+        entries.append((ref, float(ctime)))
+    return entries
+
+
+class HistoryIndex(object):
+    """Indexes the chain of roots behind every link of ``store`` so that a
+    page of a link's history can be read without fetching every root on the
+    way. The index of a link is a file of ``ref ctime`` lines under
+    ``path``, oldest first, named by the SHA-1 of the link so that any link
+    name is a safe file name. It's extended when the link is set to a child
+    of the root it pointed to; otherwise it's brought up to date the next
+    time it's read, by walking back from the link's root to the newest one
+    it already has.
+    """
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def __get_path(self, link):
+        return os.path.join(self.path, hashlib.sha1(link).hexdigest())
+
+    def __load(self, link):
+        entries = []
+        try:
+            with open(self.__get_path(link)) as fp:
+                for line in fp:
+                    try:
+                        ref, ctime = line.split()
+                        entries.append((ref, float(ctime)))
+                    except ValueError:
+                        continue # torn by a crash mid-write
+        except IOError:
+            pass
+        return entries
+
+    def __save(self, link, entries):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(format_page(entries))
+            if entries:
+                fp.write('\n')
+        os.rename(tmp_path, self.__get_path(link))
+
+    def update(self, link, ref):
+        """Record that ``link`` was set to ``ref``, or deleted if ``ref`` is
+        empty.
+        """
+        with self.lock:
+            if not ref:
+                try:
+                    os.remove(self.__get_path(link))
+                except OSError:
+                    pass
+                return
+            entries = self.__load(link)
+            if not entries:
+                return
+            root = parse_root(self.store.get_blob(ref))
+            if root is None or root[0] != entries[-1][0]:
+                return # rebuilt when it's next read
+            with open(self.__get_path(link), 'a') as fp:
+                fp.write('%s %r\n' % (ref, root[1]))
+
+    def entries(self, link):
+        """Return the refs and creation times of the roots behind ``link``,
+        oldest first, or ``None`` if there's no such link.
+        """
+        with self.lock:
+            ref = self.store.get_link(link)
+            if ref is None:
+                return None
+            entries = self.__load(link)
+            if entries and entries[-1][0] == ref:
+                return entries
+            known = dict((r, i) for i, (r, _) in enumerate(entries))
+            walked = []
+            seen = set()
+            while ref and ref not in known and ref not in seen:
+                seen.add(ref)
+                root = parse_root(self.store.get_blob(ref))
+                if root is None:
+                    break
+                walked.append((ref, root[1]))
+                ref = root[0]
+            entries = entries[:known[ref] + 1] if ref in known else []
+            entries.extend(reversed(walked))
+            self.__save(link, entries)
+            return entries
+
+    def page(self, link, limit=PAGE_SIZE, before=None, until=None):
+        """Return up to ``limit`` of the roots behind ``link``, newest first,
+        starting after the root ``before`` and from the newest one created
+        at or before the time ``until``, if given. Return ``None`` if
+        there's no such link.
+        """
+        entries = self.entries(link)
+        if entries is None:
+            return None
+        end = len(entries)
+        if before is not None:
+            refs = [ref for ref, _ in entries]
+            end = refs.index(before) if before in refs else 0
+        if until is not None:
+            while end and entries[end - 1][1] > until:
+                end -= 1
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+        return entries[max(end - limit, 0):end][::-1]
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+TIMEOUT = 30 # seconds to wait for another process's write to finish
+
+
+def prefix_end(prefix):
+    """Return the smallest string greater than every string that starts
+    with ``prefix``, or ``None`` if there's no such string.
+    """
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class LinkDB(object):
+    """Keeps links and the refs they point to in an sqlite database at
+    ``path``. Writes are transactions, so a crash never leaves a link half
+    written. Every write is a single statement that checks the link's
+    current value as well, so concurrent writers can swap a link safely.
+    Links are listed in order from the primary key index, a page at a time.
+
+    Links kept one file per link in the directory ``import_path`` by earlier
+    versions are imported the first time the database is opened, and the
+    directory is then renamed so they aren't imported again.
+    """
+
+    def __init__(self, path, import_path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=TIMEOUT,
+                                  check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS links ('
+                            'name TEXT PRIMARY KEY, ref TEXT NOT NULL)')
+        if import_path is not None and os.path.isdir(import_path):
+            self.__import(import_path)
+
+    def __import(self, path):
+        entries = []
+        for name in os.listdir(path):
+            try:
+                with open(os.path.join(path, name)) as fp:
+                    entries.append((name, fp.read()))
+            except IOError:
+                continue
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO links (name, ref) '
+                                    'VALUES (?, ?)', entries)
+        try:
+            os.rename(path, path + '.imported')
+        except OSError:
+            pass # another process got there first
+
+    def get(self, name):
+        with self.lock:
+            row = self.db.execute('SELECT ref FROM links WHERE name = ?',
+                                  (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def list(self, prefix='', after='', limit=PAGE_SIZE):
+        """Return up to ``limit`` of the names that start with ``prefix``
+        and sort after ``after``, in order.
+        """
+        query = 'SELECT name FROM links WHERE name >= ? AND name > ?'
+        params = [prefix, after]
+        end = prefix_end(prefix)
+        if end is not None:
+            query += ' AND name < ?'
+            params.append(end)
+        query += ' ORDER BY name LIMIT ?'
+        params.append(min(max(limit, 1), MAX_PAGE_SIZE))
+        with self.lock:
+            return [row[0] for row in self.db.execute(query, params)]
+
+    def set(self, name, ref, expected=None):
+        """Point ``name`` at ``ref``, or delete it if ``ref`` is empty, and
+        return ``True``. If ``expected`` isn't ``None``, only do it if the
+        link currently points at ``expected``, or doesn't exist if it's
+        empty, and return ``False`` otherwise. Deleting a link that doesn't
+        exist returns ``False`` too.
+        """
+        if not ref:
+            query = 'DELETE FROM links WHERE name = ?'
+            params = [name]
+            if expected:
+                query += ' AND ref = ?'
+                params.append(expected)
+            elif expected is not None:
+                return False
+        elif expected is None:
+            query = 'INSERT OR REPLACE INTO links (name, ref) VALUES (?, ?)'
+            params = [name, ref]
+        elif expected:
+            query = 'UPDATE links SET ref = ? WHERE name = ? AND ref = ?'
+            params = [ref, name, expected]
+        else:
+            query = 'INSERT OR IGNORE INTO links (name, ref) VALUES (?, ?)'
+            params = [name, ref]
+        with self.lock:
+            with self.db:
+                return self.db.execute(query, params).rowcount > 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
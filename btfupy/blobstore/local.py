@@ -3,20 +3,69 @@ import hashlib
 import os
 import stat
 import sys
+import tempfile
+import threading
 import uuid
 
 from . import abstract
+from . import compression
+from . import links
+
+BUFFER_SIZE = 64 * 1024 # streamed blobs are read and written in these
+# A compressed blob is stored next to where it would be stored raw, with
+# this suffix, and starts with an ``encoding size`` line.
+COMPRESSED_SUFFIX = '.z'
+
+
+class BlobFile(object):
+    """A read-only view of the ``size`` bytes of the open file ``fp`` that
+    start at ``offset``. Views made by ``range`` share the file but keep
+    their own positions.
+    """
+
+    def __init__(self, fp, offset, size):
+        self.fp = fp
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def range(self, start, length):
+        return BlobFile(self.fp, self.offset + start,
+                        max(min(length, self.size - start), 0))
+
+    def read(self, size=-1):
+        remaining = self.size - self.pos
+        if size < 0 or size > remaining:
+            size = remaining
+        self.fp.seek(self.offset + self.pos)
+        data = self.fp.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos):
+        self.pos = min(max(pos, 0), self.size)
+
+    def close(self):
+        self.fp.close()
 
 
 class LocalBlobStore(abstract.BlobStore):
+    """Stores one file per blob under ``path``. If ``compress`` is true,
+    blobs that compress well are stored compressed.
+    """
 
-    def __init__(self, path):
+    def __init__(self, path, compress=False):
+        self.compress = compress
         self.store_path = path
         self.blobs_path = os.path.join(self.store_path, 'blobs')
-        self.links_path = os.path.join(self.store_path, 'links')
-        for path in [self.store_path, self.blobs_path, self.links_path]:
+        for path in [self.store_path, self.blobs_path]:
             if not os.path.exists(path):
                 distutils.dir_util.mkpath(path)
+        self.link_db = None
+        self.link_db_lock = threading.Lock()
 
     def __get_blob_path(self, ref, split=False):
         try:
@@ -25,67 +74,206 @@ class LocalBlobStore(abstract.BlobStore):
             return None
         return os.path.join(self.blobs_path, a, b[0:2], b[2:4], b[4:])
 
-    def __get_link_path(self, link):
-        return os.path.join(self.links_path, link)
+    def __find_blob(self, ref):
+        """Return the path of the file holding the blob at ``ref`` and
+        whether it's compressed, or ``None`` and ``False``.
+        """
+        path = self.__get_blob_path(ref)
+        if path is None:
+            return None, False
+        if os.path.isfile(path):
+            return path, False
+        if os.path.isfile(path + COMPRESSED_SUFFIX):
+            return path + COMPRESSED_SUFFIX, True
+        return None, False
+
+    @staticmethod
+    def __read_compressed(path, header_only=False):
+        """Return the encoding, original size and compressed content of
+        the compressed blob file at ``path``.
+        """
+        with open(path, 'rb') as f:
+            encoding, size = f.readline().split()
+            return encoding, int(size), None if header_only else f.read()
+
+    def __get_link_db(self):
+        # Opened on first use, so that caches built on this class don't
+        # create a database they never use.
+        with self.link_db_lock:
+            if self.link_db is None:
+                self.link_db = links.LinkDB(
+                    os.path.join(self.store_path, 'links.db'),
+                    os.path.join(self.store_path, 'links'))
+            return self.link_db
 
     def blobref(self, blob):
         return 'sha1-%s' % hashlib.sha1(blob).hexdigest()
 
+    def count_blobs(self):
+        return sum(1 for _ in self.iter_blobs())
+
+    def delete_blob(self, ref):
+        """Remove the blob at ``ref`` and return ``True`` if it existed."""
+        path, _ = self.__find_blob(ref)
+        if path is None:
+            return False
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+    def flush(self):
+        """Make every blob put so far durable. Loose blobs are written
+        synchronously, so there's nothing to do.
+        """
+
     def get_blob(self, ref, size=-1, offset=0):
-        path = self.__get_blob_path(ref)
-        if path is None or not os.path.exists(path) or os.path.isdir(path):
+        path, compressed = self.__find_blob(ref)
+        if path is None:
             return None
         try:
+            if compressed:
+                encoding, _, data = self.__read_compressed(path)
+                blob = compression.decompress(data, encoding)[offset:]
+                return blob if size < 0 else blob[:size]
             with open(path, 'rb') as f:
                 f.seek(offset)
                 return f.read(size)
         except IOError:
             return None
 
-    def get_link(self, link):
-        if not link:
-            return '\n'.join(sorted(os.listdir(self.links_path)))
+    def get_encoded_blob(self, ref):
+        path, compressed = self.__find_blob(ref)
+        if not compressed:
+            return None
         try:
-            with open(self.__get_link_path(link)) as fp:
-                return fp.read()
+            encoding, _, data = self.__read_compressed(path)
         except IOError:
             return None
+        return encoding, data
+
+    def get_link(self, link):
+        if not link:
+            return '\n'.join(self.iter_links())
+        return self.__get_link_db().get(link)
 
     def get_size(self, ref):
-        path = self.__get_blob_path(ref)
-        if path is None or not os.path.exists(path) or os.path.isdir(path):
+        path, compressed = self.__find_blob(ref)
+        if path is None:
             return None
+        if compressed:
+            try:
+                return self.__read_compressed(path, header_only=True)[1]
+            except IOError:
+                return None
         return os.stat(path).st_size
 
     def has_blob(self, ref):
-        return os.path.isfile(self.__get_blob_path(ref))
+        return self.__find_blob(ref)[0] is not None
+
+    def iter_blobs(self):
+        """Generate the refs and paths of the blobs in the store."""
+        for dirpath, dirnames, filenames in os.walk(self.blobs_path):
+            parts = os.path.relpath(dirpath, self.blobs_path).split(os.sep)
+            if len(parts) != 3:
+                continue
+            for filename in filenames:
+                if filename.startswith('tmp'):
+                    continue # being written by put_blob
+                name = filename
+                if name.endswith(COMPRESSED_SUFFIX):
+                    name = name[:-len(COMPRESSED_SUFFIX)]
+                yield ('%s-%s%s%s' % (parts[0], parts[1], parts[2], name),
+                       os.path.join(dirpath, filename))
+
+    def list_links(self, prefix='', after='', limit=links.PAGE_SIZE):
+        return self.__get_link_db().list(prefix, after, limit)
+
+    def iter_refs(self):
+        """Generate the ref of every blob in the store."""
+        for ref, _ in self.iter_blobs():
+            yield ref
+
+    def open_blob(self, ref):
+        path = self.__get_blob_path(ref)
+        if path is None or os.path.isdir(path):
+            return None
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            return None
+        return BlobFile(fp, 0, os.fstat(fp.fileno()).st_size)
 
     def put_blob(self, blob):
         ref = self.blobref(blob)
+        if self.touch_blob(ref):
+            return ref
         path = self.__get_blob_path(ref)
-        if not os.path.exists(path):
-            distutils.dir_util.mkpath(os.path.dirname(path))
-            with open(path, 'wb') as f:
+        compressed = None
+        if self.compress:
+            compressed = compression.compress(blob)
+        dirname = os.path.dirname(path)
+        distutils.dir_util.mkpath(dirname)
+        # Write to a temporary file first so that concurrent writers of the
+        # same blob never see each other's partial content.
+        fd, tmp_path = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            if compressed is None:
                 f.write(blob)
-            os.chmod(path, 0400)
+            else:
+                f.write('%s %d\n' % (compression.DEFLATE, len(blob)))
+                f.write(compressed)
+                path += COMPRESSED_SUFFIX
+        os.chmod(tmp_path, 0400)
+        os.rename(tmp_path, path)
         return ref
 
-    def set_link(self, link, ref):
+    def put_blob_stream(self, fp):
+        """Store the content of the file object ``fp`` without holding it
+        in memory. It's hashed while it's written to a temporary file, which
+        is then renamed into place under its ref.
+        """
+        digest = hashlib.sha1()
+        fd, tmp_path = tempfile.mkstemp(dir=self.blobs_path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in iter(lambda: fp.read(BUFFER_SIZE), ''):
+                    digest.update(data)
+                    f.write(data)
+            ref = 'sha1-%s' % digest.hexdigest()
+            path = self.__get_blob_path(ref)
+            if self.touch_blob(ref):
+                os.remove(tmp_path)
+                return ref
+            distutils.dir_util.mkpath(os.path.dirname(path))
+            os.chmod(tmp_path, 0400)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return ref
+
+    def touch_blob(self, ref):
+        """Mark the blob at ``ref`` as recently used, so that it isn't
+        garbage collected before the grace period ends, and return ``True``
+        if it exists.
+        """
+        path, _ = self.__find_blob(ref)
+        if path is None:
+            return False
+        try:
+            os.utime(path, None)
+        except OSError:
+            return os.path.exists(path)
+        return True
+
+    def set_link(self, link, ref, expected=None):
         if not link and not ref:
             return None
         if not link:
             link = 'uuid4-%s' % str(uuid.uuid4())
-        path = self.__get_link_path(link)
-        if not ref:
-            if not os.path.isfile(path):
-                return None
-            os.remove(path)
-            return link
-        if os.path.isdir(path):
-            return None
-        try:
-            with open(path, 'w') as fp:
-                fp.write(ref)
-        except IOError:
+        if not self.__get_link_db().set(link, ref, expected):
             return None
         return link
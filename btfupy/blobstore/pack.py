@@ -0,0 +1,482 @@
+import binascii
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from . import local
+
+PACK_MAGIC = 'BTFPACK1'
+INDEX_MAGIC = 'BTFIDX01'
+
+# Every blob in a pack file is preceded by its raw SHA-1 and its length.
+RECORD = struct.Struct('>20sQ')
+# The index is a 256-entry fan-out table of cumulative counts by first byte,
+# followed by entries sorted by raw SHA-1.
+FANOUT = struct.Struct('>256I')
+INDEX_ENTRY = struct.Struct('>20sQQ')
+ENTRIES_OFFSET = len(INDEX_MAGIC) + FANOUT.size
+
+PACK_SIZE = 256 * 1024 * 1024 # start a new pack after this many bytes
+SYNC_EVERY = 64 # fsync the active pack after this many puts...
+SYNC_INTERVAL = 1.0 # ...or after this many seconds, whichever comes first
+
+
+def raw_ref(ref):
+    """Return the 20-byte digest of a ``sha1-`` ref, or ``None``."""
+    if not ref or not ref.startswith('sha1-') or len(ref) != 45:
+        return None
+    try:
+        return binascii.unhexlify(ref[5:])
+    except TypeError:
+        return None
+
+
+def hex_ref(raw):
+    return 'sha1-%s' % binascii.hexlify(raw)
+
+
+class PackIndex(object):
+    """A read-only, memory-mapped index of a sealed pack file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError('not a pack index: %s' % path)
+        self.fanout = FANOUT.unpack_from(self.mm, len(INDEX_MAGIC))
+        self.count = self.fanout[-1]
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            pos = ENTRIES_OFFSET + i * INDEX_ENTRY.size
+            yield INDEX_ENTRY.unpack_from(self.mm, pos)
+
+    def lookup(self, raw):
+        """Return the offset and length of the blob with the digest ``raw``,
+        or ``None``.
+        """
+        first = ord(raw[0])
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = ENTRIES_OFFSET + mid * INDEX_ENTRY.size
+            key = self.mm[pos:pos + 20]
+            if key < raw:
+                lo = mid + 1
+            elif key > raw:
+                hi = mid
+            else:
+                return INDEX_ENTRY.unpack_from(self.mm, pos)[1:]
+        return None
+
+    def close(self):
+        self.mm.close()
+
+    @classmethod
+    def write(cls, path, entries):
+        """Atomically write an index of ``entries``, a dict mapping digests to
+        offsets and lengths.
+        """
+        keys = sorted(entries)
+        counts = [0] * 256
+        for key in keys:
+            counts[ord(key[0])] += 1
+        for i in xrange(1, 256):
+            counts[i] += counts[i - 1]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(INDEX_MAGIC)
+            fp.write(FANOUT.pack(*counts))
+            for key in keys:
+                offset, length = entries[key]
+                fp.write(INDEX_ENTRY.pack(key, offset, length))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, path)
+        return cls(path)
+
+
+class MemoryIndex(object):
+    """An index of a pack file that isn't sealed, held in memory, with the
+    same interface as ``PackIndex``.
+    """
+
+    path = None
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.count = len(entries)
+
+    def __iter__(self):
+        for raw in sorted(self.entries):
+            yield (raw,) + self.entries[raw]
+
+    def lookup(self, raw):
+        return self.entries.get(raw)
+
+    def close(self):
+        pass
+
+
+class Pack(object):
+    """A sealed pack file and its index."""
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        with open(path, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, length, size=-1, skip=0):
+        start = offset + min(skip, length)
+        end = offset + length
+        if size > -1:
+            end = min(end, start + size)
+        return self.mm[start:end]
+
+    def close(self):
+        self.mm.close()
+        self.index.close()
+
+
+class PackBlobStore(local.LocalBlobStore):
+    """A blob store that appends blobs to large pack files instead of writing
+    one file per blob. Every sealed pack has a sorted, memory-mapped index
+    with a fan-out table, so a lookup is a binary search over a small slice
+    of the index. Blobs in the active pack are indexed in memory and the
+    pack is scanned to rebuild that index on startup.
+
+    Appends are fsynced in batches of ``SYNC_EVERY`` puts or every
+    ``SYNC_INTERVAL`` seconds, and always before a link is set, so a link
+    never refers to a blob that could be lost in a crash. Links, and blobs
+    stored loose by ``LocalBlobStore``, are handled by the superclass.
+
+    If ``read_only`` is true, the packs are only read, so that another
+    process can look at them while a server appends to them: unsealed
+    packs are scanned up to their last complete record and never
+    truncated or indexed, and blobs can't be put. Loose blobs can still be
+    deleted.
+    """
+
+    def __init__(self, path, read_only=False):
+        super(PackBlobStore, self).__init__(path)
+        self.read_only = read_only
+        self.packs_path = os.path.join(self.store_path, 'packs')
+        if not os.path.exists(self.packs_path) and not read_only:
+            os.mkdir(self.packs_path)
+        self.lock = threading.RLock()
+        self.packs = []
+        self.active = None
+        self.__open_packs()
+
+    def __get_pack_path(self, number):
+        return os.path.join(self.packs_path, 'pack-%08d.pack' % number)
+
+    def __get_pack_numbers(self):
+        numbers = []
+        if not os.path.exists(self.packs_path):
+            return numbers
+        for filename in os.listdir(self.packs_path):
+            if filename.startswith('pack-') and filename.endswith('.pack'):
+                numbers.append(int(filename[5:-5]))
+        return sorted(numbers)
+
+    def __open_packs(self):
+        numbers = self.__get_pack_numbers()
+        for number in numbers:
+            path = self.__get_pack_path(number)
+            index_path = path[:-len('.pack')] + '.idx'
+            if os.path.exists(index_path):
+                self.packs.insert(0, Pack(path, PackIndex(index_path)))
+                continue
+            entries = self.__scan_pack(path)
+            if self.read_only:
+                if entries:
+                    self.packs.insert(0, Pack(path, MemoryIndex(entries)))
+            elif number == numbers[-1]:
+                self.__open_active(number, entries)
+            elif entries:
+                self.packs.insert(0, Pack(path, PackIndex.write(index_path,
+                                                                entries)))
+            else:
+                os.remove(path)
+        if self.active is None and not self.read_only:
+            self.__open_active(numbers[-1] + 1 if numbers else 0, {})
+
+    def __scan_pack(self, path):
+        """Return the entries of a pack file that has no index, truncating
+        a partially written record left behind by a crash unless the store
+        is read-only.
+        """
+        entries = {}
+        with open(path, 'rb' if self.read_only else 'r+b') as fp:
+            if fp.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                if self.read_only:
+                    return entries
+                fp.seek(0)
+                fp.truncate()
+                fp.write(PACK_MAGIC)
+                return entries
+            end = len(PACK_MAGIC)
+            while True:
+                header = fp.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                raw, length = RECORD.unpack(header)
+                offset = end + RECORD.size
+                fp.seek(offset + length)
+                if fp.tell() > os.fstat(fp.fileno()).st_size:
+                    break
+                entries[raw] = (offset, length)
+                end = offset + length
+            if not self.read_only:
+                fp.truncate(end)
+        return entries
+
+    def __open_active(self, number, entries):
+        path = self.__get_pack_path(number)
+        writer = open(path, 'ab')
+        if writer.tell() == 0:
+            writer.write(PACK_MAGIC)
+            writer.flush()
+        self.active = {
+            'number': number,
+            'path': path,
+            'writer': writer,
+            'reader': open(path, 'rb'),
+            'entries': entries,
+            'size': writer.tell(),
+            'unsynced': 0,
+            'synced_at': time.time(),
+        }
+
+    def __active_entries(self):
+        return self.active['entries'] if self.active is not None else {}
+
+    def __check_writable(self):
+        if self.read_only:
+            raise IOError('%s is open read-only' % self.packs_path)
+
+    def __seal(self):
+        """Index the active pack and start a new one."""
+        active = self.active
+        self.flush()
+        active['writer'].close()
+        active['reader'].close()
+        if active['entries']:
+            index_path = active['path'][:-len('.pack')] + '.idx'
+            index = PackIndex.write(index_path, active['entries'])
+            self.packs.insert(0, Pack(active['path'], index))
+        else:
+            os.remove(active['path'])
+        self.__open_active(active['number'] + 1, {})
+
+    def __locate(self, ref):
+        raw = raw_ref(ref)
+        if raw is None:
+            return None, None
+        location = self.__active_entries().get(raw)
+        if location is not None:
+            return None, location
+        for pack in self.packs:
+            location = pack.index.lookup(raw)
+            if location is not None:
+                return pack, location
+        return None, None
+
+    def flush(self):
+        """Make every blob put so far durable."""
+        with self.lock:
+            if self.active is None:
+                return
+            if self.active['unsynced']:
+                self.active['writer'].flush()
+                os.fsync(self.active['writer'].fileno())
+            self.active['unsynced'] = 0
+            self.active['synced_at'] = time.time()
+
+    def get_blob(self, ref, size=-1, offset=0):
+        with self.lock:
+            pack, location = self.__locate(ref)
+            if location is None:
+                return super(PackBlobStore, self).get_blob(ref, size=size,
+                                                           offset=offset)
+            if pack is not None:
+                return pack.read(location[0], location[1], size, offset)
+            start, length = location
+            reader = self.active['reader']
+            reader.seek(start + min(offset, length))
+            length -= min(offset, length)
+            return reader.read(length if size < 0 else min(size, length))
+
+    def get_size(self, ref):
+        with self.lock:
+            pack, location = self.__locate(ref)
+        if location is None:
+            return super(PackBlobStore, self).get_size(ref)
+        return location[1]
+
+    def has_blob(self, ref):
+        with self.lock:
+            pack, location = self.__locate(ref)
+        if location is None:
+            return super(PackBlobStore, self).has_blob(ref)
+        return True
+
+    def open_blob(self, ref):
+        with self.lock:
+            pack, location = self.__locate(ref)
+            if location is None:
+                return super(PackBlobStore, self).open_blob(ref)
+            path = self.active['path'] if pack is None else pack.path
+            return local.BlobFile(open(path, 'rb'), location[0], location[1])
+
+    def __append(self, raw, length, parts):
+        """Append a blob of ``length`` bytes, given as an iterable of
+        strings, to the active pack. Must be called with the lock held.
+        """
+        self.__check_writable()
+        active = self.active
+        writer = active['writer']
+        writer.write(RECORD.pack(raw, length))
+        for data in parts:
+            writer.write(data)
+        writer.flush()
+        offset = active['size'] + RECORD.size
+        active['entries'][raw] = (offset, length)
+        active['size'] = offset + length
+        active['unsynced'] += 1
+        if (active['unsynced'] >= SYNC_EVERY or
+                time.time() - active['synced_at'] >= SYNC_INTERVAL):
+            self.flush()
+        if active['size'] >= PACK_SIZE:
+            self.__seal()
+
+    def put_blob(self, blob):
+        ref = self.blobref(blob)
+        raw = raw_ref(ref)
+        with self.lock:
+            if self.__locate(ref)[1] is None:
+                self.__append(raw, len(blob), [blob])
+        return ref
+
+    def put_blob_stream(self, fp):
+        """Store the content of the file object ``fp`` without holding it
+        in memory. Its length and ref have to be known before it can be
+        appended, so it's hashed into a temporary file first.
+        """
+        self.__check_writable()
+        digest = hashlib.sha1()
+        length = 0
+        with tempfile.TemporaryFile(dir=self.packs_path) as tmp:
+            for data in iter(lambda: fp.read(local.BUFFER_SIZE), ''):
+                digest.update(data)
+                tmp.write(data)
+                length += len(data)
+            ref = 'sha1-%s' % digest.hexdigest()
+            tmp.seek(0)
+            with self.lock:
+                if self.__locate(ref)[1] is None:
+                    parts = iter(lambda: tmp.read(local.BUFFER_SIZE), '')
+                    self.__append(digest.digest(), length, parts)
+        return ref
+
+    def set_link(self, link, ref, expected=None):
+        self.flush()
+        return super(PackBlobStore, self).set_link(link, ref, expected)
+
+    def count_blobs(self):
+        with self.lock:
+            packed = sum(pack.index.count for pack in self.packs)
+            packed += len(self.__active_entries())
+        return packed + super(PackBlobStore, self).count_blobs()
+
+    def touch_blob(self, ref):
+        with self.lock:
+            pack, location = self.__locate(ref)
+            if location is not None:
+                # Packed blobs have no times of their own, so the whole pack
+                # is marked as recently used and repack keeps all of it.
+                path = pack.path if pack is not None else self.active['path']
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+                return True
+        return super(PackBlobStore, self).touch_blob(ref)
+
+    def iter_refs(self):
+        with self.lock:
+            packed = list(self.__active_entries())
+            indexes = [pack.index for pack in self.packs]
+        for raw in packed:
+            yield hex_ref(raw)
+        for index in indexes:
+            for raw, _, _ in index:
+                yield hex_ref(raw)
+        for ref in super(PackBlobStore, self).iter_refs():
+            yield ref
+
+    def iter_loose_blobs(self):
+        """Generate the refs and paths of blobs stored one file per blob."""
+        return super(PackBlobStore, self).iter_blobs()
+
+    def repack(self, keep=None, deadline=None):
+        """Rewrite every pack, and every loose blob, into new tightly packed
+        files, dropping duplicates and any blob whose ref isn't in ``keep``
+        (if given). If ``deadline`` is given, such blobs are only dropped if
+        they were last written or touched before it; for a packed blob,
+        that's the last time its pack was. Return the number of blobs kept
+        and dropped.
+
+        Other processes must not use the store while it's being repacked.
+        """
+        self.__check_writable()
+        with self.lock:
+            self.__seal()
+            old_packs = self.packs
+            loose = list(self.iter_loose_blobs())
+            self.packs = []
+            kept = set()
+            dropped = 0
+            def droppable(ref, path):
+                if keep is None or ref in keep:
+                    return False
+                if deadline is None:
+                    return True
+                try:
+                    return os.stat(path).st_mtime <= deadline
+                except OSError:
+                    return False
+            for pack in old_packs:
+                for raw, offset, length in pack.index:
+                    if raw in kept:
+                        continue
+                    if droppable(hex_ref(raw), pack.path):
+                        dropped += 1
+                        continue
+                    self.put_blob(pack.read(offset, length))
+                    kept.add(raw)
+            for ref, path in loose:
+                raw = raw_ref(ref)
+                if raw is None or raw in kept:
+                    continue
+                if droppable(ref, path):
+                    dropped += 1
+                    continue
+                self.put_blob(super(PackBlobStore, self).get_blob(ref))
+                kept.add(raw)
+            self.__seal()
+            for pack in old_packs:
+                pack.close()
+                os.remove(pack.path)
+                os.remove(pack.index.path)
+            for ref, path in loose:
+                os.remove(path)
+        return len(kept), dropped
@@ -3,54 +3,247 @@ import SocketServer
 import hashlib
 import hmac
 import httplib
+import json
+import os
 import ssl
+import time
 import traceback
+import urlparse
 
+from . import abstract
+from . import compression
+from . import existence
+from . import history
+from . import links
 from . import local
+from . import zerocopy
+from .. import metrics
 
 BLOBS_PATH = '/blobs/'
 LINKS_PATH = '/links/'
+HISTORY_PATH = '/history/'
+BATCH_HAS_PATH = '/batch/has'
+BATCH_GET_PATH = '/batch/get'
+BATCH_PUT_PATH = '/batch/put'
+STATS_PATH = '/stats'
+
+# Requests are measured under the first of these their path starts with.
+ROUTES = [BLOBS_PATH, LINKS_PATH, HISTORY_PATH, BATCH_HAS_PATH,
+          BATCH_GET_PATH, BATCH_PUT_PATH, STATS_PATH]
+COMMANDS = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE']
+
+
+def parse_range(header, size):
+    """Parse the value of a ``Range`` header for a blob of ``size`` bytes and
+    return the first and last byte positions it selects, or ``None`` if the
+    whole blob should be sent. Raise ``ValueError`` if the range can't be
+    satisfied.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    spec = header[len('bytes='):].strip()
+    if ',' in spec or '-' not in spec:
+        return None # multiple or malformed ranges; send the whole blob
+    first, last = spec.split('-', 1)
+    try:
+        if not first:
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError('unsatisfiable range: %r' % header)
+    return start, end
+
+
+def parse_precondition(headers):
+    """Return the ref a link must point to for a request with ``headers`` to
+    change it, given as ``If-Match: "ref"``, ``''`` if it must not exist,
+    given as ``If-None-Match: *``, or ``None`` if the request is
+    unconditional.
+    """
+    if_match = headers.get('If-Match')
+    if if_match is not None:
+        return if_match.strip().strip('"')
+    if (headers.get('If-None-Match') or '').strip() == '*':
+        return ''
+    return None
+
+
+def pack_blobs(items):
+    """Frame ``(ref, blob)`` pairs into a single body. Each blob is preceded
+    by a ``ref size`` header line; a missing blob has a size of ``-1`` and no
+    content.
+    """
+    parts = []
+    for ref, blob in items:
+        if blob is None:
+            parts.append('%s -1\n' % ref)
+        else:
+            parts.append('%s %d\n' % (ref, len(blob)))
+            parts.append(blob)
+    return ''.join(parts)
+
+
+def unpack_blobs(content):
+    """Generate the ``(ref, blob)`` pairs framed by ``pack_blobs``. Raise
+    ``ValueError`` if a frame is malformed or cut short.
+    """
+    i = 0
+    while i < len(content):
+        j = content.find('\n', i)
+        if j < 0:
+            raise ValueError('unterminated frame header')
+        ref, size = content[i:j].split(' ', 1)
+        size = int(size)
+        i = j + 1
+        if size == -1:
+            yield ref, None
+        elif 0 <= size <= len(content) - i:
+            yield ref, content[i:i + size]
+            i += size
+        else:
+            raise ValueError('bad frame size for %s' % ref)
+
+
+def encode_content(content, accept_encoding, headers):
+    """Return ``content`` compressed with an encoding listed in the
+    ``Accept-Encoding`` header value ``accept_encoding`` and set
+    ``Content-Encoding`` in ``headers``, or return it unchanged if the client
+    doesn't accept compression or it isn't worth it.
+    """
+    encoding = compression.accepted(accept_encoding)
+    if encoding is None or len(content) > compression.MAX_SIZE:
+        return content
+    compressed = compression.compress(content, encoding)
+    if compressed is None:
+        return content
+    headers['Content-Encoding'] = encoding
+    return compressed
+
+
+def route_name(command, path):
+    """Return the name that requests of ``command`` on ``path`` are
+    measured under, such as ``GET.blobs`` or ``POST.batch.get``.
+    """
+    if command not in COMMANDS:
+        command = 'other'
+    for prefix in ROUTES:
+        if path.startswith(prefix):
+            return '%s.%s' % (command, prefix.strip('/').replace('/', '.'))
+    return '%s.other' % command
+
+
+def authenticate(auth_token, command, path, headers):
+    """Check the HMAC signature of a request against ``auth_token``."""
+    if auth_token is None:
+        return True
+    authorization = headers.get('Authorization')
+    date = headers.get('Date')
+    if not (authorization or date):
+        return False
+    # TODO: assert that date is recent
+    signature = hmac.new(auth_token, digestmod=hashlib.sha1)
+    signature.update(command)
+    signature.update(path)
+    signature.update(date)
+    signature = signature.hexdigest()
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(authorization, signature)
+    xs = map(ord, authorization)
+    ys = map(ord, signature)
+    n = len(xs) - len(ys)
+    padding = [-1] * abs(n) # a list of some number ord() will never return
+    if n < 0:
+        xs.extend(padding)
+    elif n > 0:
+        ys.extend(padding)
+    z = 0
+    for x, y in zip(xs, ys):
+        z |= x ^ y
+    return not z
+
+
+class BodyReader(object):
+    """Reads a request body from ``rfile`` without reading past its end,
+    whether it's sent with a ``Content-Length`` or with chunked transfer
+    encoding.
+    """
+
+    def __init__(self, rfile, headers):
+        self.rfile = rfile
+        encoding = headers.get('Transfer-Encoding') or ''
+        self.chunked = encoding.lower() == 'chunked'
+        self.remaining = 0 if self.chunked else int(
+            headers.get('Content-Length') or 0)
+        self.started = False
+        self.done = False
+
+    def __next_chunk(self):
+        if self.started:
+            self.rfile.readline() # the line break that ends the last chunk
+        self.started = True
+        line = self.rfile.readline()
+        try:
+            self.remaining = int(line.split(';', 1)[0], 16)
+        except ValueError:
+            raise IOError('malformed chunk size: %r' % line)
+        if not self.remaining:
+            # skip any trailers up to the blank line that ends the body
+            while self.rfile.readline() not in ['\r\n', '\n', '']:
+                pass
+            self.done = True
+
+    def read(self, size=-1):
+        parts = []
+        while size and not self.done:
+            if not self.remaining:
+                if not self.chunked:
+                    break
+                self.__next_chunk()
+                continue
+            n = self.remaining if size < 0 else min(size, self.remaining)
+            data = self.rfile.read(n)
+            if not data:
+                raise IOError('request body ended early')
+            self.remaining -= len(data)
+            if size > 0:
+                size -= len(data)
+            parts.append(data)
+        return ''.join(parts)
 
 
 class BlobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
+    # Headers are written a line at a time; without this, every response
+    # waits for the client to acknowledge the first of them.
+    disable_nagle_algorithm = True
+
     def authenticate(self):
-        if self.server.auth_token is None:
-            return True
-        authorization = self.headers.get('Authorization')
-        date = self.headers.get('Date')
-        if not (authorization or date):
-            return False
-        # TODO: assert that date is recent
-        signature = hmac.new(self.server.auth_token, digestmod=hashlib.sha1)
-        signature.update(self.command)
-        signature.update(self.path)
-        signature.update(date)
-        signature = signature.hexdigest()
-        if hasattr(hmac, 'compare_digest'):
-            return hmac.compare_digest(authorization, signature)
-        xs = map(ord, authorization)
-        ys = map(ord, signature)
-        n = len(xs) - len(ys)
-        padding = [-1] * abs(n) # a list of some number ord() will never return
-        if n < 0:
-            xs.extend(padding)
-        elif n > 0:
-            ys.extend(padding)
-        z = 0
-        for x, y in zip(xs, ys):
-            z |= x ^ y
-        return not z
+        return authenticate(self.server.auth_token, self.command, self.path,
+                            self.headers)
+
+    def body(self, max_size=compression.MAX_DECODED_SIZE):
+        """Return a file object that reads the decoded request body, which
+        may decode to at most ``max_size`` bytes, or any amount if it's
+        ``None``.
+        """
+        encoding = self.headers.get('Content-Encoding')
+        if not compression.supported(encoding):
+            raise compression.UnsupportedEncoding(encoding)
+        return compression.decoding_reader(
+            BodyReader(self.rfile, self.headers), encoding, max_size)
 
     def do_DELETE(self):
         if not self.authenticate():
             self.send_error(httplib.FORBIDDEN)
             return
-        length = int(self.headers['Content-Length'])
-        content = self.rfile.read(length)
+        content = self.body().read()
         if self.path.startswith(LINKS_PATH):
-            link = self.path[len(LINKS_PATH):]
-            self.send_content(self.server.set_link(link, None))
+            self.send_link(self.path[len(LINKS_PATH):], None)
         else:
             self.send_error(httplib.METHOD_NOT_ALLOWED)
 
@@ -59,17 +252,34 @@ class BlobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_error(httplib.FORBIDDEN)
             return
         if self.path.startswith(BLOBS_PATH):
-            blob = self.server.get_blob(self.path[len(BLOBS_PATH):])
-            if blob is not None:
-                self.send_content(blob)
-            else:
-                self.send_error(httplib.NOT_FOUND)
+            self.send_blob(self.path[len(BLOBS_PATH):])
+        elif self.path.startswith(LINKS_PATH + '?'):
+            try:
+                content = self.server.get_links_content(
+                    self.path[len(LINKS_PATH) + 1:])
+            except ValueError:
+                self.send_error(httplib.BAD_REQUEST)
+                return
+            self.send_content(content, encode=True)
         elif self.path.startswith(LINKS_PATH):
             blobref = self.server.get_link(self.path[len(LINKS_PATH):])
             if blobref is not None:
-                self.send_content(blobref)
+                self.send_content(blobref, encode=True)
+            else:
+                self.send_error(httplib.NOT_FOUND)
+        elif self.path.startswith(HISTORY_PATH):
+            try:
+                content = self.server.get_history_content(
+                    self.path[len(HISTORY_PATH):])
+            except ValueError:
+                self.send_error(httplib.BAD_REQUEST)
+                return
+            if content is not None:
+                self.send_content(content, encode=True)
             else:
                 self.send_error(httplib.NOT_FOUND)
+        elif self.path == STATS_PATH:
+            self.send_content(self.server.get_stats_content(), encode=True)
         else:
             self.send_error(httplib.METHOD_NOT_ALLOWED)
 
@@ -80,12 +290,27 @@ class BlobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if not self.authenticate():
             self.send_error(httplib.FORBIDDEN)
             return
-        length = int(self.headers['Content-Length'])
-        content = self.rfile.read(length)
         if self.path == BLOBS_PATH:
-            self.send_content(self.server.put_blob(content))
-        elif self.path == LINKS_PATH:
-            self.send_content(self.server.set_link(None, content))
+            ref = self.server.put_blob_stream(self.body(None))
+            self.send_content(ref)
+            return
+        content = self.body().read()
+        if self.path == LINKS_PATH:
+            self.send_link(None, content)
+        elif self.path == BATCH_HAS_PATH:
+            self.send_content('\n'.join(ref for ref in content.split()
+                                        if not self.server.has_blob(ref)))
+        elif self.path == BATCH_GET_PATH:
+            self.send_content(pack_blobs((ref, self.server.get_blob(ref))
+                                         for ref in content.split()),
+                              encode=True)
+        elif self.path == BATCH_PUT_PATH:
+            try:
+                content = self.server.put_blobs_content(content)
+            except ValueError:
+                self.send_error(httplib.BAD_REQUEST)
+                return
+            self.send_content(content)
         else:
             self.send_error(httplib.METHOD_NOT_ALLOWED)
 
@@ -93,30 +318,121 @@ class BlobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if not self.authenticate():
             self.send_error(httplib.FORBIDDEN)
             return
-        length = int(self.headers['Content-Length'])
-        content = self.rfile.read(length)
+        content = self.body().read()
         if self.path.startswith(LINKS_PATH):
-            link = self.path[len(LINKS_PATH):]
-            self.send_content(self.server.set_link(link, content))
+            self.send_link(self.path[len(LINKS_PATH):], content)
         else:
             self.send_error(httplib.METHOD_NOT_ALLOWED)
 
     def handle_one_request(self):
         self.protocol_version = 'HTTP/1.1'
+        self.request_started = None
         try:
             BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        except compression.UnsupportedEncoding:
+            self.close_connection = 1 # the body is left unread
+            self.send_error(httplib.UNSUPPORTED_MEDIA_TYPE)
+        except compression.CorruptContent:
+            self.close_connection = 1 # the body may be left partly unread
+            self.send_error(httplib.BAD_REQUEST)
         except:
+            metrics.incr('server.errors')
             self.send_error(httplib.INTERNAL_SERVER_ERROR)
             traceback.print_exc()
+        if self.request_started is not None and self.command:
+            metrics.observe('server.' + route_name(self.command, self.path),
+                            time.time() - self.request_started)
+
+    def parse_request(self):
+        # Called once the request line has been read, so the time spent
+        # waiting for the next request on a persistent connection isn't
+        # measured.
+        self.request_started = time.time()
+        return BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+
+    def send_blob(self, ref):
+        if self.command == 'HEAD' and not self.server.has_blob(ref):
+            self.send_error(httplib.NOT_FOUND)
+            return
+        size = self.server.get_size(ref)
+        if size is None:
+            self.send_error(httplib.NOT_FOUND)
+            return
+        headers = {'Accept-Ranges': 'bytes'}
+        try:
+            byte_range = parse_range(self.headers.get('Range'), size)
+        except ValueError:
+            headers['Content-Range'] = 'bytes */%d' % size
+            self.send_content('', code=httplib.REQUESTED_RANGE_NOT_SATISFIABLE,
+                              headers=headers)
+            return
+        if byte_range is None:
+            start, end = 0, size - 1
+            code = httplib.OK
+        else:
+            start, end = byte_range
+            code = httplib.PARTIAL_CONTENT
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        if byte_range is None and self.command == 'GET':
+            content = self.server.get_encoded_content(
+                ref, size, self.headers.get('Accept-Encoding'), headers)
+            if content is not None:
+                self.send_content(content, headers=headers)
+                return
+        blob_file = self.server.open_blob(ref)
+        if blob_file is not None:
+            # Stream straight from the file so that memory use doesn't grow
+            # with the size of the blob.
+            try:
+                blob_file = blob_file.range(start, end - start + 1)
+                self.send_headers(blob_file.size, code=code, headers=headers)
+                if self.command != 'HEAD':
+                    zerocopy.send_blob_file(self.connection, blob_file)
+            finally:
+                blob_file.close()
+            return
+        if byte_range is None:
+            blob = self.server.get_blob(ref)
+        else:
+            blob = self.server.get_blob(ref, end - start + 1, start)
+        if blob is None:
+            self.send_error(httplib.NOT_FOUND)
+            return
+        self.send_content(blob, code=code, headers=headers)
+
+    def send_link(self, link, ref):
+        """Set ``link`` to ``ref`` if the request's preconditions hold, and
+        send the link.
+        """
+        expected = parse_precondition(self.headers)
+        link = self.server.set_link(link, ref, expected)
+        if link is not None:
+            self.send_content(link)
+        elif expected is not None:
+            self.send_error(httplib.PRECONDITION_FAILED)
+        else:
+            self.send_error(httplib.NOT_FOUND)
 
     def send_content(self, content, content_type='text/plain',
-                     code=httplib.OK):
+                     code=httplib.OK, headers=None, encode=False):
+        if encode and self.command != 'HEAD':
+            headers = dict(headers or {})
+            content = encode_content(content,
+                                     self.headers.get('Accept-Encoding'),
+                                     headers)
+        self.send_headers(len(content), content_type, code, headers)
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def send_headers(self, length, content_type='text/plain',
+                     code=httplib.OK, headers=None):
         self.send_response(code)
-        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Content-Length', str(length))
         self.send_header('Content-Type', content_type)
+        self.send_header('Accept-Encoding', ', '.join(compression.ENCODINGS))
+        for key, value in (headers or {}).iteritems():
+            self.send_header(key, value)
         self.end_headers()
-        if self.command != 'HEAD':
-            self.wfile.write(content)
 
     def send_error(self, code, message=None):
         if code in [httplib.FORBIDDEN]:
@@ -127,12 +443,143 @@ class BlobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_content('', code=code)
 
 
+class StoreServer(abstract.BlobStore):
+    """Serves the blobs and links of ``self.store``, and the history of
+    every link from ``self.history``. Blobs that ``self.existence`` rules
+    out are reported missing without looking for them.
+    """
+
+    def open_existence(self):
+        refs = existence.ExistenceFilter(self.store)
+        refs.start()
+        return refs
+
+    def open_history(self):
+        return history.HistoryIndex(
+            self.store, os.path.join(self.store.store_path, 'history'))
+
+    def get_blob(self, ref, size=-1, offset=0):
+        return self.store.get_blob(ref, size=size, offset=offset)
+
+    def get_encoded_blob(self, ref):
+        return self.store.get_encoded_blob(ref)
+
+    def get_encoded_content(self, ref, size, accept_encoding, headers):
+        """Return the content to send for the whole blob at ``ref``, of
+        ``size`` bytes, to a client that sent ``accept_encoding``, and set
+        ``Content-Encoding`` in ``headers`` if it's compressed. Blobs stored
+        compressed are sent as they are. Return ``None`` if the client
+        doesn't accept compression or the blob is too big to compress on
+        the fly.
+        """
+        encoding = compression.accepted(accept_encoding)
+        if encoding is None:
+            return None
+        encoded = self.get_encoded_blob(ref)
+        if encoded is not None and encoded[0] == encoding:
+            headers['Content-Encoding'] = encoding
+            return encoded[1]
+        if size > compression.MAX_SIZE:
+            return None
+        blob = self.get_blob(ref)
+        if blob is None:
+            return None
+        return encode_content(blob, accept_encoding, headers)
+
+    def get_history_content(self, query):
+        """Return a page of the history of a link, given as
+        ``link?limit=n&before=ref&until=time`` with every parameter optional,
+        or ``None`` if there's no such link. Raise ``ValueError`` if a
+        parameter is malformed.
+        """
+        link, _, query = query.partition('?')
+        params = urlparse.parse_qs(query)
+        limit = int(params.get('limit', [history.PAGE_SIZE])[0])
+        before = params.get('before', [None])[0]
+        until = params.get('until', [None])[0]
+        if until is not None:
+            until = float(until)
+        entries = self.history.page(link, limit, before, until)
+        if entries is None:
+            return None
+        return history.format_page(entries)
+
+    def get_link(self, link):
+        return self.store.get_link(link)
+
+    def get_links_content(self, query):
+        """Return a page of links, given as ``prefix=p&after=link&limit=n``
+        with every parameter optional. Raise ``ValueError`` if a parameter
+        is malformed.
+        """
+        params = urlparse.parse_qs(query)
+        limit = int(params.get('limit', [links.PAGE_SIZE])[0])
+        return '\n'.join(self.list_links(params.get('prefix', [''])[0],
+                                         params.get('after', [''])[0],
+                                         limit))
+
+    def list_links(self, prefix='', after='', limit=links.PAGE_SIZE):
+        return self.store.list_links(prefix, after, limit)
+
+    def get_stats_content(self):
+        return json.dumps(metrics.snapshot(), sort_keys=True)
+
+    def get_size(self, ref):
+        if not self.existence.might_have(ref):
+            return None
+        return self.store.get_size(ref)
+
+    def has_blob(self, ref):
+        if not self.existence.might_have(ref):
+            return False
+        # Clients check for blobs before referring to them without putting
+        # them again, so they're protected from garbage collection too.
+        return self.store.touch_blob(ref)
+
+    def open_blob(self, ref):
+        return self.store.open_blob(ref)
+
+    def put_blob(self, blob):
+        ref = self.store.put_blob(blob)
+        self.existence.add(ref)
+        return ref
+
+    def put_blob_stream(self, fp):
+        ref = self.store.put_blob_stream(fp)
+        self.existence.add(ref)
+        return ref
+
+    def put_blobs_content(self, content):
+        """Put the blobs framed by ``pack_blobs`` in ``content`` and return
+        their refs, one per line. Raise ``ValueError``, before putting any
+        of them, if a frame is malformed, has no blob or doesn't match its
+        ref.
+        """
+        blobs = []
+        for ref, blob in unpack_blobs(content):
+            if blob is None or self.store.blobref(blob) != ref:
+                raise ValueError('blob does not match %s' % ref)
+            blobs.append(blob)
+        return '\n'.join(self.put_blob(blob) for blob in blobs)
+
+    def set_link(self, link, ref, expected=None):
+        link = self.store.set_link(link, ref, expected)
+        if link is not None:
+            self.history.update(link, ref)
+        return link
+
+
 class BlobServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer,
-                 local.LocalBlobStore):
+                 StoreServer):
+    """Serve the blobs and links of ``store``, which defaults to a
+    ``LocalBlobStore`` at ``path``.
+    """
 
     def __init__(self, path, host, port, auth_token=None, ssl_key=None,
-                 ssl_cert=None):
-        local.LocalBlobStore.__init__(self, path)
+                 ssl_cert=None, store=None):
+        self.store = store if store is not None else local.LocalBlobStore(path)
+        self.existence = self.open_existence()
+        self.history = self.open_history()
         BaseHTTPServer.HTTPServer.__init__(self, (host, port),
                                            BlobRequestHandler)
         self.path = path
@@ -1,74 +1,309 @@
+import bisect
+import errno
 import fnmatch
 import os
+import stat
 import time
 
 from . import client
+from . import history
+from .. import chunker
+from .. import index
+from .. import lru
 
 TYPE_BLOB = 'blob'
+TYPE_CHUNKS = 'chunks'
+TYPE_CHUNK = 'chunk'
 TYPE_TREE = 'tree'
 TYPE_PARENT = 'root'
 TYPE_CTIME = 'ctime'
+TYPE_FORMAT = 'format'
 
+# Trees whose entries record sizes start with a 'format 2' line. Trees
+# without it are format 1, where the mode column is a bare mode; clients that
+# predate format 2 can't read format 2 trees.
+TREE_FORMAT = 2
 
-class FileAttr:
+# Regular files larger than this are split into content-defined chunks and
+# stored as a chunk index instead of a single blob.
+CHUNK_THRESHOLD = chunker.MAX_CHUNK_SIZE
 
-    def __init__(self, typ, ref, mod, name):
+# Parsed trees and chunk indexes are cached in memory up to this many bytes,
+# estimated as the size of the blob plus ENTRY_OVERHEAD bytes per entry.
+TREE_CACHE_BYTES = 64 * 1024 * 1024
+ENTRY_OVERHEAD = 128
+
+
+class FileAttr(object):
+    """A tree entry: ``typ ref mode name``. In format 2 trees the mode column
+    may be ``mode,size`` so that sizes can be served from the tree alone;
+    ``size`` is ``None`` for entries without one. Only data derived from the
+    content is recorded, so touching a file doesn't change any tree.
+    """
+
+    __slots__ = ('typ', 'ref', 'mod', 'name', 'size')
+
+    def __init__(self, typ, ref, mod, name, size=None):
         self.typ = typ
         self.ref = ref
         self.mod = mod
         self.name = name
+        self.size = size
+
+    def copy(self):
+        return FileAttr(self.typ, self.ref, self.mod, self.name, self.size)
 
     def __str__(self):
-        return '%s %s %06o %s' % (self.typ, self.ref, self.mod, self.name)
+        mod = '%06o' % self.mod
+        if self.size is not None:
+            mod += ',%d' % self.size
+        return '%s %s %s %s' % (self.typ, self.ref, mod, self.name)
 
     @classmethod
     def parse(cls, s):
         typ, ref, mod, name = s.split(' ', 3)
-        return cls(typ, ref, int(mod, 8), name)
+        fields = mod.split(',') # a third field, an mtime, is ignored
+        size = int(fields[1]) if len(fields) > 1 else None
+        return cls(typ, ref, int(fields[0], 8), name, size)
+
+
+def format_tree(attrs):
+    """Return the tree blob listing ``attrs``. The format line is only
+    written if an entry records its size, so trees without sizes, and the
+    empty tree, read the same as before.
+    """
+    lines = map(str, attrs)
+    if any(attr.size is not None for attr in attrs):
+        lines.insert(0, '%s %d' % (TYPE_FORMAT, TREE_FORMAT))
+    return '\n'.join(lines)
+
+
+class ChunkAttr(object):
+
+    __slots__ = ('ref', 'offset', 'size')
+
+    def __init__(self, ref, offset, size):
+        self.ref = ref
+        self.offset = offset
+        self.size = size
+
+    def __str__(self):
+        return '%s %s %d %d' % (TYPE_CHUNK, self.ref, self.offset, self.size)
+
+    @classmethod
+    def parse(cls, s):
+        typ, ref, offset, size = s.split(' ', 3)
+        return cls(ref, int(offset), int(size))
+
+
+class ParsedTree(object):
+    """A tree blob parsed into a dict of its entries by name. The entries
+    are shared by everyone who reads the tree from the cache and must not be
+    modified; ``get`` and ``attrs`` return copies.
+    """
+
+    __slots__ = ('names', 'entries')
+
+    def __init__(self, blob=''):
+        self.names = []
+        self.entries = {}
+        lines = blob.splitlines()
+        if lines and lines[0].startswith(TYPE_FORMAT + ' '):
+            version = int(lines.pop(0).split(' ', 1)[1])
+            if version > TREE_FORMAT:
+                raise ValueError('unsupported tree format %d' % version)
+        for line in lines:
+            attr = FileAttr.parse(line)
+            self.names.append(attr.name)
+            self.entries[attr.name] = attr
+
+    def attrs(self):
+        return [self.entries[name].copy() for name in self.names]
+
+    def get(self, name):
+        attr = self.entries.get(name)
+        return attr.copy() if attr is not None else None
+
+
+class ChunkIndex(object):
+
+    __slots__ = ('chunks', 'offsets')
+
+    def __init__(self, blob=''):
+        self.chunks = map(ChunkAttr.parse, blob.splitlines())
+        self.offsets = [chunk.offset for chunk in self.chunks]
 
 
 class TreeStore(client.BlobClient):
 
-    def __init__(self, baseurl, auth_token, root_name='.'):
-        super(TreeStore, self).__init__(baseurl, auth_token)
+    def __init__(self, baseurl, auth_token, root_name='.',
+                 tree_cache_bytes=TREE_CACHE_BYTES, **kwargs):
+        super(TreeStore, self).__init__(baseurl, auth_token, **kwargs)
         self.root_path = os.path.abspath(root_name)
         self.key_id = ''
         self.__ignore_patterns = None
+        self.tree_cache = lru.LRUCache(tree_cache_bytes)
+
+    def __cache_parsed(self, key, ref, blob, cls):
+        parsed = cls(blob)
+        self.tree_cache.set((key, ref), parsed,
+                            len(blob) + ENTRY_OVERHEAD * blob.count('\n'))
+        return parsed
+
+    def get_parsed_tree(self, ref):
+        """Return the tree at ``ref`` as a ``ParsedTree``, or an empty one if
+        ``ref`` is ``None``. Raise ``IOError`` if the tree can't be fetched,
+        so that it's never mistaken for an empty one. Trees are immutable,
+        so parsed trees are cached by ref.
+        """
+        if ref is None:
+            return ParsedTree()
+        tree = self.tree_cache.get((TYPE_TREE, ref))
+        if tree is not None:
+            return tree
+        blob = self.get_blob(ref)
+        if blob is None:
+            raise IOError('missing tree %s' % ref)
+        return self.__cache_parsed(TYPE_TREE, ref, blob, ParsedTree)
+
+    def get_chunk_index(self, ref):
+        """Return the chunk index at ``ref``, or an empty one if ``ref`` is
+        ``None``. Raise ``IOError`` if it can't be fetched.
+        """
+        if ref is None:
+            return ChunkIndex()
+        index = self.tree_cache.get((TYPE_CHUNKS, ref))
+        if index is not None:
+            return index
+        blob = self.get_blob(ref)
+        if blob is None:
+            raise IOError('missing chunk index %s' % ref)
+        return self.__cache_parsed(TYPE_CHUNKS, ref, blob, ChunkIndex)
 
     def blobref_by_path(self, ref, path):
-        if not path:
-            return ref
+        """Return the ref of the entry at ``path`` in the tree at ``ref``, or
+        ``None`` if there's no such entry.
+        """
         if isinstance(path, basestring):
-            path = path[1:]
-            path = path.split(os.sep) if path else []
-            return self.blobref_by_path(ref, path)
-        name = path.pop(0)
-        for obj in self.get_tree(ref):
-            if obj.name == name:
-                return self.blobref_by_path(obj.ref, path)
+            path = path.split(os.sep)
+        for name in path:
+            if not name:
+                continue
+            if ref is None:
+                return None
+            attr = self.get_parsed_tree(ref).entries.get(name)
+            if attr is None:
+                return None
+            ref = attr.ref
         return ref
 
     def get_attr(self, ref, path):
         path, name = os.path.split(path)
         ref = self.blobref_by_path(ref, path)
-        for attr in self.get_tree(ref):
-            if name == attr.name:
-                return attr
-        return None
+        if ref is None:
+            return None
+        return self.get_parsed_tree(ref).get(name)
 
     def get_blob_by_path(self, treeref, path):
         blobref = self.blobref_by_path(treeref, path)
+        if blobref is None:
+            return None
         return self.get_blob(blobref)
 
+    def get_chunks(self, ref):
+        return list(self.get_chunk_index(ref).chunks)
+
+    def get_chunked_blob(self, ref, size=-1, offset=0):
+        """Read ``size`` bytes at ``offset`` from the file whose chunk index
+        is at ``ref``, fetching only the chunks that overlap the range.
+        """
+        index = self.get_chunk_index(ref)
+        chunks = index.chunks
+        end = None if size < 0 else offset + size
+        i = max(bisect.bisect_right(index.offsets, offset) - 1, 0)
+        parts = []
+        for chunk in chunks[i:]:
+            chunk_end = chunk.offset + chunk.size
+            if end is not None and chunk.offset >= end:
+                break
+            if chunk_end <= offset:
+                continue
+            start = max(offset, chunk.offset) - chunk.offset
+            stop = (chunk_end if end is None else min(end, chunk_end))
+            part = self.get_blob(chunk.ref, size=stop - chunk.offset - start,
+                                 offset=start)
+            if part is None:
+                return None
+            parts.append(part)
+        return ''.join(parts)
+
+    def get_chunked_size(self, ref):
+        chunks = self.get_chunk_index(ref).chunks
+        if not chunks:
+            return 0
+        return chunks[-1].offset + chunks[-1].size
+
+    def get_file_blob(self, ref, size=-1, offset=0, typ=TYPE_BLOB):
+        if typ == TYPE_CHUNKS:
+            return self.get_chunked_blob(ref, size=size, offset=offset)
+        return self.get_blob(ref, size=size, offset=offset)
+
+    def get_file_size(self, ref, typ=TYPE_BLOB):
+        if typ == TYPE_CHUNKS:
+            return self.get_chunked_size(ref)
+        return self.get_size(ref)
+
+    def get_attr_size(self, attr):
+        """Return the size recorded in ``attr``, looking it up only for
+        entries from trees that predate recorded sizes.
+        """
+        if attr.size is not None:
+            return attr.size
+        return self.get_file_size(attr.ref, attr.typ)
+
     def get_tree(self, ref, path=None):
         if path is not None:
             ref = self.blobref_by_path(ref, path)
-        for line in self.get_blob(ref).splitlines():
-            yield FileAttr.parse(line)
+        return self.get_parsed_tree(ref).attrs()
+
+    def get_trees(self, refs):
+        """Return a dict mapping each of ``refs`` to its list of entries,
+        fetching all the tree blobs in as few requests as possible.
+        """
+        trees = {}
+        missing = []
+        for ref in refs:
+            tree = self.tree_cache.get((TYPE_TREE, ref))
+            if tree is None:
+                missing.append(ref)
+            else:
+                trees[ref] = tree.attrs()
+        for ref, blob in self.get_blobs(missing).iteritems():
+            if blob is not None:
+                tree = self.__cache_parsed(TYPE_TREE, ref, blob, ParsedTree)
+                trees[ref] = tree.attrs()
+        return trees
+
+    def walk_trees(self, ref):
+        """Return a dict mapping the refs of the tree at ``ref`` and all of
+        its subtrees to their lists of entries. Trees are fetched breadth-first
+        so that every level costs a single batch of requests.
+        """
+        trees = {}
+        level = [ref]
+        while level:
+            fetched = self.get_trees(level)
+            trees.update(fetched)
+            level = list(set(attr.ref
+                             for attrs in fetched.itervalues()
+                             for attr in attrs
+                             if attr.typ == TYPE_TREE and
+                             attr.ref not in trees))
+        return trees
 
     def ignore_file(self, name):
         if not self.__ignore_patterns:
-            self.__ignore_patterns = ['.btfu']
+            self.__ignore_patterns = ['.btfu', index.INDEX_FILENAME]
             with open(os.path.join(self.root_path, '.btfuignore')) as f:
                 for line in f:
                     line = line.strip()
@@ -79,55 +314,295 @@ class TreeStore(client.BlobClient):
                 return True
         return False
 
-    def put_file(self, path):
+    def file_type(self, st):
+        if stat.S_ISREG(st.st_mode):
+            if st.st_size > CHUNK_THRESHOLD:
+                return TYPE_CHUNKS
+            return TYPE_BLOB
+        elif stat.S_ISLNK(st.st_mode):
+            return TYPE_BLOB
+        return TYPE_TREE
+
+    def hash_file(self, path, typ):
+        """Return the ref that the file or symlink at ``path``, of type
+        ``typ``, would be put under, without putting anything.
+        """
+        if typ != TYPE_CHUNKS:
+            return self.blobref(self.read_file(path))
+        ls = []
+        offset = 0
+        with open(path, 'rb') as fp:
+            for blob in chunker.chunks(fp):
+                ref = self.blobref(blob)
+                ls.append(str(ChunkAttr(ref, offset, len(blob))))
+                offset += len(blob)
+        return self.blobref('\n'.join(ls))
+
+    def put_chunks(self, path):
+        """Split the file at ``path`` into content-defined chunks, put each
+        chunk and return the ref of the chunk index. Chunks that are already
+        in the store aren't uploaded again.
+        """
+        return self.__put_chunks(path)[0]
+
+    def __put_chunks(self, path):
+        ls = []
+        offset = 0
+        batch = []
+        batch_size = 0
+        with open(path, 'rb') as fp:
+            for blob in chunker.chunks(fp):
+                batch.append(blob)
+                batch_size += len(blob)
+                if batch_size < client.BATCH_BYTES:
+                    continue
+                for blob, ref in zip(batch, self.put_blobs(batch)):
+                    ls.append(str(ChunkAttr(ref, offset, len(blob))))
+                    offset += len(blob)
+                batch = []
+                batch_size = 0
+        for blob, ref in zip(batch, self.put_blobs(batch)):
+            ls.append(str(ChunkAttr(ref, offset, len(blob))))
+            offset += len(blob)
+        return self.put_blob('\n'.join(ls)), offset
+
+    def put_file(self, path, index=None):
+        """Put the file, symlink or directory at ``path`` and return its ref.
+        If ``index`` is given, files whose stat data is unchanged since the
+        last commit reuse their recorded refs instead of being read again.
+        """
+        return self.__put_file(path, index=index)[0]
+
+    def __put_file(self, path, index=None):
         if os.path.islink(path):
-            blob = os.readlink(path)
+            blob = self.read_file(path)
         elif os.path.isfile(path):
-            f = open(path, 'rb')
-            blob = f.read()
-            f.close()
+            if os.path.getsize(path) > CHUNK_THRESHOLD:
+                return self.__put_chunks(path)
+            blob = self.read_file(path)
         else:
-            blob = self.put_tree(path)
-        return self.put_blob(blob)
+            blob = self.put_tree(path, index=index)
+            if index is not None:
+                ref = self.blobref(blob)
+                if not index.lookup_tree(path, ref):
+                    ref = self.put_blob(blob)
+                index.set(path, os.lstat(path), TYPE_TREE, ref)
+                return ref, len(blob)
+        return self.put_blob(blob), len(blob)
 
-    def put_tree(self, dirpath):
+    def put_tree(self, dirpath, index=None):
+        """Put every file under ``dirpath`` and return the tree blob. The
+        blobs of small files and symlinks in the same directory are checked
+        and uploaded together in batches.
+        """
         ls = []
+        pending = []
+        pending_size = 0
         for name in os.listdir(dirpath):
             if self.ignore_file(name):
                 continue
             path = os.path.join(dirpath, name)
             st = os.lstat(path)
-            typ = (TYPE_BLOB if os.path.isfile(path) or os.path.islink(path)
-                   else TYPE_TREE)
-            attr = FileAttr(typ, self.put_file(path), st.st_mode, name)
-            ls.append(str(attr))
-        return '\n'.join(ls)
+            typ = self.file_type(st)
+            attr = FileAttr(typ, None, st.st_mode, name, st.st_size)
+            ls.append(attr)
+            if index is not None and typ != TYPE_TREE:
+                attr.ref = index.lookup(path, st)
+                if attr.ref is not None:
+                    continue
+            if typ == TYPE_BLOB:
+                blob = self.read_file(path)
+                attr.size = len(blob)
+                pending.append((attr, path, st, blob))
+                pending_size += len(blob)
+                if pending_size >= client.BATCH_BYTES:
+                    self.__put_pending(pending, index)
+                    pending = []
+                    pending_size = 0
+            else:
+                attr.ref, attr.size = self.__put_file(path, index=index)
+                if index is not None and typ != TYPE_TREE:
+                    index.set(path, st, typ, attr.ref)
+        self.__put_pending(pending, index)
+        return format_tree(ls)
+
+    def __put_pending(self, pending, index):
+        refs = self.put_blobs([blob for attr, path, st, blob in pending])
+        for (attr, path, st, blob), ref in zip(pending, refs):
+            attr.ref = ref
+            if index is not None:
+                index.set(path, st, attr.typ, ref)
+
+    def read_file(self, path):
+        """Return the content of the regular file or the target of the
+        symlink at ``path``.
+        """
+        if os.path.islink(path):
+            return os.readlink(path)
+        with open(path, 'rb') as fp:
+            return fp.read()
 
     def set_attr(self, rootref, path, new_attr):
-        dirpath, filename = os.path.split(path)
-        if not filename:
+        """Set the entry at ``path`` to ``new_attr``, or delete it if
+        ``new_attr`` has no ref, and return the ref of the new root tree.
+        """
+        if not os.path.split(path)[1]:
             return new_attr.ref
-        exists = False
-        tree = []
-        for attr in self.get_tree(rootref, dirpath):
-            if attr.name == filename:
-                if new_attr.ref:
-                    tree.append(new_attr)
-                exists = True
-            else:
-                tree.append(attr)
-        if not exists:
-            tree.append(new_attr)
-        tree.sort(lambda a, b: cmp(a.name, b.name))
-        ref = self.put_blob('\n'.join(map(str, tree)))
-        if dirpath == os.sep:
-            return ref
-        attr = self.get_attr(rootref, dirpath)
-        attr.ref = ref
-        return self.set_attr(rootref, dirpath, attr)
+        transaction = self.transaction(rootref)
+        if new_attr.ref:
+            transaction.set(path, new_attr)
+        else:
+            transaction.delete(path)
+        return transaction.commit()
+
+    def transaction(self, rootref):
+        return TreeTransaction(self, rootref)
 
     def files_by_path(self, ref, path):
-        return [row.name for row in self.get_tree(ref, path)]
+        ref = self.blobref_by_path(ref, path)
+        return list(self.get_parsed_tree(ref).names)
+
+
+class TreeTransaction(object):
+    """Stages changes to the tree at ``rootref`` in memory. Every directory
+    that is read or changed is loaded once; ``commit`` then writes each
+    modified tree exactly once, deepest first, and uploads them together.
+    """
+
+    def __init__(self, store, rootref):
+        self.store = store
+        self.rootref = rootref
+        self.nodes = {}
+        self.dirty = set()
+
+    @classmethod
+    def __split(cls, path):
+        names = [name for name in path.split(os.sep) if name]
+        if not names:
+            return '', ''
+        return '/'.join(names[:-1]), names[-1]
+
+    def __node(self, dirpath):
+        node = self.nodes.get(dirpath)
+        if node is not None:
+            return node
+        if dirpath:
+            parent, name = self.__split(dirpath)
+            parent_node = self.__node(parent)
+            attr = parent_node.get(name) if parent_node is not None else None
+            if attr is None or attr.typ != TYPE_TREE:
+                return None
+            ref = attr.ref
+        else:
+            ref = self.rootref
+        tree = self.store.get_parsed_tree(ref)
+        node = self.nodes[dirpath] = dict((name, tree.entries[name].copy())
+                                          for name in tree.names)
+        return node
+
+    def __parent_node(self, path):
+        dirpath, name = self.__split(path)
+        node = self.__node(dirpath)
+        if node is None or not name:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return dirpath, name, node
+
+    def __touch(self, dirpath):
+        while dirpath not in self.dirty:
+            self.dirty.add(dirpath)
+            if not dirpath:
+                break
+            dirpath = self.__split(dirpath)[0]
+
+    def __subpaths(self, keys, path):
+        return [key for key in keys
+                if key == path or key.startswith(path + '/')]
+
+    def __forget(self, path):
+        for key in self.__subpaths(self.nodes.keys(), path):
+            del self.nodes[key]
+            self.dirty.discard(key)
+
+    def get(self, path):
+        """Return a copy of the entry at ``path``, or ``None``."""
+        dirpath, name = self.__split(path)
+        node = self.__node(dirpath)
+        if node is None or name not in node:
+            return None
+        return node[name].copy()
+
+    def list(self, path):
+        """Return copies of the entries of the directory at ``path``."""
+        dirpath, name = self.__split(path)
+        node = self.__node('/'.join(filter(None, [dirpath, name])))
+        if node is None:
+            return []
+        return [node[name].copy() for name in sorted(node)]
+
+    def set(self, path, attr):
+        dirpath, name, node = self.__parent_node(path)
+        old = node.get(name)
+        if old is not None and (old.typ != attr.typ or old.ref != attr.ref):
+            self.__forget('/'.join(filter(None, [dirpath, name])))
+        attr = attr.copy()
+        attr.name = name
+        node[name] = attr
+        self.__touch(dirpath)
+
+    def delete(self, path):
+        dirpath, name, node = self.__parent_node(path)
+        if node.pop(name, None) is not None:
+            self.__forget('/'.join(filter(None, [dirpath, name])))
+            self.__touch(dirpath)
+
+    def rename(self, old, new):
+        old_dirpath, old_name, old_node = self.__parent_node(old)
+        new_dirpath, new_name, new_node = self.__parent_node(new)
+        if old_name not in old_node:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), old)
+        old = '/'.join(filter(None, [old_dirpath, old_name]))
+        new = '/'.join(filter(None, [new_dirpath, new_name]))
+        if old == new:
+            return
+        self.delete(new)
+        attr = old_node.pop(old_name)
+        attr.name = new_name
+        new_node[new_name] = attr
+        for key in self.__subpaths(self.nodes.keys(), old):
+            new_key = new + key[len(old):]
+            self.nodes[new_key] = self.nodes.pop(key)
+            if key in self.dirty:
+                self.dirty.remove(key)
+                self.dirty.add(new_key)
+        self.__touch(old_dirpath)
+        self.__touch(new_dirpath)
+
+    def commit(self):
+        """Write every modified tree and return the ref of the new root tree,
+        or ``None`` if an upload failed.
+        """
+        if not self.dirty:
+            return self.rootref
+        blobs = []
+        rootref = None
+        depth = lambda dirpath: dirpath.count('/') + 1 if dirpath else 0
+        for dirpath in sorted(self.dirty, key=depth, reverse=True):
+            node = self.nodes[dirpath]
+            blob = format_tree([node[name] for name in sorted(node)])
+            ref = self.store.blobref(blob)
+            blobs.append(blob)
+            if not dirpath:
+                rootref = ref
+                continue
+            parent, name = self.__split(dirpath)
+            attr = self.nodes[parent][name]
+            attr.ref = ref
+            attr.size = len(blob)
+        if None in self.store.put_blobs(blobs):
+            return None
+        self.rootref = rootref
+        self.dirty.clear()
+        return rootref
 
 
 class RootAttr:
@@ -168,13 +643,44 @@ class RootStore(TreeStore):
     def get_root(self, ref):
         return RootAttr.parse(self.get_blob(ref))
 
+    def iter_history(self, link, until=None):
+        """Generate the refs and creation times of the roots behind
+        ``link``, newest first, starting from the newest one created at or
+        before the time ``until`` if given. Pages of history are fetched
+        from the server, or the chain of roots is walked one at a time if it
+        can't serve them.
+        """
+        before = None
+        while True:
+            page = self.get_history(link, before=before, until=until)
+            if page is None:
+                break
+            for ref, ctime in page:
+                yield ref, ctime
+            if len(page) < history.PAGE_SIZE:
+                return
+            before = page[-1][0]
+        if before is None:
+            rootref = self.get_link(link)
+        else:
+            rootref = self.get_root(before).rootref
+        while rootref:
+            root = self.get_root(rootref)
+            if until is None or root.ctime <= until:
+                until = None
+                yield rootref, root.ctime
+            rootref = root.rootref
+
     def get_roots(self):
         for filename in os.listdir(self.roots_path):
             with open(os.path.join(self.roots_path, filename)) as fp:
                 yield fp.read()
 
-    def put_root(self, rootref, filename):
-        treeref = self.put_file(filename)
+    def put_root(self, rootref, treeref, filename):
+        """Put a root for the tree at ``treeref``, already put from the
+        directory ``filename``, whose parent is ``rootref``. If the tree
+        hasn't changed, ``rootref`` is returned as is.
+        """
         if rootref is not None:
             root = self.get_root(rootref)
             if treeref == root.tree.ref:
@@ -0,0 +1,76 @@
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import ssl
+import sys
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _find_sendfile():
+    """Return a function with the signature of ``os.sendfile``, which
+    Python 2 lacks, or ``None`` if the platform doesn't have a usable one.
+    """
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    if not sys.platform.startswith('linux'):
+        return None # BSD and OS X sendfile have a different signature
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = func(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return sent
+
+    return sendfile
+
+sendfile = _find_sendfile()
+
+
+def can_sendfile(sock):
+    """Return ``True`` if the kernel can copy files straight to ``sock``."""
+    return sendfile is not None and not isinstance(sock, ssl.SSLSocket)
+
+
+def send_blob_file(sock, blob_file):
+    """Send the rest of ``blob_file`` to the blocking socket ``sock``, using
+    ``sendfile`` if possible and chunks of a memory map otherwise, so memory
+    use doesn't depend on the size of the blob.
+    """
+    start = blob_file.offset + blob_file.pos
+    end = blob_file.offset + blob_file.size
+    if start >= end:
+        return
+    if can_sendfile(sock):
+        while start < end:
+            try:
+                sent = sendfile(sock.fileno(), blob_file.fileno(), start,
+                                min(end - start, CHUNK_SIZE))
+            except OSError, e:
+                if e.errno in [errno.EAGAIN, errno.EINTR]:
+                    continue
+                raise
+            if not sent:
+                raise IOError('file ended before %d bytes were sent' % end)
+            start += sent
+        blob_file.seek(blob_file.size)
+        return
+    mm = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for pos in xrange(start, end, CHUNK_SIZE):
+            sock.sendall(mm[pos:min(pos + CHUNK_SIZE, end)])
+    finally:
+        mm.close()
+    blob_file.seek(blob_file.size)
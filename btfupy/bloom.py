@@ -0,0 +1,48 @@
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    """A set of strings in a fixed amount of memory. It never misses a
+    string that was added, but reports about ``error_rate`` of the others
+    as present once ``capacity`` strings have been added, and more after
+    that.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) /
+                            math.log(2) ** 2), 64)
+        self.hashes = max(int(round(float(self.size) / capacity *
+                                    math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __positions(self, key):
+        # Double hashing: two 64-bit halves of one digest give every
+        # position.
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(key).digest())
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self, key):
+        for pos in self.__positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key):
+        """Add ``key`` and return ``True`` if it wasn't already present."""
+        added = False
+        for pos in self.__positions(key):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
@@ -0,0 +1,186 @@
+import os
+import Queue
+import sys
+import threading
+import time
+
+from . import chunker
+from .blobstore import client
+from .blobstore import treestore
+
+JOBS = client.POOL_SIZE
+# Blobs bigger than this, or of unknown size, are fetched and written one
+# range at a time instead of as part of a batch.
+STREAM_SIZE = client.BATCH_BYTES
+PROGRESS_INTERVAL = 0.5
+
+
+class Checkout(object):
+    """Copies a tree out of the store. Trees are walked breadth-first, with
+    one batch of requests per level, while ``jobs`` worker threads fetch
+    file contents in batches and write them to disk. Big files are written a
+    batch of chunks or a range of the blob at a time, so no worker holds much
+    more than ``client.BATCH_BYTES`` in memory.
+    """
+
+    def __init__(self, store, jobs=JOBS, progress=sys.stderr):
+        self.store = store
+        self.jobs = max(jobs, 1)
+        self.progress = progress
+        self.queue = Queue.Queue(self.jobs * 2)
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.errors = []
+        self.started = self.reported = 0
+        self.chunks_per_batch = max(STREAM_SIZE // chunker.MAX_CHUNK_SIZE, 1)
+
+    def __error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+    def __wrote(self, path, attr, size):
+        os.chmod(path, attr.mod)
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    def __report(self, final=False):
+        if self.progress is None:
+            return
+        now = time.time()
+        if not final and now - self.reported < PROGRESS_INTERVAL:
+            return
+        self.reported = now
+        elapsed = max(now - self.started, 0.001)
+        megabytes = self.bytes / 1048576.0
+        line = '%d files, %.1f MB, %.1f MB/s' % (self.files, megabytes,
+                                                 megabytes / elapsed)
+        if final:
+            print >>self.progress, '\r%s in %.1fs' % (line, elapsed)
+        elif self.progress.isatty():
+            self.progress.write('\r' + line)
+            self.progress.flush()
+
+    def __put(self, job):
+        while True:
+            try:
+                self.queue.put(job, timeout=PROGRESS_INTERVAL)
+                return
+            except Queue.Full:
+                self.__report()
+
+    def __walk(self, treeref, dest, dirs):
+        level = [(treeref, dest)]
+        while level:
+            trees = self.store.get_trees(list(set(ref for ref, _ in level)))
+            next_level = []
+            batch = []
+            batch_bytes = 0
+            for ref, dirname in level:
+                attrs = trees.get(ref)
+                if attrs is None:
+                    self.__error('missing tree %s for %s' % (ref, dirname))
+                    continue
+                for attr in attrs:
+                    path = os.path.join(dirname, attr.name)
+                    if attr.typ == treestore.TYPE_TREE:
+                        if not os.path.isdir(path):
+                            os.mkdir(path)
+                        dirs.append((path, attr.mod))
+                        next_level.append((attr.ref, path))
+                    elif (attr.typ == treestore.TYPE_CHUNKS or
+                          attr.size is None or attr.size > STREAM_SIZE):
+                        self.__put((path, attr))
+                    else:
+                        if (len(batch) >= client.BATCH_SIZE or
+                                batch_bytes + attr.size > STREAM_SIZE):
+                            self.__put(batch)
+                            batch = []
+                            batch_bytes = 0
+                        batch.append((path, attr))
+                        batch_bytes += attr.size
+            if batch:
+                self.__put(batch)
+            level = next_level
+            self.__report()
+
+    def __write_blobs(self, batch):
+        blobs = self.store.get_blobs([attr.ref for path, attr in batch])
+        for path, attr in batch:
+            blob = blobs.get(attr.ref)
+            if blob is None:
+                self.__error('missing blob %s for %s' % (attr.ref, path))
+                continue
+            with open(path, 'wb') as fp:
+                fp.write(blob)
+            self.__wrote(path, attr, len(blob))
+
+    def __write_file(self, path, attr):
+        size = 0
+        with open(path, 'wb') as fp:
+            if attr.typ == treestore.TYPE_CHUNKS:
+                chunks = self.store.get_chunks(attr.ref)
+                for batch in client.batches(chunks, self.chunks_per_batch):
+                    blobs = self.store.get_blobs([c.ref for c in batch])
+                    for chunk in batch:
+                        blob = blobs.get(chunk.ref)
+                        if blob is None:
+                            self.__error('missing chunk %s for %s' %
+                                         (chunk.ref, path))
+                            return
+                        fp.write(blob)
+                        size += len(blob)
+            else:
+                while True:
+                    blob = self.store.get_blob(attr.ref, size=STREAM_SIZE,
+                                               offset=size)
+                    if blob is None:
+                        self.__error('missing blob %s for %s' %
+                                     (attr.ref, path))
+                        return
+                    fp.write(blob)
+                    size += len(blob)
+                    if len(blob) < STREAM_SIZE:
+                        break
+        self.__wrote(path, attr, size)
+
+    def __work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                if isinstance(job, list):
+                    self.__write_blobs(job)
+                else:
+                    self.__write_file(*job)
+            except Exception, e:
+                self.__error('%s: %s' % (type(e).__name__, e))
+
+    def run(self, treeref, dest):
+        """Write the tree at ``treeref`` into the directory ``dest`` and
+        return a list of error messages.
+        """
+        self.started = time.time()
+        workers = [threading.Thread(target=self.__work)
+                   for _ in xrange(self.jobs)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        dirs = []
+        try:
+            self.__walk(treeref, dest, dirs)
+        finally:
+            for worker in workers:
+                self.queue.put(None)
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(PROGRESS_INTERVAL)
+                    self.__report()
+        # Directory modes are set last, deepest first, in case one of them
+        # doesn't allow writing.
+        for path, mod in reversed(dirs):
+            os.chmod(path, mod)
+        self.__report(final=True)
+        return self.errors
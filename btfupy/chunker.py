@@ -0,0 +1,128 @@
+import cPickle
+import hashlib
+import struct
+
+# Chunk boundaries are found with a gear hash (a table-driven variant of
+# buzhash): every input byte shifts the 32-bit hash left and adds a random
+# value from the table, so the hash only depends on the last 32 bytes and a
+# boundary found in unchanged content is found again after an edit elsewhere.
+GEAR = [int(hashlib.sha1('btfu-gear-%d' % i).hexdigest()[:8], 16)
+        for i in xrange(256)]
+HASH_MASK = 0xffffffff
+
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_BITS = 20 # on average one boundary every 1 MiB past the minimum
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# Boundaries are looked for a block at a time. The low SCAN_BITS bits of the
+# hash at every position of a block are computed at once: each byte is
+# widened through a table to a 24-bit lane holding its gear value's low bits,
+# the lanes are packed into one long, and multiplying by SPREAD adds every
+# lane, shifted, into the SCAN_BITS - 1 lanes after it. Lane sums stay below
+# 2 ** 24, so lanes don't carry into each other. Only positions whose low bits
+# come out zero are hashed byte by byte.
+SCAN_SIZE = 128 * 1024
+SCAN_BITS = 12
+SCAN_MASK = (1 << SCAN_BITS) - 1
+LANE_SIZE = 3
+LANE_LOW = ''.join(chr(g & 0xff) for g in GEAR)
+LANE_HIGH = ''.join(chr((g & SCAN_MASK) >> 8) for g in GEAR)
+SPREAD = sum(1 << (LANE_SIZE * 8 + 1) * j for j in xrange(SCAN_BITS))
+
+
+def to_long(data):
+    """Return the string ``data`` as a little-endian unsigned long.
+
+    Pickle's LONG4 opcode holds a long as its little-endian bytes, and
+    loading it is much faster than going through hex.
+    """
+    return cPickle.loads('\x80\x02\x8b' + struct.pack('<i', len(data) + 1) +
+                         data + '\0.')
+
+
+def from_long(n, size):
+    """Return the low ``size`` bytes of the long ``n`` >= 0, little-endian."""
+    data = cPickle.dumps(n, 2)
+    if data[2] != '\x8b':
+        data = '\0' * 7 + data[4:4 + ord(data[3])] # LONG1, for small longs
+    return data[7:7 + size].ljust(size, '\0')
+
+
+def hash_matches(buf, start, i, mask):
+    """Return whether the hash of ``buf[start:i + 1]`` has no bits of
+    ``mask`` set.
+    """
+    gear = GEAR
+    h = 0
+    for k in xrange(max(start, i - 31), i + 1):
+        h = ((h << 1) + gear[buf[k]]) & HASH_MASK
+    return not h & mask
+
+
+def find_boundary(buf, start, end, bits=AVG_CHUNK_BITS):
+    """Return the index just past the first content-defined boundary in
+    ``buf[start:end]``, or ``None`` if there isn't one.
+    """
+    mask = (1 << bits) - 1
+    if bits < SCAN_BITS:
+        gear = GEAR
+        h = 0
+        for i in xrange(start, end):
+            h = ((h << 1) + gear[buf[i]]) & HASH_MASK
+            if not h & mask:
+                return i + 1
+        return None
+    for pos in xrange(start, end, SCAN_SIZE):
+        # The lanes before pos only provide the bytes hashed into pos.
+        base = max(start, pos - SCAN_BITS + 1)
+        data = bytes(buf[base:min(end, pos + SCAN_SIZE)])
+        size = len(data) * LANE_SIZE
+        lanes = bytearray(size)
+        lanes[0::LANE_SIZE] = data.translate(LANE_LOW)
+        lanes[1::LANE_SIZE] = data.translate(LANE_HIGH)
+        sums = from_long(to_long(bytes(lanes)) * SPREAD, size)
+        low = sums[0::LANE_SIZE]
+        i = low.find('\0', pos - base)
+        while i >= 0:
+            if (not ord(sums[i * LANE_SIZE + 1]) << 8 & SCAN_MASK and
+                    hash_matches(buf, start, base + i, mask)):
+                return base + i + 1
+            i = low.find('\0', i + 1)
+    return None
+
+
+def chunks(fp, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE,
+           bits=AVG_CHUNK_BITS):
+    """Split the file object ``fp`` into content-defined chunks and yield
+    them one at a time as strings. At most ``max_size + READ_SIZE`` bytes are
+    held in memory.
+    """
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = fp.read(READ_SIZE)
+            if not data:
+                eof = True
+            buf.extend(data)
+        if not buf:
+            return
+        end = min(len(buf), max_size)
+        cut = None
+        if end > min_size:
+            cut = find_boundary(buf, min_size, end, bits)
+        if cut is None:
+            cut = end
+        yield str(buf[:cut])
+        del buf[:cut]
+
+
+def chunk_sizes(path, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE,
+                bits=AVG_CHUNK_BITS):
+    """Return the sizes of the content-defined chunks of the file at
+    ``path``. Only sizes are returned so that boundaries can be found in
+    another process cheaply.
+    """
+    with open(path, 'rb') as fp:
+        return [len(chunk) for chunk in chunks(fp, min_size, max_size, bits)]
@@ -0,0 +1,234 @@
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+
+from . import chunker
+from . import metrics
+from .blobstore import client
+from .blobstore import treestore
+
+JOBS = multiprocessing.cpu_count()
+UPLOADS = client.POOL_SIZE
+BATCH_WAIT = 0.05 # how long an uploader waits for more blobs to batch
+
+
+class Directory(object):
+
+    def __init__(self, path, st, parent=None, attr=None):
+        self.path = path
+        self.st = st
+        self.parent = parent
+        self.attr = attr
+        self.attrs = []
+        # One for every entry that hasn't been hashed yet, plus one until
+        # the directory has been listed.
+        self.pending = 1
+
+
+class Commit(object):
+    """Puts a working directory tree in the store as a pipeline. The calling
+    thread walks the tree, ``jobs`` threads read and hash files, and
+    ``uploads`` threads check which blobs the server is missing and upload
+    them in batches, so disk reads, hashing and round trips overlap. File
+    reads and SHA-1 release the GIL, but finding chunk boundaries doesn't,
+    so that's done by a pool of ``jobs`` processes. Every tree blob is
+    assembled as soon as its last entry has been hashed.
+    """
+
+    def __init__(self, store, jobs=JOBS, uploads=UPLOADS, index=None):
+        self.store = store
+        self.jobs = max(jobs, 1)
+        self.uploads = max(uploads, 1)
+        self.index = index
+        self.hash_queue = Queue.Queue(self.jobs * 4)
+        self.upload_queue = Queue.Queue()
+        self.lock = threading.Lock()
+        # Blobs waiting to be uploaded are held in memory, so hashing waits
+        # while more than this many bytes are queued.
+        self.max_upload_bytes = 2 * self.uploads * client.BATCH_BYTES
+        self.upload_bytes = 0
+        self.upload_cond = threading.Condition()
+        self.queued = set()
+        self.failed = False
+        self.error = None
+        self.treeref = None
+        self.pool = None
+
+    def __fail(self):
+        with self.lock:
+            if self.error is None:
+                self.error = sys.exc_info()
+
+    def __upload(self, ref, blob):
+        with self.upload_cond:
+            if ref in self.queued:
+                return
+            self.queued.add(ref)
+            if self.upload_bytes > self.max_upload_bytes:
+                with metrics.timer('commit.upload_wait'):
+                    while self.upload_bytes > self.max_upload_bytes:
+                        self.upload_cond.wait()
+            self.upload_bytes += len(blob)
+        self.upload_queue.put((ref, blob))
+
+    def __upload_worker(self):
+        done = False
+        while not done:
+            item = self.upload_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            size = len(item[1])
+            while (len(batch) < client.BATCH_SIZE and
+                   size < client.BATCH_BYTES):
+                try:
+                    item = self.upload_queue.get(timeout=BATCH_WAIT)
+                except Queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+                size += len(item[1])
+            try:
+                with metrics.timer('commit.upload'):
+                    refs = self.store.put_blobs([blob for _, blob in batch])
+                if None in refs:
+                    self.failed = True
+            except Exception:
+                self.__fail()
+            with self.upload_cond:
+                self.upload_bytes -= size
+                self.upload_cond.notify_all()
+
+    def __get_pool(self):
+        # Started the first time a file has to be chunked, so that commits
+        # of unchanged trees don't fork at all.
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.jobs)
+            return self.pool
+
+    def __hash_chunks(self, path):
+        ls = []
+        offset = 0
+        with metrics.timer('commit.chunk'):
+            if self.jobs > 1:
+                sizes = self.__get_pool().apply(chunker.chunk_sizes, (path,))
+            else:
+                sizes = chunker.chunk_sizes(path)
+        with open(path, 'rb') as fp:
+            for size in sizes:
+                blob = fp.read(size)
+                ref = self.store.blobref(blob)
+                self.__upload(ref, blob)
+                ls.append(str(treestore.ChunkAttr(ref, offset, len(blob))))
+                offset += len(blob)
+        blob = '\n'.join(ls)
+        ref = self.store.blobref(blob)
+        self.__upload(ref, blob)
+        return ref, offset
+
+    def __hash_worker(self):
+        while True:
+            job = self.hash_queue.get()
+            if job is None:
+                return
+            directory, attr, path, st = job
+            try:
+                if attr.typ == treestore.TYPE_CHUNKS:
+                    attr.ref, attr.size = self.__hash_chunks(path)
+                else:
+                    with metrics.timer('commit.read'):
+                        blob = self.store.read_file(path)
+                    with metrics.timer('commit.hash'):
+                        attr.ref = self.store.blobref(blob)
+                    attr.size = len(blob)
+                    self.__upload(attr.ref, blob)
+                if self.index is not None:
+                    self.index.set(path, st, attr.typ, attr.ref)
+            except Exception:
+                self.__fail()
+            self.__finish(directory)
+
+    def __finish(self, directory):
+        """Count off one pending entry of ``directory`` and, if it was the
+        last one, put its tree blob and finish its parent in turn.
+        """
+        while directory is not None:
+            with self.lock:
+                directory.pending -= 1
+                if directory.pending:
+                    return
+            blob = treestore.format_tree(directory.attrs)
+            ref = self.store.blobref(blob)
+            if (self.index is None or
+                    not self.index.lookup_tree(directory.path, ref)):
+                self.__upload(ref, blob)
+            if self.index is not None:
+                self.index.set(directory.path, directory.st,
+                               treestore.TYPE_TREE, ref)
+            if directory.parent is None:
+                self.treeref = ref
+                return
+            directory.attr.ref = ref
+            directory.attr.size = len(blob)
+            directory = directory.parent
+
+    def __walk(self, directory):
+        for name in os.listdir(directory.path):
+            if self.store.ignore_file(name):
+                continue
+            path = os.path.join(directory.path, name)
+            st = os.lstat(path)
+            typ = self.store.file_type(st)
+            attr = treestore.FileAttr(typ, None, st.st_mode, name,
+                                      st.st_size)
+            directory.attrs.append(attr)
+            if typ == treestore.TYPE_TREE:
+                with self.lock:
+                    directory.pending += 1
+                self.__walk(Directory(path, st, directory, attr))
+                continue
+            if self.index is not None:
+                attr.ref = self.index.lookup(path, st)
+                if attr.ref is not None:
+                    continue
+            with self.lock:
+                directory.pending += 1
+            self.hash_queue.put((directory, attr, path, st))
+        self.__finish(directory)
+
+    def run(self, path):
+        """Put the tree at ``path`` and return its ref, or ``None`` if a blob
+        couldn't be uploaded.
+        """
+        hashers = [threading.Thread(target=self.__hash_worker)
+                   for _ in xrange(self.jobs)]
+        uploaders = [threading.Thread(target=self.__upload_worker)
+                     for _ in xrange(self.uploads)]
+        for worker in hashers + uploaders:
+            worker.daemon = True
+            worker.start()
+        try:
+            self.__walk(Directory(path, os.lstat(path)))
+        finally:
+            for worker in hashers:
+                self.hash_queue.put(None)
+            for worker in hashers:
+                worker.join()
+            for worker in uploaders:
+                self.upload_queue.put(None)
+            for worker in uploaders:
+                worker.join()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        if self.failed:
+            return None
+        return self.treeref
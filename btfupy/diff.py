@@ -0,0 +1,125 @@
+import os
+
+from .blobstore import treestore
+
+ADDED = 'A'
+DELETED = 'D'
+MODIFIED = 'M'
+TYPE_CHANGED = 'T'
+
+
+class Diff(object):
+    """Compares trees entry by entry, descending only into subtrees whose
+    refs differ, so the cost grows with the size of the change rather than
+    the size of the trees. Trees are compared a level at a time, with one
+    batch of requests per level. Added and deleted directories are reported
+    as a whole, with a trailing slash.
+
+    When a tree is compared with a working directory, a file is only read
+    and hashed if its stat data doesn't match the stat ``index``. A file
+    whose size differs from the one recorded in the tree is modified without
+    being read.
+    """
+
+    def __init__(self, store, index=None):
+        self.store = store
+        self.index = index
+        self.changes = []
+
+    def __change(self, status, path, attr):
+        if attr.typ == treestore.TYPE_TREE:
+            path += os.sep
+        self.changes.append((status, path))
+
+    def __get_level(self, refs):
+        trees = self.store.get_trees(list(set(refs)))
+        for ref in refs:
+            if ref not in trees:
+                raise IOError('missing tree %s' % ref)
+        return dict((ref, dict((attr.name, attr) for attr in attrs))
+                    for ref, attrs in trees.iteritems())
+
+    def __compare(self, old, new, path):
+        """Record the change from ``old`` to ``new`` at ``path``, if any, and
+        return ``True`` if both are trees with different contents.
+        """
+        if old is None:
+            self.__change(ADDED, path, new)
+            return False
+        if new is None:
+            self.__change(DELETED, path, old)
+            return False
+        old_tree = old.typ == treestore.TYPE_TREE
+        new_tree = new.typ == treestore.TYPE_TREE
+        if old_tree != new_tree:
+            self.changes.append((TYPE_CHANGED, path))
+        elif old_tree:
+            return old.ref != new.ref
+        elif old.ref != new.ref or old.mod != new.mod:
+            self.changes.append((MODIFIED, path))
+        return False
+
+    def trees(self, old_ref, new_ref):
+        """Return the sorted ``(status, path)`` changes from the tree at
+        ``old_ref`` to the tree at ``new_ref``.
+        """
+        self.changes = []
+        level = [(old_ref, new_ref, '')] if old_ref != new_ref else []
+        while level:
+            trees = self.__get_level([ref for pair in level
+                                      for ref in pair[:2]])
+            next_level = []
+            for old_ref, new_ref, dirpath in level:
+                old, new = trees[old_ref], trees[new_ref]
+                for name in set(old) | set(new):
+                    path = os.path.join(dirpath, name)
+                    if self.__compare(old.get(name), new.get(name), path):
+                        next_level.append((old[name].ref, new[name].ref,
+                                           path))
+            level = next_level
+        return sorted(self.changes, key=lambda change: change[1])
+
+    def __file_ref(self, path, st, typ, attr):
+        if self.index is not None:
+            ref = self.index.lookup(path, st)
+            if ref is not None:
+                return ref
+        if (attr.typ == typ and attr.size is not None and
+                attr.size != st.st_size):
+            return None # a different size means different content
+        return self.store.hash_file(path, typ)
+
+    def worktree(self, treeref, root):
+        """Return the sorted ``(status, path)`` changes from the tree at
+        ``treeref`` to the working directory ``root``. Paths are relative to
+        ``root``.
+        """
+        self.changes = []
+        level = [(treeref, '')]
+        while level:
+            trees = self.__get_level([ref for ref, _ in level])
+            next_level = []
+            for ref, dirpath in level:
+                old = trees[ref]
+                new = {}
+                for name in os.listdir(os.path.join(root, dirpath)):
+                    if self.store.ignore_file(name):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    st = os.lstat(os.path.join(root, path))
+                    typ = self.store.file_type(st)
+                    attr = new[name] = treestore.FileAttr(typ, None,
+                                                          st.st_mode, name)
+                    if (typ == treestore.TYPE_TREE or name not in old or
+                            old[name].typ == treestore.TYPE_TREE):
+                        continue
+                    attr.ref = self.__file_ref(os.path.join(root, path), st,
+                                               typ, old[name])
+                for name in set(old) | set(new):
+                    path = os.path.join(dirpath, name)
+                    # Directories on disk have no ref yet, so they always
+                    # compare as different trees.
+                    if self.__compare(old.get(name), new.get(name), path):
+                        next_level.append((old[name].ref, path))
+            level = next_level
+        return sorted(self.changes, key=lambda change: change[1])
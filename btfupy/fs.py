@@ -3,194 +3,335 @@ import logging
 import os
 import stat
 import sys
+import tempfile
+import threading
 
 import fuse
 
+from . import metrics
 from .blobstore import treestore
 
 ENCODING = 'utf-8'
 
 
+class FileHandle:
+    """An open file. Writes go to a local temporary file, the buffer, which
+    is put in the store as a whole when the handle is flushed.
+    """
+
+    def __init__(self, path, attr):
+        self.path = path
+        self.attr = attr
+        self.buffer = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def size(self):
+        self.buffer.flush()
+        return os.fstat(self.buffer.fileno()).st_size
+
+
 class BTFS(fuse.Operations):
+    """Changes to the tree are staged in a single transaction and written to
+    the store when a file is fsynced or the file system is unmounted.
+    """
 
     def __init__(self, store, rootref=None):
         self.store = store
         self.rootref = rootref
+        self.txn = store.transaction(rootref)
         self.fh = 0
-        self.fh_refs = {}
+        self.handles = {}
+        self.lock = threading.RLock()
+
+    def __call__(self, op, *args):
+        # Every file system operation is dispatched through here. A blob that
+        # can't be fetched fails the operation rather than reading as empty.
+        with metrics.timer('fs.' + op):
+            try:
+                return fuse.Operations.__call__(self, op, *args)
+            except IOError:
+                raise fuse.FuseOSError(errno.EIO)
+
+    def __open_handle(self, handle):
+        with self.lock:
+            self.fh += 1
+            self.handles[self.fh] = handle
+            return self.fh
+
+    def __get_dirty_handle(self, path):
+        for handle in self.handles.values():
+            if handle.path == path and handle.dirty:
+                return handle
+        return None
+
+    def __load_buffer(self, handle):
+        """Copy the file's stored content into the handle's buffer, unless
+        it already has one.
+        """
+        if handle.buffer is not None:
+            return
+        attr = handle.attr
+        if attr.typ == treestore.TYPE_CHUNKS:
+            refs = [chunk.ref for chunk in self.store.get_chunks(attr.ref)]
+        else:
+            refs = [attr.ref]
+        buf = tempfile.NamedTemporaryFile(prefix='btfu-')
+        for ref in refs:
+            blob = self.store.get_blob(ref)
+            if blob is None:
+                buf.close()
+                raise IOError('missing blob %s' % ref)
+            buf.write(blob)
+        handle.buffer = buf
+
+    def __commit(self, handle):
+        """Put the handle's buffer in the store and link it into the tree."""
+        with handle.lock:
+            if not handle.dirty or handle.path is None:
+                return
+            handle.buffer.flush()
+            st = os.fstat(handle.buffer.fileno())
+            typ = self.store.file_type(st)
+            ref = self.store.put_file(handle.buffer.name)
+            handle.dirty = False
+        with self.lock:
+            attr = self.txn.get(handle.path)
+            if attr is None:
+                return
+            attr.typ = typ
+            attr.ref = ref
+            attr.size = st.st_size
+            self.txn.set(handle.path, attr)
+            handle.attr = attr
+
+    def __stat(self, attr):
+        return dict(st_mode=attr.mod, st_size=self.store.get_attr_size(attr))
+
+    def commit(self):
+        """Write the staged changes to the store and return the ref of the
+        new root tree.
+        """
+        with self.lock:
+            rootref = self.txn.commit()
+            if rootref is None:
+                raise fuse.FuseOSError(errno.EIO)
+            self.rootref = rootref
+            return rootref
 
     def access(self, path, mode):
-        # print 'access', path, mode
         path = path.encode(ENCODING)
-        if self.store.blobref_by_path(self.rootref, path):
-            return 0
+        with self.lock:
+            if path == os.sep or self.txn.get(path):
+                return 0
         raise fuse.FuseOSError(errno.EACCES)
 
     def chmod(self, path, mode):
-        # print 'chmod', path, mode
         path = path.encode(ENCODING)
-        attr = self.store.get_attr(self.rootref, path)
-        attr.mod = mode
-        self.rootref = self.store.set_attr(self.rootref, path, attr)
+        with self.lock:
+            attr = self.txn.get(path)
+            if not attr:
+                raise fuse.FuseOSError(errno.ENOENT)
+            attr.mod = mode
+            self.txn.set(path, attr)
         return 0
 
     def chown(self, path, uid, gid):
-        # print 'chown', path, uid, gid
         return 0
 
     def create(self, path, mode):
-        # print 'create', path, mode
         path = path.encode(ENCODING)
-        self.fh += 1
-        fh = self.fh
-        ref = self.fh_refs[fh] = self.store.put_blob('')
+        ref = self.store.put_blob('')
         attr = treestore.FileAttr(treestore.TYPE_BLOB, ref, mode,
-                                  os.path.split(path)[-1])
-        self.rootref = self.store.set_attr(self.rootref, path, attr)
-        return fh
+                                  os.path.split(path)[-1], 0)
+        with self.lock:
+            self.txn.set(path, attr)
+        handle = FileHandle(path, attr)
+        handle.buffer = tempfile.NamedTemporaryFile(prefix='btfu-')
+        return self.__open_handle(handle)
 
     def flush(self, path, fh):
-        # print 'flush', path, fh
-        pass
+        self.__commit(self.handles[fh])
+
+    def destroy(self, path):
+        self.commit()
+
+    def fsync(self, path, datasync, fh):
+        self.__commit(self.handles[fh])
+        self.commit()
 
     def getattr(self, path, fh=None):
-        # print 'getattr', path, fh
         path = path.encode(ENCODING)
         if path == os.sep:
             return dict(st_mode=(stat.S_IFDIR | 0755), st_nlink=2)
-        attr = self.store.get_attr(self.rootref, path)
+        with self.lock:
+            attr = self.txn.get(path)
         if not attr:
             raise fuse.FuseOSError(errno.ENOENT)
-        return dict(st_mode=attr.mod, st_size=self.store.get_size(attr.ref))
+        handle = self.handles.get(fh) if fh is not None else None
+        if handle is None or not handle.dirty:
+            handle = self.__get_dirty_handle(path)
+        if handle is not None and handle.dirty:
+            with handle.lock:
+                attr.size = handle.size()
+        return self.__stat(attr)
 
     def getxattr(self, path, name, position=0):
-        # print 'getxattr', path, name, position
         raise fuse.FuseOSError(errno.ENOATTR)
 
     def listxattr(self, path):
-        # print 'listxattr', path
         raise fuse.FuseOSError(errno.ENOATTR)
 
     def mkdir(self, path, mode):
-        # print 'mkdir', path, mode
         path = path.encode(ENCODING)
         ref = self.store.put_blob('')
         attr = treestore.FileAttr(treestore.TYPE_TREE, ref, mode,
-                                  os.path.split(path)[-1])
-        self.rootref = self.store.set_attr(self.rootref, path, attr)
+                                  os.path.split(path)[-1], 0)
+        with self.lock:
+            self.txn.set(path, attr)
 
     def open(self, path, flags):
         # TODO: If the write flag is set, open a temporary copy.
-        # print 'open', path, flags
         path = path.encode(ENCODING)
-        ref = self.store.blobref_by_path(self.rootref, path)
-        self.fh += 1
-        self.fh_refs[self.fh] = ref
-        return self.fh
+        with self.lock:
+            attr = self.txn.get(path)
+        if not attr:
+            raise fuse.FuseOSError(errno.ENOENT)
+        return self.__open_handle(FileHandle(path, attr))
 
     def read(self, path, size, offset, fh):
-        # print 'read', path, size, offset, fh
-        return self.store.get_blob(self.fh_refs[fh], size=size, offset=offset)
+        handle = self.handles[fh]
+        with handle.lock:
+            if handle.buffer is not None:
+                handle.buffer.seek(offset)
+                return handle.buffer.read(size)
+        attr = handle.attr
+        return self.store.get_file_blob(attr.ref, size=size, offset=offset,
+                                        typ=attr.typ)
 
     def readdir(self, path, fh):
-        # print 'readdir', path, fh
         path = path.encode(ENCODING)
-        return ['.', '..'] + map(lambda s: s.decode(ENCODING),
-                                 self.store.files_by_path(self.rootref, path))
+        entries = ['.', '..']
+        with self.lock:
+            attrs = self.txn.list(path)
+        for attr in attrs:
+            name = attr.name.decode(ENCODING)
+            if attr.size is None:
+                entries.append(name)
+            else:
+                entries.append((name, self.__stat(attr), 0))
+        return entries
 
     def readlink(self, path):
-        # print 'readlink', path
         path = path.encode(ENCODING)
-        return self.store.get_blob_by_path(self.rootref, path)
+        with self.lock:
+            attr = self.txn.get(path)
+        if not attr:
+            raise fuse.FuseOSError(errno.ENOENT)
+        return self.store.get_blob(attr.ref)
 
     def release(self, path, fh):
-        # print 'release', path, fh
-        # TODO: add path to root
-        del self.fh_refs[fh]
+        handle = self.handles[fh]
+        self.__commit(handle)
+        with self.lock:
+            del self.handles[fh]
+        if handle.buffer is not None:
+            handle.buffer.close()
 
     def removexattr(self, path, name):
-        # print 'removexattr', path, name
         raise fuse.FuseOSError(errno.ENOATTR)
 
     def rename(self, old, new):
-        # print 'rename', old, new
         old = old.encode(ENCODING)
         new = new.encode(ENCODING)
-        attr = self.store.get_attr(self.rootref, old)
-        old_dirpath, old_filename = os.path.split(old)
-        new_dirpath, new_filename = os.path.split(new)
-        if old_dirpath == new_dirpath:
-            attr.name = new_filename
-            self.rootref = self.store.set_attr(self.rootref, old, attr)
-            return
-        new_attr = treestore.FileAttr(attr.typ, attr.typ, attr.mod,
-                                      new_filename)
-        attr.ref = None
-        # TODO: try to do this without rebuilding the tree twice.
-        self.rootref = self.store.set_attr(self.rootref, old, attr)
-        self.rootref = self.store.set_attr(self.rootref, new, new_attr)
+        with self.lock:
+            self.txn.rename(old, new)
+            for handle in self.handles.values():
+                if handle.path is None:
+                    continue
+                if handle.path == new:
+                    handle.path = None
+                elif handle.path == old:
+                    handle.path = new
+                elif handle.path.startswith(old + os.sep):
+                    handle.path = new + handle.path[len(old):]
 
     def rmdir(self, path):
-        # print 'rmdir', path
         path = path.encode(ENCODING)
-        attr = self.store.get_attr(self.rootref, path)
-        if self.store.get_size(attr.ref):
-            raise fuse.FuseOSError(errno.ENOTEMPTY)
-        attr.ref = None
-        self.rootref = self.store.set_attr(self.rootref, path, attr)
+        with self.lock:
+            if not self.txn.get(path):
+                raise fuse.FuseOSError(errno.ENOENT)
+            if self.txn.list(path):
+                raise fuse.FuseOSError(errno.ENOTEMPTY)
+            self.txn.delete(path)
 
     def statfs(self, path):
-        # print 'statfs', path
         return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
 
     def setxattr(self, path, name, value, options, position=0):
-        # print 'setxattr', path, name, value, options, position
         pass
 
     def symlink(self, target, source):
         # BUG: "too many levels of symbolic links" when trying to read a linked
         # file.
-        # print 'symlink', target, source
         target = target.encode(ENCODING)
         source = source.encode(ENCODING)
         ref = self.store.put_blob(source)
         attr = treestore.FileAttr(treestore.TYPE_BLOB, ref,
                                   stat.S_IFLNK | 0755,
-                                  os.path.split(target)[1])
-        self.rootref = self.store.set_attr(self.rootref, target, attr)
+                                  os.path.split(target)[1], len(source))
+        with self.lock:
+            self.txn.set(target, attr)
 
     def truncate(self, path, length, fh=None):
-        print 'truncate', path, length, fh
         path = path.encode(ENCODING)
-        attr = self.store.get_attr(self.rootref, path)
-        attr.ref = self.store.put_blob(self.store.get_blob(attr.ref,
-                                                           size=length))
-        self.rootref = self.store.set_attr(self.rootref, path, attr)
-        if fh is not None:
-            self.fh_refs[fh] = attr.ref
+        handle = self.handles.get(fh) if fh is not None else None
+        if handle is None:
+            handle = self.__get_dirty_handle(path)
+        temporary = handle is None
+        if temporary:
+            with self.lock:
+                attr = self.txn.get(path)
+            if not attr:
+                raise fuse.FuseOSError(errno.ENOENT)
+            handle = FileHandle(path, attr)
+        with handle.lock:
+            if length == 0 and handle.buffer is None:
+                handle.buffer = tempfile.NamedTemporaryFile(prefix='btfu-')
+            self.__load_buffer(handle)
+            handle.buffer.truncate(length)
+            handle.dirty = True
+        if fh is None:
+            self.__commit(handle)
+        if temporary:
+            handle.buffer.close()
 
     def unlink(self, path):
         path = path.encode(ENCODING)
-        attr = self.store.get_attr(self.rootref, path)
-        attr.ref = None
-        self.rootref = self.store.set_attr(self.rootref, path, attr)
+        with self.lock:
+            for handle in self.handles.values():
+                if handle.path == path:
+                    handle.path = None
+            self.txn.delete(path)
 
     def utimens(self, path, times=None):
-        # print 'utimens', path, times
         pass
 
     def write(self, path, data, offset, fh):
-        # print 'write', path, offset, fh
-        path = path.encode(ENCODING)
-        attr = self.store.get_attr(self.rootref, path)
-        if not attr:
-            raise fuse.FuseOSError(errno.ENOENT)
-        attr.ref = self.fh_refs[fh] = self.store.put_blob(
-            self.store.get_blob(self.fh_refs[fh], size=offset) + data)
-        self.rootref = self.store.set_attr(self.rootref, path, attr)
+        handle = self.handles[fh]
+        with handle.lock:
+            self.__load_buffer(handle)
+            handle.buffer.seek(offset)
+            handle.buffer.write(data)
+            handle.dirty = True
         return len(data)
 
 
 def mount(store, treeref, mountpoint):
+    """Mount the tree at ``treeref`` and return the ref of the tree as it
+    was when it was unmounted.
+    """
     logging.getLogger().setLevel(logging.DEBUG)
-    fuse.FUSE(BTFS(store, treeref), mountpoint, foreground=True)
+    btfs = BTFS(store, treeref)
+    fuse.FUSE(btfs, mountpoint, foreground=True)
+    return btfs.commit()
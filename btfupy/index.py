@@ -0,0 +1,117 @@
+import os
+import time
+
+INDEX_FILENAME = '.btfuindex'
+INDEX_VERSION = 1
+
+
+def stat_ns(t):
+    return int(t * 1000000000)
+
+
+class IndexEntry:
+
+    def __init__(self, ino, size, mtime_ns, ctime_ns, mod, typ, ref):
+        self.ino = ino
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ctime_ns = ctime_ns
+        self.mod = mod
+        self.typ = typ
+        self.ref = ref
+
+    def __str__(self):
+        return '%d %d %d %d %06o %s %s' % (self.ino, self.size, self.mtime_ns,
+                                           self.ctime_ns, self.mod, self.typ,
+                                           self.ref)
+
+    @classmethod
+    def from_stat(cls, st, typ, ref):
+        return cls(st.st_ino, st.st_size, stat_ns(st.st_mtime),
+                   stat_ns(st.st_ctime), st.st_mode, typ, ref)
+
+    @classmethod
+    def parse(cls, s):
+        ino, size, mtime_ns, ctime_ns, mod, typ, ref = s.split(' ', 6)
+        return cls(int(ino), int(size), int(mtime_ns), int(ctime_ns),
+                   int(mod, 8), typ, ref)
+
+    def matches(self, st):
+        return (self.ino == st.st_ino and
+                self.size == st.st_size and
+                self.mtime_ns == stat_ns(st.st_mtime) and
+                self.ctime_ns == stat_ns(st.st_ctime) and
+                self.mod == st.st_mode)
+
+
+class Index:
+    """A persistent map of working tree paths to the stat data and refs they
+    had when they were last committed, so that unchanged files don't have to
+    be read, hashed or checked against the server again.
+
+    Every line of the index file is ``path\\0entry``. The first line records
+    when the index was written; entries modified at or after that time are
+    "racily clean" (they may have changed within the timestamp granularity)
+    and are never trusted.
+    """
+
+    def __init__(self, path=INDEX_FILENAME):
+        self.path = path
+        self.timestamp_ns = 0
+        self.started_ns = stat_ns(time.time())
+        self.old_entries = {}
+        self.entries = {}
+
+    @classmethod
+    def load(cls, path=INDEX_FILENAME):
+        index = cls(path)
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            return index
+        with fp:
+            header = fp.readline().split()
+            if header[:2] != ['btfu-index', str(INDEX_VERSION)]:
+                return index
+            index.timestamp_ns = int(header[2])
+            for line in fp:
+                key, value = line.rstrip('\n').split('\0', 1)
+                index.old_entries[key] = IndexEntry.parse(value)
+        return index
+
+    def lookup(self, path, st):
+        """Return the ref recorded for ``path`` if its stat data hasn't
+        changed since, otherwise ``None``.
+        """
+        key = os.path.normpath(path)
+        entry = self.old_entries.get(key)
+        if entry is None or not entry.matches(st):
+            return None
+        if entry.mtime_ns >= self.timestamp_ns:
+            return None
+        self.entries[key] = entry
+        return entry.ref
+
+    def lookup_tree(self, path, ref):
+        """Return ``True`` if ``ref`` was already recorded for the tree at
+        ``path``, i.e. it's known to be in the store.
+        """
+        entry = self.old_entries.get(os.path.normpath(path))
+        return entry is not None and entry.ref == ref
+
+    def set(self, path, st, typ, ref):
+        if ref is None or '\n' in path:
+            return
+        self.entries[os.path.normpath(path)] = IndexEntry.from_stat(st, typ,
+                                                                    ref)
+
+    def save(self):
+        """Atomically replace the index file with the entries that were
+        looked up or set since it was loaded.
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write('btfu-index %d %d\n' % (INDEX_VERSION, self.started_ns))
+            for key in sorted(self.entries):
+                fp.write('%s\0%s\n' % (key, self.entries[key]))
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,62 @@
+import collections
+import threading
+
+
+class LRUCache(object):
+    """A thread-safe mapping that evicts its least recently used items once
+    the sizes they were stored with add up to more than ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.size -= evicted_size
+
+    def discard(self, key):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def snapshot(self):
+        """Return the keys and values, least recently used first."""
+        with self.lock:
+            return [(key, value) for key, (value, _) in self.items.iteritems()]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
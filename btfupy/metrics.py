@@ -0,0 +1,214 @@
+import atexit
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in seconds, doubling from
+# 8us to about 67s. Slower observations fall into one more bucket.
+BUCKETS = [2 ** i / 1e6 for i in xrange(3, 27)]
+PERCENTILES = [('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)]
+
+
+def percentile(buckets, count, maximum, fraction):
+    """Return the upper bound of the bucket that holds the ``fraction``
+    percentile of ``count`` observations counted in ``buckets``. It's at
+    most twice the true value, and never more than ``maximum``.
+    """
+    rank = fraction * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if n and seen >= rank:
+            return min(BUCKETS[i], maximum) if i < len(BUCKETS) else maximum
+    return maximum
+
+
+class Counter(object):
+
+    __slots__ = ('lock', 'value')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def add(self, n=1):
+        with self.lock:
+            self.value += n
+
+
+class Histogram(object):
+    """Counts observed latencies in exponential buckets, so recording one
+    costs the same however many there have been.
+    """
+
+    __slots__ = ('lock', 'buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        with self.lock:
+            buckets = list(self.buckets)
+            count, total, maximum = self.count, self.total, self.max
+        snapshot = {
+            'count': count,
+            'total_ms': round(total * 1000, 3),
+            'max_ms': round(maximum * 1000, 3),
+            # upper bound in ms, or None for the last one, and count
+            'buckets': [[round(BUCKETS[i] * 1000, 3)
+                         if i < len(BUCKETS) else None, n]
+                        for i, n in enumerate(buckets) if n],
+        }
+        for key, fraction in PERCENTILES:
+            snapshot[key] = round(percentile(buckets, count, maximum,
+                                             fraction) * 1000, 3)
+        return snapshot
+
+
+class Timer(object):
+    """Records how long the body of a ``with`` statement takes in the
+    histogram ``name`` of ``registry``, and counts the exceptions that
+    escape it in the counter ``name.errors``.
+    """
+
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.registry.observe(self.name, time.time() - self.start)
+        if typ is not None:
+            self.registry.incr(self.name + '.errors')
+
+
+class Registry(object):
+    """The counters and latency histograms of a process, by name. Metrics
+    are created the first time they're used.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def __get(self, metrics, name, cls):
+        metric = metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = metrics.setdefault(name, cls())
+        return metric
+
+    def counter(self, name):
+        return self.__get(self.counters, name, Counter)
+
+    def histogram(self, name):
+        return self.__get(self.histograms, name, Histogram)
+
+    def incr(self, name, n=1):
+        self.counter(name).add(n)
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def snapshot(self):
+        """Return the current value of every metric as a dict that can be
+        serialized as JSON.
+        """
+        with self.lock:
+            counters = self.counters.items()
+            histograms = self.histograms.items()
+        now = time.time()
+        return {
+            'pid': os.getpid(),
+            'time': now,
+            'uptime': round(now - self.started, 3),
+            'counters': dict((name, counter.value)
+                             for name, counter in counters),
+            'histograms': dict((name, histogram.snapshot())
+                               for name, histogram in histograms),
+        }
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+incr = REGISTRY.incr
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+snapshot = REGISTRY.snapshot
+
+
+def format_snapshot(snapshot):
+    """Return the metrics ``snapshot`` as lines of text."""
+    lines = ['pid %d, up %.0fs' % (snapshot['pid'], snapshot['uptime'])]
+    if snapshot['counters']:
+        lines.append('')
+        lines.append('%-40s %12s' % ('counter', 'value'))
+        for name, value in sorted(snapshot['counters'].iteritems()):
+            lines.append('%-40s %12d' % (name, value))
+    if snapshot['histograms']:
+        lines.append('')
+        columns = ['count', 'total_ms'] + [key for key, _ in PERCENTILES]
+        columns.append('max_ms')
+        lines.append('%-40s' % 'latency' +
+                     ''.join(' %10s' % column for column in columns))
+        for name, histogram in sorted(snapshot['histograms'].iteritems()):
+            lines.append('%-40s %10d' % (name, histogram['count']) +
+                         ''.join(' %10.3f' % histogram[column]
+                                 for column in columns[1:]))
+    return '\n'.join(lines)
+
+
+def dump(fp, registry=REGISTRY):
+    json.dump(registry.snapshot(), fp, sort_keys=True)
+    fp.write('\n')
+    fp.flush()
+
+
+def start_dump(interval, path=None, registry=REGISTRY):
+    """Append a snapshot of ``registry`` as a line of JSON to the file at
+    ``path``, or to standard error, every ``interval`` seconds and when the
+    process exits.
+    """
+    def write():
+        if path:
+            with open(path, 'a') as fp:
+                dump(fp, registry)
+        else:
+            dump(sys.stderr, registry)
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            write()
+    thread = threading.Thread(target=loop)
+    thread.daemon = True
+    thread.start()
+    atexit.register(write)
+    return thread